@@ -1,13 +1,37 @@
-import tkinter as tk
+# Tkinter front end for the relay, on top of client.ServerConnection (the same network side the console client uses)
+# Tk is only ever touched from the main thread: a network thread reads from the socket and appends what arrives to a
+# deque, a writer thread sends (ServerConnection.state keeps the two of them off each other's room state), and the Tk
+# thread drains the deque every DRAIN_INTERVAL ms, a batch at a time, so a busy room costs one chat log redraw per batch
+# instead of one widget update per message.
+# The chat log only keeps the last LOG_LIMIT rows and only the rows that fit in the window are ever in the Text widget.
+
+import collections
+import queue
+import socket
 import threading
+import tkinter as tk
+import tkinter.filedialog as filedialog
+import tkinter.font as tkfont
+
 import client
+import e2e
+
+DRAIN_INTERVAL = 50  # ms between checks for new messages
+DRAIN_BATCH = 500    # most messages handled per check, the rest wait for the next one (scheduled right away)
+LOG_LIMIT = 5000     # rows kept in the chat log, older ones are dropped
+
 
 class App(tk.Tk):
 
     def __init__(self):
         super().__init__()
         self.title("Chat Room Application")
-        self.geometry("400x250")
+        self.geometry("520x420")
+
+        # set once connected
+        self.server = None
+        self.inbound = collections.deque()  # messages from the network thread, None once the connection is gone
+        self.outbox = queue.Queue()         # sends for the writer thread (functions), None stops it
 
         container = tk.Frame(self)
         container.pack(fill="both", expand=True)
@@ -18,24 +42,175 @@ class App(tk.Tk):
 
         self.frames = {}
 
-        for Page in (HomePage, JoinRoomPage, CreateRoomPage, OptionsPage):
+        for Page in (HomePage, JoinRoomPage, CreateRoomPage, OptionsPage, ChatPage):
             page_name = Page.__name__
             frame = Page(parent=container, controller=self)
             self.frames[page_name] = frame
             frame.grid(row=0, column=0, sticky="nsew")
 
         self.show_frame("HomePage")
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.after(DRAIN_INTERVAL, self.drain)
 
     def show_frame(self, page_name: str):
         frame = self.frames[page_name]
+        if hasattr(frame, "shown"):
+            frame.shown()
         frame.tkraise()
 
+    # connecting, registering, reading and writing all happen off the Tk thread
+    def connect(self, address, name):
+        threading.Thread(target=self.network_loop, args=(address, name), daemon=True).start()
+
+    def network_loop(self, address, name):
+        try:
+            sock = socket.create_connection(address, timeout=10)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            self.inbound.append({"TYPE": "ERROR", "MESSAGE": f"Could not connect: {e}"})
+            self.inbound.append(None)
+            return
+
+        self.server = client.ServerConnection(sock, e2e.E2ESession() if e2e.AVAILABLE else None)
+        threading.Thread(target=self.writer_loop, args=(self.server, self.outbox), daemon=True).start()
+        self.send(lambda server: server.register(name))
+
+        while True:
+            msgs = self.server.read()
+            # dropped, reconnect and pick up our session (the writer thread carries on with the new socket)
+            if msgs is None and self.server.token is not None:
+                self.inbound.append({"TYPE": "BROADCAST", "MESSAGE": "Disconnected from server, reconnecting..."})
+                msgs = self.server.reconnect(address)
+            if msgs is None:
+                self.inbound.append(None)
+                return
+            self.inbound.extend(msgs)
+
+    def writer_loop(self, server, outbox):
+        while True:
+            job = outbox.get()
+            if job is None:
+                return
+            try:
+                job(server)
+            except OSError:
+                # the connection dropped, whatever this was is lost, the network thread reconnects
+                pass
+            except Exception as e:
+                # anything else is a bug, the user hears about it and the writer goes on with the next send
+                self.inbound.append({"TYPE": "BROADCAST", "MESSAGE": f"Could not send: {e!r}"})
+
+    # job(server) runs on the writer thread
+    def send(self, job):
+        if self.server is not None:
+            self.outbox.put(job)
+
+    def send_message(self, msg):
+        self.send(lambda server: server.send(msg))
+
+    # a line typed into the chat, see ServerConnection.say
+    def say(self, text):
+        self.send(lambda server: self.inbound.extend(server.say(text)))
+
+    # handles up to DRAIN_BATCH messages from the network thread, chat lines go to the log in one go
+    def drain(self):
+        lines = []
+        handled = 0
+        while self.inbound and handled < DRAIN_BATCH:
+            msg = self.inbound.popleft()
+            handled += 1
+            if msg is None:
+                lines.append("Disconnected from server.")
+                self.disconnected()
+                continue
+            self.handle_message(msg, lines)
+
+        if lines:
+            self.frames["ChatPage"].log.extend(lines)
+        # more waiting, carry on as soon as Tk has had a chance to redraw
+        self.after(1 if self.inbound else DRAIN_INTERVAL, self.drain)
+
+    def handle_message(self, msg, lines):
+        match msg.get("TYPE"):
+
+            case "WELCOME":
+                self.frames["HomePage"].status.set(msg.get("MESSAGE"))
+                # resumed after a reconnect, we're still where we were
+                if msg.get("RESUMED"):
+                    lines.append(f"[BROADCAST]: {msg.get('MESSAGE')}")
+                else:
+                    self.show_frame("OptionsPage")
+
+            # the listing (or the changes since our copy) arrived, the server's copy is already updated
+            case "ROOM_LIST" | "ROOM_DELTA":
+                self.frames["JoinRoomPage"].display_rooms()
+
+            case "RECEIVE":
+                lines.append(f"{msg.get('FROM')}: {msg.get('MESSAGE')}")
+
+            # earlier messages of the room, on joining or asked for with !history
+            case "HISTORY":
+                entries = msg.get("MESSAGES") or []
+                if not entries:
+                    lines.append("[BROADCAST]: No older messages.")
+                lines.extend(f"{from_user}: {text}" for _, _, from_user, text, _ in entries)
+
+            case "BROADCAST":
+                lines.append(f"[BROADCAST]: {msg.get('MESSAGE')}")
+
+            case "CONNECTED":
+                self.frames["ChatPage"].entered(msg.get("ROOM_NAME"))
+                self.show_frame("ChatPage")
+
+            # left, kicked or refused, back to choosing a room
+            case "REJOIN":
+                self.frames["OptionsPage"].status.set(msg.get("MESSAGE"))
+                self.show_frame("OptionsPage")
+
+            case "ERROR":
+                self.frames["HomePage"].status.set(msg.get("MESSAGE"))
+
+    def disconnected(self):
+        self.outbox.put(None)
+        self.outbox = queue.Queue()
+        self.server = None
+        self.show_frame("HomePage")
+
+    def close(self):
+        if self.server is not None:
+            # the relay doesn't keep our session, and the network thread doesn't try to reconnect
+            self.server.logout()
+        self.destroy()
+
 class HomePage(tk.Frame):
     def __init__(self, parent, controller: App):
         super().__init__(parent)
+        self.controller = controller
         tk.Label(self, text="Home", font=("Arial", 18)).pack(pady=10)
-        tk.Button(self, text="Join / Create Room",
-                  command=lambda: controller.show_frame("OptionsPage")).pack()
+
+        tk.Label(self, text="Server").pack()
+        self.address = tk.Entry(self)
+        self.address.insert(0, "%s:%d" % client.SERVER)
+        self.address.pack()
+
+        tk.Label(self, text="Username").pack()
+        self.name = tk.Entry(self)
+        self.name.pack()
+        self.name.bind("<Return>", lambda event: self.connect())
+
+        tk.Button(self, text="Connect", command=self.connect).pack(pady=5)
+        self.status = tk.StringVar()
+        tk.Label(self, textvariable=self.status, wraplength=400).pack()
+
+    def connect(self):
+        host, _, port = self.address.get().strip().rpartition(":")
+        name = self.name.get().strip()
+        if not host or not port.isdigit() or not name:
+            self.status.set("Enter the server as host:port and a username.")
+            return
+        self.status.set("Connecting...")
+        self.controller.connect((host, int(port)), name)
 
 class OptionsPage(tk.Frame):
     def __init__(self, parent, controller: App):
@@ -45,28 +220,245 @@ class OptionsPage(tk.Frame):
                   command=lambda: controller.show_frame("CreateRoomPage")).pack()
         tk.Button(self, text="Join Room",
                   command=lambda: controller.show_frame("JoinRoomPage")).pack()
-        tk.Button(self, text="Back to Home",
-                  command=lambda: controller.show_frame("HomePage")).pack()
+        self.status = tk.StringVar()
+        tk.Label(self, textvariable=self.status, wraplength=400).pack(pady=10)
 
 class CreateRoomPage(tk.Frame):
     def __init__(self, parent, controller: App):
         super().__init__(parent)
+        self.controller = controller
+        tk.Label(self, text="Create Room", font=("Arial", 18)).pack(pady=10)
+
+        tk.Label(self, text="Room name").pack()
+        self.room_name = tk.Entry(self)
+        self.room_name.pack()
+        tk.Label(self, text="Password (optional)").pack()
+        self.password = tk.Entry(self, show="*")
+        self.password.pack()
+
+        tk.Button(self, text="Create", command=self.create).pack(pady=5)
         tk.Button(self, text="Back to Options",
                   command=lambda: controller.show_frame("OptionsPage")).pack()
 
+    def create(self):
+        room_name = self.room_name.get().strip()
+        if not room_name:
+            return
+        self.controller.send_message({"TYPE": "CREATE_ROOM", "ROOM_NAME": room_name, "PASSWORD": self.password.get() or None})
+        self.password.delete(0, "end")
+
 class JoinRoomPage(tk.Frame):
     def __init__(self, parent, controller: App):
         super().__init__(parent)
+        self.controller = controller
+        tk.Label(self, text="Join Room", font=("Arial", 18)).pack(pady=10)
+
+        # one row per room of the listing (the listing comes in pages, More asks for the next one)
+        rooms = tk.Frame(self)
+        rooms.pack(fill="both", expand=True, padx=10)
+        self.rooms = tk.Listbox(rooms, activestyle="none")
+        scrollbar = tk.Scrollbar(rooms, command=self.rooms.yview)
+        self.rooms.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        self.rooms.pack(side="left", fill="both", expand=True)
+        self.rooms.bind("<Double-Button-1>", lambda event: self.join())
+        self.names = []
+
+        # only shown while the server has more pages
+        more = tk.Frame(self)
+        more.pack()
+        self.more = tk.Button(more, text="More rooms", command=self.more_rooms)
+        tk.Label(self, text="Password (if the room has one)").pack()
+        self.password = tk.Entry(self, show="*")
+        self.password.pack()
+        tk.Button(self, text="Join", command=self.join).pack(pady=5)
         tk.Button(self, text="Back to Options",
                   command=lambda: controller.show_frame("OptionsPage")).pack()
-    
+
+    # catch up on rooms created / changed / deleted since our listing, display_rooms runs when the answer arrives
+    def shown(self):
+        server = self.controller.server
+        if server is not None:
+            self.controller.send_message({"TYPE": "LIST_ROOMS", "SINCE": server.rooms.version})
+        self.display_rooms()
+
+    def more_rooms(self):
+        server = self.controller.server
+        if server is not None:
+            self.controller.send_message({"TYPE": "LIST_ROOMS", "PAGE": server.rooms.pages})
+
     def display_rooms(self):
-        for widget in self.winfo_children():
-            if isinstance(widget, tk.Button) and widget.cget("text") not in ["Back to Options"]:
-                widget.destroy()
+        server = self.controller.server
+        # the network thread updates the listing, take a copy
+        rooms = []
+        if server is not None:
+            with server.state:
+                rooms = list(server.rooms.rooms.values())
+
+        self.rooms.delete(0, "end")
+        self.names = [room.name for room in rooms]
+        for room in rooms:
+            lock = " (password)" if room.has_password else ""
+            self.rooms.insert("end", f"{room.name} - Owner: {room.owner} - Users: {room.members}{lock}")
+
+        if server is not None and server.rooms.has_more():
+            self.more.pack()
+        else:
+            self.more.pack_forget()
+
+    def join(self):
+        selection = self.rooms.curselection()
+        if not selection:
+            return
+        room_name = self.names[selection[0]]
+        self.controller.send_message({"TYPE": "JOIN_ROOM", "ROOM_NAME": room_name, "PASSWORD": self.password.get() or None})
+        self.password.delete(0, "end")
+
+class ChatPage(tk.Frame):
+    def __init__(self, parent, controller: App):
+        super().__init__(parent)
+        self.controller = controller
+        self.room_name = tk.StringVar()
+        tk.Label(self, textvariable=self.room_name, font=("Arial", 14)).pack(pady=5)
+
+        self.log = ChatLog(self)
+        self.log.pack(fill="both", expand=True, padx=5)
+
+        bottom = tk.Frame(self)
+        bottom.pack(fill="x", padx=5, pady=5)
+        self.entry = tk.Entry(bottom)
+        self.entry.pack(side="left", fill="x", expand=True)
+        self.entry.bind("<Return>", lambda event: self.send())
+        tk.Button(bottom, text="Send", command=self.send).pack(side="left")
+        tk.Button(bottom, text="File", command=self.send_file).pack(side="left")
+        tk.Button(bottom, text="Leave", command=lambda: controller.say("!leave")).pack(side="left")
+
+    def entered(self, room_name):
+        self.room_name.set(room_name)
+        self.log.clear()
+        self.entry.focus_set()
+
+    # chat lines and commands (!history, !leave, ...) alike
+    def send(self):
+        text = self.entry.get().strip()
+        if not text:
+            return
+        self.entry.delete(0, "end")
+        self.controller.say(text)
+
+    # streamed to the room in chunks, see attachments.py
+    def send_file(self):
+        path = filedialog.askopenfilename(parent=self)
+        if path:
+            self.controller.say(f"!send {path}")
+
+
+# A capped, virtualized chat log: the lines live in a deque of at most limit lines, the Text widget only ever holds
+# the rows that fit on screen. Redrawing is the same amount of work with 50 or 5000 lines kept, and happens once per batch.
+# Scrolled to the bottom it follows new lines, scrolled up it stays on the lines being read.
+# rows of the chat log in a fixed size ring: adding a row (dropping the oldest once it's full) and getting any row by
+# its index both take constant time, wherever in the log the row is
+class Rows:
+
+    def __init__(self, limit):
+        self.slots = [None] * limit
+        self.start = 0  # slot of the oldest row
+        self.count = 0
+
+    # returns the number of old rows that were dropped to make room
+    def extend(self, rows):
+        dropped = 0
+        for row in rows:
+            self.slots[(self.start + self.count) % len(self.slots)] = row
+            if self.count < len(self.slots):
+                self.count += 1
+            else:
+                self.start = (self.start + 1) % len(self.slots)
+                dropped += 1
+        return dropped
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.slots[(self.start + index) % len(self.slots)]
+
+
+# The log is kept as display rows, not messages: a message with newlines in it (!help, a pasted block) is split into
+# one row per line when it comes in, so row i of the log is always row i on screen. The Text widget doesn't wrap
+# (wrap="none"), a line never takes more than one row.
+class ChatLog(tk.Frame):
+
+    def __init__(self, parent, limit=LOG_LIMIT):
+        super().__init__(parent)
+        self.lines = Rows(limit)
+        self.first = 0      # index of the top visible row
+        self.rows = 1       # rows that fit
+        self.follow = True  # at the bottom, new rows scroll into view
+
+        self.text = tk.Text(self, wrap="none", height=1, state="disabled")
+        self.scrollbar = tk.Scrollbar(self, command=self.scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.text.pack(side="left", fill="both", expand=True)
+        self.line_height = max(1, tkfont.Font(font=self.text.cget("font")).metrics("linespace"))
+
+        self.text.bind("<Configure>", self.resized)
+        self.text.bind("<MouseWheel>", lambda event: self.scroll("scroll", -1 if event.delta > 0 else 1, "units"))
+        # X11 sends the wheel as buttons 4 / 5
+        self.text.bind("<Button-4>", lambda event: self.scroll("scroll", -1, "units"))
+        self.text.bind("<Button-5>", lambda event: self.scroll("scroll", 1, "units"))
+
+    def bottom(self):
+        return max(0, len(self.lines) - self.rows)
+
+    def extend(self, lines):
+        dropped = self.lines.extend(row for line in lines for row in (line.splitlines() or [""]))
+        # rows dropped off the top move the ones being read up
+        self.first = self.bottom() if self.follow else max(0, self.first - dropped)
+        self.render()
+
+    def clear(self):
+        self.lines.clear()
+        self.first = 0
+        self.follow = True
+        self.render()
+
+    def resized(self, event):
+        self.rows = max(1, event.height // self.line_height)
+        self.first = self.bottom() if self.follow else min(self.first, self.bottom())
+        self.render()
+
+    # scrollbar and mouse wheel: ("moveto", fraction) or ("scroll", n, "units" / "pages")
+    def scroll(self, *args):
+        if args[0] == "moveto":
+            first = int(float(args[1]) * len(self.lines))
+        else:
+            first = self.first + int(args[1]) * (self.rows if args[2] == "pages" else 1)
+        self.first = min(max(0, first), self.bottom())
+        self.follow = self.first == self.bottom()
+        self.render()
+        return "break"
+
+    def render(self):
+        last = min(len(self.lines), self.first + self.rows)
+        visible = [self.lines[i] for i in range(self.first, last)]
+
+        self.text.configure(state="normal")
+        self.text.delete("1.0", "end")
+        self.text.insert("1.0", "\n".join(visible))
+        self.text.configure(state="disabled")
+
+        total = len(self.lines)
+        if total:
+            self.scrollbar.set(self.first / total, last / total)
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
-        # logic has not been implemented yet to fetch rooms from server
-        
 
 if __name__ == "__main__":
     App().mainloop()
@@ -0,0 +1,82 @@
+# Room actors (relay_server.py --room-workers N).
+# Everything that touches a room (joining, leaving, chat lines, commands, key exchange, history) is a job in that room's
+# mailbox, and a fixed pool of worker threads runs the mailboxes: a room is only ever run by one worker at a time and its
+# jobs run in the order they were sent, so a room has a single writer without a lock around it, different rooms run on
+# different workers, and the pool stays the same size however many clients are connected.
+#
+# a mailbox is only on the ready queue once, the worker that takes it runs up to BATCH jobs and puts it back at the end
+# of the queue if there are more, so one busy room can't hold a worker while the others wait.
+# Idle mailboxes are dropped, a room that gets a job again gets a new one.
+
+import collections
+import threading
+
+ROOM_WORKERS = 4  # worker threads (0 = room jobs run on the thread that read the message, the old behaviour)
+BATCH = 64        # jobs a worker runs for one room before the next room gets a turn
+
+
+class Mailbox:
+    __slots__ = ("key", "jobs", "scheduled")
+
+    def __init__(self, key):
+        self.key = key
+        self.jobs = collections.deque()  # (fn, args)
+        self.scheduled = False           # on the ready queue or being run by a worker
+
+
+class ActorPool:
+
+    def __init__(self, workers=ROOM_WORKERS, batch=BATCH):
+        self.workers = workers
+        self.batch = batch
+        # only held to post a job or hand a mailbox over, never while a job runs
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.mailboxes = {}               # key -> Mailbox with jobs waiting or running
+        self.queue = collections.deque()  # mailboxes waiting for a worker
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    # runs fn(*args) on key's actor, after every job posted to it before
+    def submit(self, key, fn, *args):
+        with self.lock:
+            box = self.mailboxes.get(key)
+            if box is None:
+                box = self.mailboxes[key] = Mailbox(key)
+            box.jobs.append((fn, args))
+            if not box.scheduled:
+                box.scheduled = True
+                self.queue.append(box)
+                self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.ready.wait()
+                box = self.queue.popleft()
+
+            # nobody else runs this mailbox until it's handed back below, new jobs only get appended
+            for _ in range(self.batch):
+                if not box.jobs:
+                    break
+                fn, args = box.jobs.popleft()
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"Error: {e}")
+
+            with self.lock:
+                if box.jobs:
+                    self.queue.append(box)
+                    self.ready.notify()
+                else:
+                    box.scheduled = False
+                    del self.mailboxes[box.key]
+
+    # jobs waiting over all rooms, and rooms waiting for a worker
+    def backlog(self):
+        with self.lock:
+            return sum(len(box.jobs) for box in self.mailboxes.values()), len(self.queue)
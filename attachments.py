@@ -0,0 +1,258 @@
+# File attachments, streamed through a room in chunks (client: !send PATH).
+#
+#   sender -> relay   ATTACH_START {TRANSFER, FILE_NAME, SIZE}       relay -> members   ATTACH_START (+ FROM)
+#   relay -> sender   ATTACH_ACK {TRANSFER, OFFSET, WINDOW, RESUME}
+#   sender -> relay   ATTACH_CHUNK {TRANSFER, OFFSET, DATA}          relay -> members   ATTACH_CHUNK (+ FROM)
+#   sender -> relay   ATTACH_END {TRANSFER}                          relay -> members   ATTACH_END (+ CANCELLED, MESSAGE)
+#
+# flow control: a sender may have WINDOW bytes past the last OFFSET the relay acknowledged. The relay acknowledges a
+# chunk once every member's writer has taken it off its queue, so a transfer never holds more than WINDOW bytes in the
+# relay (the chunk frame is shared by all members) and goes as fast as its slowest member reads.
+# Chunks go in a second lane of each connection's outbound queue (connection.py), the writer takes chat frames first and
+# at most one chunk per write, so a file going through a room doesn't hold up what people type.
+# resuming: the relay keeps a transfer for TRANSFER_TIMEOUT seconds after its sender went quiet, an ATTACH_START with the
+# same TRANSFER (and name / size) is answered with RESUME = the offset the members already have.
+#
+# attachments are not end-to-end encrypted, the relay sees the file.
+
+import os
+import threading
+import time
+
+from protocol import Frame, send_frame, send_message, send_bulk_frame
+
+CHUNK_SIZE = 16 * 1024        # what the client sends per chunk
+MAX_CHUNK = 64 * 1024         # bigger chunks cancel the transfer
+WINDOW = 256 * 1024           # bytes a sender may have in flight per transfer
+MAX_TRANSFERS = 16            # transfers open in one room at a time
+TRANSFER_TIMEOUT = 120.0      # seconds a transfer nobody sends to is kept for resuming
+
+DOWNLOADS = "downloads"  # where the client saves what it receives
+
+
+# relay side
+
+class Transfer:
+
+    def __init__(self, transfer_id, sender, conn, file_name, size, recipients):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.conn = conn  # sender's connection, replaced when they resume from a new one
+        self.file_name = file_name
+        self.size = size
+        self.recipients = recipients  # ((user, connection), ...) of the members when it started
+
+        self.forwarded = 0  # bytes passed on to the members
+        self.acked = 0      # bytes every member's writer has taken
+        self.touched = time.monotonic()
+        self.lock = threading.Lock()
+
+    def in_flight(self):
+        return self.forwarded - self.acked
+
+    # the members have everything up to end, called from their writers (any thread)
+    def acked_to(self, end):
+        with self.lock:
+            if end <= self.acked:
+                return
+            self.acked = end
+            conn = self.conn
+        send_message(conn, {"TYPE": "ATTACH_ACK", "TRANSFER": self.transfer_id, "OFFSET": end, "WINDOW": WINDOW})
+
+
+# one chunk on its way to the members, the transfer is acknowledged when the last of them took it
+class Chunk:
+    __slots__ = ("transfer", "end", "left", "lock")
+
+    def __init__(self, transfer, end, left):
+        self.transfer = transfer
+        self.end = end
+        self.left = left
+        self.lock = threading.Lock()
+
+    def done(self):
+        with self.lock:
+            self.left -= 1
+            last = self.left == 0
+        if last:
+            self.transfer.acked_to(self.end)
+
+
+def member_frame(room, transfer, mType, **fields):
+    return Frame({"TYPE": mType, "ROOM_NAME": room.room_name, "TRANSFER": transfer.transfer_id, "FROM": transfer.sender, **fields})
+
+# the members that were there when the transfer started and still are
+def receivers(room, transfer):
+    return [conn for user, conn in transfer.recipients if user in room.users]
+
+# ends a transfer, the members get the ATTACH_END after the chunks already queued for them
+def finish(room, transfer, cancelled=False, message=None):
+    room.transfers.pop((transfer.sender, transfer.transfer_id), None)
+    frame = member_frame(room, transfer, "ATTACH_END", CANCELLED=cancelled, MESSAGE=message)
+    for conn in receivers(room, transfer):
+        send_bulk_frame(conn, frame)
+    if cancelled:
+        send_message(transfer.conn, {"TYPE": "ATTACH_END", "ROOM_NAME": room.room_name, "TRANSFER": transfer.transfer_id, "CANCELLED": True, "MESSAGE": message})
+
+# transfers whose sender went quiet for too long are cancelled
+def expire(room, now):
+    for transfer in list(room.transfers.values()):
+        if now - transfer.touched > TRANSFER_TIMEOUT:
+            finish(room, transfer, cancelled=True, message="The sender went away.")
+
+def refuse(conn, room, transfer_id, message):
+    send_message(conn, {"TYPE": "ATTACH_END", "ROOM_NAME": room.room_name, "TRANSFER": transfer_id, "CANCELLED": True, "MESSAGE": message})
+
+
+# the handlers run on the room's actor, like every other room message
+
+def start(room, clients, from_user, conn, msg):
+    if from_user not in room.users:
+        return
+    transfer_id = msg.get("TRANSFER")
+    file_name = msg.get("FILE_NAME")
+    size = msg.get("SIZE")
+    if not isinstance(transfer_id, str) or not isinstance(file_name, str) or not isinstance(size, int) or size < 0:
+        refuse(conn, room, transfer_id if isinstance(transfer_id, str) else None, "Invalid attachment.")
+        return
+
+    now = time.monotonic()
+    transfer = room.transfers.get((from_user, transfer_id))
+    if transfer is not None and transfer.file_name == file_name and transfer.size == size:
+        # resuming, possibly from a new connection: carries on from what the members already have
+        with transfer.lock:
+            transfer.conn = conn
+        transfer.touched = now
+    else:
+        expire(room, now)
+        if len(room.transfers) >= MAX_TRANSFERS:
+            refuse(conn, room, transfer_id, "Too many files are being sent in this room right now, try again later.")
+            return
+
+        recipients = tuple((user, member) for user, member in room.recipients(clients) if user != from_user)
+        transfer = room.transfers[(from_user, transfer_id)] = Transfer(transfer_id, from_user, conn, file_name, size, recipients)
+        frame = member_frame(room, transfer, "ATTACH_START", FILE_NAME=file_name, SIZE=size)
+        for _, member in recipients:
+            send_frame(member, frame)
+
+    send_message(conn, {"TYPE": "ATTACH_ACK", "TRANSFER": transfer_id, "OFFSET": transfer.acked, "WINDOW": WINDOW, "RESUME": transfer.forwarded})
+
+def chunk(room, clients, from_user, conn, msg):
+    transfer = room.transfers.get((from_user, msg.get("TRANSFER")))
+    if transfer is None:
+        return
+
+    data = msg.get("DATA")
+    offset = msg.get("OFFSET")
+    if not isinstance(data, bytes) or offset != transfer.forwarded or len(data) > MAX_CHUNK or offset + len(data) > transfer.size:
+        finish(room, transfer, cancelled=True, message="The file was sent out of order.")
+        return
+    with transfer.lock:
+        over = transfer.in_flight() + len(data) > WINDOW
+    if over:
+        finish(room, transfer, cancelled=True, message="The sender didn't wait for the relay.")
+        return
+
+    transfer.forwarded = end = offset + len(data)
+    transfer.touched = time.monotonic()
+
+    members = receivers(room, transfer)
+    if not members:
+        transfer.acked_to(end)
+        return
+    frame = member_frame(room, transfer, "ATTACH_CHUNK", OFFSET=offset, DATA=data)
+    pending = Chunk(transfer, end, len(members))
+    for member in members:
+        send_bulk_frame(member, frame, pending.done)
+
+def end(room, clients, from_user, conn, msg):
+    transfer = room.transfers.get((from_user, msg.get("TRANSFER")))
+    if transfer is None:
+        return
+    if msg.get("CANCELLED") or transfer.forwarded != transfer.size:
+        finish(room, transfer, cancelled=True, message="The sender cancelled it.")
+    else:
+        finish(room, transfer)
+
+
+# client side
+
+# a file we are sending, chunks go out as the relay's acknowledgements open the window
+class Upload:
+
+    def __init__(self, transfer_id, room_name, path):
+        self.transfer_id = transfer_id
+        self.room_name = room_name
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.file = open(path, "rb")
+
+        self.sent = 0
+        self.acked = 0
+        self.window = 0  # set by the relay's first ATTACH_ACK
+
+    def start_message(self):
+        return {"TYPE": "ATTACH_START", "ROOM_NAME": self.room_name, "TRANSFER": self.transfer_id, "FILE_NAME": self.file_name, "SIZE": self.size}
+
+    # an ATTACH_ACK, returns the chunks the window now has room for
+    def acknowledged(self, msg):
+        self.acked = max(self.acked, msg.get("OFFSET") or 0)
+        self.window = msg.get("WINDOW") or self.window
+        # answer to our ATTACH_START, the members already have everything up to RESUME
+        if msg.get("RESUME") is not None:
+            self.sent = msg["RESUME"]
+            self.file.seek(self.sent)
+
+        chunks = []
+        while self.sent < self.size and self.sent - self.acked < self.window:
+            data = self.file.read(min(CHUNK_SIZE, self.size - self.sent, self.window - (self.sent - self.acked)))
+            if not data:
+                break
+            chunks.append({"TYPE": "ATTACH_CHUNK", "ROOM_NAME": self.room_name, "TRANSFER": self.transfer_id, "OFFSET": self.sent, "DATA": data})
+            self.sent += len(data)
+        return chunks
+
+    def done(self):
+        return self.acked >= self.size
+
+    def close(self):
+        self.file.close()
+
+
+# a file someone in the room is sending us, written where each chunk says it goes
+class Download:
+
+    def __init__(self, sender, file_name, size, directory=DOWNLOADS):
+        os.makedirs(directory, exist_ok=True)
+        # only the last part of the name, the sender doesn't get to pick the directory
+        name = os.path.basename(file_name.replace("\\", "/")).strip() or "attachment"
+        base, ext = os.path.splitext(name)
+        path = os.path.join(directory, name)
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(directory, f"{base} ({n}){ext}")
+            n += 1
+
+        self.sender = sender
+        self.file_name = name
+        self.size = size
+        self.path = path
+        self.file = open(path, "wb")
+        self.received = 0
+
+    def write(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+        self.received = max(self.received, offset + len(data))
+
+    def close(self):
+        self.file.close()
+
+    # a cancelled download, the part we got is thrown away
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,60 @@
+# encode / decode throughput and payload size: pickle vs the compact codec (codec.py)
+# run from the repo root: python -m benchmarks.codec
+
+import argparse
+import pickle
+import time
+
+import codec
+from chat_room import chat_room
+from directory import RoomDirectory
+
+
+def sample_messages(room_count, room_size):
+    directory = RoomDirectory(page_size=room_count)
+    for r in range(room_count):
+        room = chat_room(f"room{r}", "owner", password="secret" if r % 2 else None, directory=directory)
+        for u in range(1, room_size):
+            room.add_user(f"user{u}", password="secret")
+
+    return {
+        "SEND": {"TYPE": "SEND", "ROOM_NAME": "room0", "MESSAGE": "hey, is anyone around?"},
+        "RECEIVE": {"TYPE": "RECEIVE", "FROM": "user12", "MESSAGE": "hey, is anyone around?"},
+        "BROADCAST": {"TYPE": "BROADCAST", "FROM": "", "MESSAGE": "user12 has left the room."},
+        "ROOM_LIST": directory.page(0).obj,
+    }
+
+
+def rate(fn, arg, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            fn(arg)
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pickle vs codec throughput")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent on each measurement")
+    parser.add_argument("--rooms", type=int, default=20, help="rooms in the ROOM_LIST sample")
+    parser.add_argument("--room-size", type=int, default=10, help="users per room in the ROOM_LIST sample")
+    args = parser.parse_args(argv)
+
+    dumps = lambda msg: pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
+
+    print(f"{'message':>10} {'format':>7} {'bytes':>7} {'encode/s':>11} {'decode/s':>11}")
+    for name, msg in sample_messages(args.rooms, args.room_size).items():
+        pickled = dumps(msg)
+        encoded = codec.encode(msg)
+
+        for label, data, encode, decode in (("pickle", pickled, dumps, pickle.loads), ("codec", encoded, codec.encode, codec.decode)):
+            enc = rate(encode, msg, args.seconds)
+            dec = rate(decode, data, args.seconds)
+            print(f"{name:>10} {label:>7} {len(data):>7} {enc:>11,.0f} {dec:>11,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# bandwidth vs CPU of per-connection compression, replaying a generated chat session through each setting
+# the trace is what one member of a busy room receives: chat lines, joins / leaves, rosters, room listings
+# and (with --sealed) end-to-end encrypted lines, which don't compress at all
+# run from the repo root: python -m benchmarks.compression
+
+import argparse
+import os
+import random
+import time
+
+import codec
+import compression
+from protocol import encode_frame, FrameBuffer, decode_payload
+
+WORDS = (
+    "the a to and i you it is that of in for on this was with me my so but have just be not are what like "
+    "do we at can lol get no yeah ok all if up out one how your know think about there time when good now "
+    "here really go going got then see some more would people did too they why back need make still want "
+    "haha today work right anyone game tonight later thanks nice sure yes well hey guys gonna play again "
+    "room server message send link check look new last first next day night week fun cool same thing"
+).split()
+
+
+def chat_line(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 18)))
+
+
+def trace(frames, users, sealed_share, seed=1):
+    rng = random.Random(seed)
+    names = [f"{rng.choice(('sam', 'alex', 'jo', 'kim', 'lee', 'max'))}_{i}" for i in range(users)]
+    present = names[:users // 2]
+    keys = {name: os.urandom(32) for name in names}
+    version = 0
+    out = []
+
+    def roster():
+        return {"TYPE": "ROSTER", "ROOM_NAME": "general", "MEMBERS": [[name, keys[name]] for name in present]}
+
+    while len(out) < frames:
+        roll = rng.random()
+        if roll < 0.03 and len(present) < len(names):
+            name = rng.choice([name for name in names if name not in present])
+            present.append(name)
+            out.append({"TYPE": "BROADCAST", "FROM": "", "MESSAGE": f"Welcome to the chat room {name}!"})
+            out.append(roster())
+        elif roll < 0.05 and len(present) > 2:
+            name = present.pop(rng.randrange(1, len(present)))
+            out.append({"TYPE": "BROADCAST", "FROM": "", "MESSAGE": f"{name} has left the room."})
+            out.append(roster())
+        elif roll < 0.06:
+            version += 1
+            rooms = [[f"room{r}", rng.choice(names), rng.randint(1, 40), bool(r % 3)] for r in range(rng.randint(5, 50))]
+            out.append({"TYPE": "ROOM_LIST", "VERSION": version, "PAGE": 0, "PAGES": 1, "ROOMS": rooms})
+        elif roll < 0.06 + sealed_share:
+            text = chat_line(rng).encode()
+            ciphertext = os.urandom(12 + len(text) + 16)  # nonce + ciphertext + tag, as e2e.py makes them
+            out.append({"TYPE": "SEALED", "ROOM_NAME": "general", "FROM": rng.choice(present), "KEY_ID": 1, "CIPHERTEXT": ciphertext})
+        else:
+            out.append({"TYPE": "RECEIVE", "FROM": rng.choice(present), "MESSAGE": chat_line(rng)})
+
+    return out[:frames]
+
+
+# sends every frame through a Deflater (or not) and reads it back through a FrameBuffer, like the two ends would
+def replay(frames, method, threshold, level):
+    deflater = compression.Deflater(method, threshold, level) if method else None
+    start = time.perf_counter()
+    sent = [deflater.compress(parts) if deflater else parts for parts in frames]
+    compress_time = time.perf_counter() - start
+
+    wire = b"".join(part for parts in sent for part in parts)
+    reader = FrameBuffer(len(wire) + 4)
+    reader.buf[:len(wire)] = wire
+    reader.filled(len(wire))
+
+    start = time.perf_counter()
+    count = sum(1 for _ in reader.payloads())
+    read_time = time.perf_counter() - start
+    assert count == len(frames)
+
+    return len(wire), compress_time, read_time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="per-connection compression, replaying a chat session")
+    parser.add_argument("--frames", type=int, default=20000, help="frames in the replayed session")
+    parser.add_argument("--users", type=int, default=30, help="people coming and going in the room")
+    parser.add_argument("--sealed", type=float, default=0.0, help="share of end-to-end encrypted chat lines (0-1)")
+    parser.add_argument("--thresholds", default="0,64,128,256", help="compression thresholds to try (bytes)")
+    parser.add_argument("--level", type=int, default=compression.LEVEL)
+    args = parser.parse_args(argv)
+
+    messages = trace(args.frames, args.users, args.sealed)
+    thresholds = [int(t) for t in args.thresholds.split(",")]
+
+    print(f"{'method':>12} {'threshold':>9} {'wire bytes':>11} {'ratio':>6} {'compress us':>12} {'read us':>8}")
+    frames = [encode_frame(msg, codec.VERSION) for msg in messages]
+
+    # the raw run also checks the trace decodes
+    for payload in (frames[0][1], frames[-1][1]):
+        decode_payload(payload)
+
+    raw_bytes, _, read_time = replay(frames, None, 0, args.level)
+    print(f"{'none':>12} {'-':>9} {raw_bytes:>11,} {1.0:>6.2f} {0.0:>12.2f} {read_time / len(frames) * 1e6:>8.2f}")
+
+    for method in (compression.ZLIB, compression.ZLIB_DICT):
+        for threshold in thresholds:
+            wire_bytes, compress_time, read_time = replay(frames, method, threshold, args.level)
+            print(f"{method:>12} {threshold:>9} {wire_bytes:>11,} {raw_bytes / wire_bytes:>6.2f} "
+                  f"{compress_time / len(frames) * 1e6:>12.2f} {read_time / len(frames) * 1e6:>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# end-to-end encryption cost: seal / open throughput per message size, and what a sender key rotation costs by room size
+# needs the cryptography package
+# run from the repo root: python -m benchmarks.e2e
+
+import argparse
+import time
+
+import e2e
+
+
+def rate(fn, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(50):
+            fn()
+        count += 50
+    return count / (time.perf_counter() - start)
+
+
+# a sender and a reader that share a room, with the reader holding the sender's key
+def make_pair():
+    alice = e2e.E2ESession("alice")
+    bob = e2e.E2ESession("bob")
+    roster = {"TYPE": "ROSTER", "ROOM_NAME": "bench", "MEMBERS": [["alice", alice.public_key], ["bob", bob.public_key]]}
+
+    bob.handle_roster(roster)
+    keys = alice.handle_roster(roster)
+    bob.handle_sender_key({**keys, "FROM": "alice"})
+    return alice, bob
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="end-to-end encryption throughput")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent on each measurement")
+    parser.add_argument("--sizes", default="16,256,1024,16384,262144", help="message sizes in bytes")
+    parser.add_argument("--room-sizes", default="10,100,1000", help="members when timing a key rotation")
+    args = parser.parse_args(argv)
+
+    if not e2e.AVAILABLE:
+        print("the cryptography package is not installed")
+        return
+
+    alice, bob = make_pair()
+
+    print(f"{'bytes':>8} {'seal/s':>10} {'open/s':>10} {'seal MB/s':>10} {'open MB/s':>10}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        text = "x" * size
+        sealed = {**alice.seal("bench", text), "FROM": "alice"}
+        seal = rate(lambda: alice.seal("bench", text), args.seconds)
+        opened = rate(lambda: bob.open(sealed), args.seconds)
+        print(f"{size:>8} {seal:>10,.0f} {opened:>10,.0f} {seal * size / 1e6:>10.1f} {opened * size / 1e6:>10.1f}")
+
+    # a rotation wraps the new sender key once per other member (the pairwise keys are cached after the first time)
+    print()
+    print(f"{'members':>8} {'first rotation (ms)':>20} {'rotation (ms)':>14}")
+    for size in (int(s) for s in args.room_sizes.split(",")):
+        me = e2e.E2ESession("user0")
+        members = [["user0", me.public_key]] + [[f"user{i}", e2e.E2ESession().public_key] for i in range(1, size)]
+        roster = {"TYPE": "ROSTER", "ROOM_NAME": "bench", "MEMBERS": members}
+
+        start = time.perf_counter()
+        me.handle_roster(roster)
+        first = (time.perf_counter() - start) * 1000
+
+        # someone leaving makes everyone rotate
+        start = time.perf_counter()
+        me.handle_roster({**roster, "MEMBERS": members[:-1]})
+        again = (time.perf_counter() - start) * 1000
+        print(f"{size:>8} {first:>20.1f} {again:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# CPU cost of one room message as a function of room size
+# compares pickling once per recipient (the old fan-out) with encoding the frame once and sharing it
+# run from the repo root: python -m benchmarks.fanout
+
+import argparse
+import time
+
+from chat_room import chat_room
+from client_info import Client
+from protocol import send_message
+
+
+# stands in for a socket / Connection so only the relay's own CPU work is measured
+class NullSocket:
+
+    def send_parts(self, parts):
+        pass
+
+
+def make_room(size):
+    clients = {}
+    room = chat_room("bench", "user0")
+    clients["user0"] = Client(NullSocket(), "user0", None)
+
+    for i in range(1, size):
+        name = f"user{i}"
+        room.add_user(name)
+        clients[name] = Client(NullSocket(), name, None)
+
+    return room, clients
+
+
+# what chat_room.send_message did before frames were shared: a fresh dict and pickle per recipient
+def fanout_per_recipient(room, clients, message):
+    for user in room.users:
+        if user != "user0":
+            send_message(clients[user].get_socket(), {"TYPE": "RECEIVE", "FROM": "user0", "MESSAGE": message})
+
+
+def fanout_encode_once(room, clients, message):
+    room.send_message("RECEIVE", message, clients, from_user="user0")
+
+
+def measure(fanout, room, clients, message, messages):
+    start = time.process_time()
+    for _ in range(messages):
+        fanout(room, clients, message)
+    return (time.process_time() - start) / messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="per-message fan-out CPU cost by room size")
+    parser.add_argument("--sizes", default="1,10,50,100,500,1000")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--payload", type=int, default=64, help="message length in characters")
+    args = parser.parse_args(argv)
+
+    message = "x" * args.payload
+
+    print(f"{'room size':>10} {'per recipient (us)':>20} {'encode once (us)':>18} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        room, clients = make_room(size)
+        old = measure(fanout_per_recipient, room, clients, message, args.messages)
+        new = measure(fanout_encode_once, room, clients, message, args.messages)
+        print(f"{size:>10} {old * 1e6:>20.1f} {new * 1e6:>18.1f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
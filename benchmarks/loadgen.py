@@ -0,0 +1,217 @@
+# headless load generator: starts the relay on localhost and drives synthetic clients through the real handshake
+# (NAME -> CREATE_ROOM / JOIN_ROOM -> SEND) at a fixed message rate, then reports throughput, delivery latency,
+# relay memory per connection and CPU, and writes everything to a JSON file so runs can be compared
+# every message carries the time it was sent (CLOCK_MONOTONIC is shared by all processes), receivers take the difference
+# run from the repo root: python -m benchmarks.loadgen --clients 2000 --room-size 10 --rate 1 --duration 10
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import selectors
+import subprocess
+import sys
+import time
+
+import codec
+from benchmarks.scaling import wait_for_port, join
+from protocol import encode_frame, send_buffers
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+# the relay and its worker processes, from /proc (linux only, empty elsewhere)
+def process_tree(pid):
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids += process_tree(int(child))
+    except OSError:
+        pass
+    return pids
+
+
+# (resident bytes, CPU seconds) summed over the relay's processes, None if /proc isn't there
+def relay_usage(pid):
+    rss = 0
+    cpu = 0.0
+    try:
+        for p in process_tree(pid):
+            with open(f"/proc/{p}/statm") as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None, None
+    return rss, cpu
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# one load process: its share of the clients send at the configured rate, every RECEIVE is timed on arrival
+def load(port, index, args, joined, start, results):
+    # more sockets than the default limit, as many as the hard limit allows
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    rng = random.Random(index)
+    mine = range(index, args.clients, args.processes)
+    conns = []
+    for i in mine:
+        sock, reader = join(port, f"load{i}", f"room{i // args.room_size}")
+        conns.append((sock, reader, f"room{i // args.room_size}"))
+    joined.wait()
+    start.wait()
+
+    selector = selectors.DefaultSelector()
+    for sock, reader, _ in conns:
+        selector.register(sock, selectors.EVENT_READ, reader)
+
+    interval = 1.0 / args.rate
+    padding = "x" * max(0, args.payload - 20)
+    began = time.monotonic()
+    send_until = began + args.duration
+    # first sends spread over one interval so the clients don't all fire together
+    due = [began + rng.random() * interval for _ in conns]
+
+    sent = 0
+    latencies = []
+    cpu_start = time.process_time()
+    deadline = send_until + args.drain
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+
+        if now < send_until:
+            for n, (sock, _, room_name) in enumerate(conns):
+                if due[n] <= now:
+                    msg = {"TYPE": "SEND", "ROOM_NAME": room_name, "MESSAGE": f"{time.monotonic_ns()} {padding}"}
+                    send_buffers(sock, encode_frame(msg, codec.VERSION))
+                    sent += 1
+                    due[n] += interval
+            timeout = max(0.0, min(min(due), send_until) - time.monotonic())
+        else:
+            timeout = deadline - now
+
+        for key, _ in selector.select(timeout):
+            reader = key.data
+            if not reader.fill():
+                selector.unregister(key.fileobj)
+                continue
+            for payload in reader.buffer.payloads():
+                msg = codec.decode(payload)
+                if msg["TYPE"] == "RECEIVE":
+                    latencies.append((time.monotonic_ns() - int(msg["MESSAGE"].split(" ", 1)[0])) / 1e6)
+
+    results.put((sent, latencies, time.process_time() - cpu_start))
+    for sock, _, _ in conns:
+        sock.close()
+
+
+def run(args):
+    relay = subprocess.Popen(
+        [sys.executable, "relay_server.py", "--port", str(args.port), "--host", "127.0.0.1", "--mode", args.mode,
+         "--workers", str(args.workers), "--queue-limit", str(args.queue_limit), "--scrollback", "0",
+         "--room-workers", str(args.room_workers)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.port)
+        time.sleep(0.2)
+        idle_rss, _ = relay_usage(relay.pid)
+
+        context = multiprocessing.get_context("fork")
+        joined = context.Barrier(args.processes + 1)
+        start = context.Barrier(args.processes + 1)
+        results = context.Queue()
+        loaders = [context.Process(target=load, args=(args.port, i, args, joined, start, results)) for i in range(args.processes)]
+        for loader in loaders:
+            loader.start()
+
+        handshake_started = time.monotonic()
+        joined.wait()
+        handshake_time = time.monotonic() - handshake_started
+        connected_rss, cpu_before = relay_usage(relay.pid)
+
+        start.wait()
+        outcome = [results.get() for _ in loaders]
+        _, cpu_after = relay_usage(relay.pid)
+        for loader in loaders:
+            loader.join()
+    finally:
+        relay.terminate()
+        relay.wait()
+
+    sent = sum(s for s, _, _ in outcome)
+    latencies = sorted(latency for _, samples, _ in outcome for latency in samples)
+    delivered = len(latencies)
+
+    return {
+        "config": vars(args),
+        "results": {
+            "sent": sent,
+            "delivered": delivered,
+            # every message goes to the other members of its room (a smaller last room makes this a bit low)
+            "delivered_share": delivered / (sent * (args.room_size - 1)) if sent and args.room_size > 1 else None,
+            "handshake_seconds": handshake_time,
+            "sent_per_second": sent / args.duration,
+            "delivered_per_second": delivered / args.duration,
+            "latency_ms": {
+                "p50": percentile(latencies, 0.5),
+                "p99": percentile(latencies, 0.99),
+                "p999": percentile(latencies, 0.999),
+                "max": latencies[-1] if latencies else None,
+            },
+            "relay_rss_bytes": connected_rss,
+            "relay_bytes_per_connection": (connected_rss - idle_rss) / args.clients if connected_rss and idle_rss else None,
+            "relay_cpu_seconds": cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None,
+            "relay_cpu_share": (cpu_after - cpu_before) / (args.duration + args.drain) if cpu_before is not None and cpu_after is not None else None,
+            "loadgen_cpu_seconds": sum(cpu for _, _, cpu in outcome),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="drive the relay with synthetic clients")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=10, help="clients per room")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second sent by every client")
+    parser.add_argument("--payload", type=int, default=64, help="approximate message size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to keep reading after the last send")
+    parser.add_argument("--processes", type=int, default=4, help="load generator processes")
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--queue-limit", type=int, default=100000)
+    parser.add_argument("--room-workers", type=int, default=4, help="relay threads running room actors (0 = on the reading thread)")
+    parser.add_argument("--port", type=int, default=5700)
+    parser.add_argument("--output", default="loadgen_results.json", help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    results = report["results"]
+    latency = results["latency_ms"]
+    print(f"{'sent':>10} {'delivered':>10} {'msgs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'KB/conn':>8} {'relay cpu':>9}")
+    per_connection = results["relay_bytes_per_connection"]
+    cpu_share = results["relay_cpu_share"]
+    print(f"{results['sent']:>10,} {results['delivered']:>10,} {results['delivered_per_second']:>10,.0f} "
+          f"{latency['p50'] or 0:>8.2f} {latency['p99'] or 0:>8.2f} {latency['p999'] or 0:>8.2f} "
+          f"{per_connection / 1024 if per_connection else 0:>8.1f} {cpu_share * 100 if cpu_share is not None else 0:>8.0f}%")
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# membership operations on very large rooms: the old list based chat_room vs the Members / set indexes
+# run from the repo root: python -m benchmarks.membership
+
+import argparse
+import random
+import time
+
+from chat_room import chat_room
+
+
+# just the parts of the old chat_room this benchmark touches (users / admins / ban_list were plain lists)
+class ListRoom:
+
+    def __init__(self, owner):
+        self.users = [owner]
+        self.admins = [owner]
+        self.ban_list = []
+
+    def add_user(self, name):
+        self.users.append(name)
+
+    def remove_user(self, name):
+        self.users.remove(name)
+
+    def in_room(self, name):
+        return name in self.users
+
+    def get_owner(self):
+        return self.users[0]
+
+
+def fill(room, size):
+    for i in range(1, size):
+        room.add_user(f"user{i}")
+    banned = [f"banned{i}" for i in range(0, size, 10)]
+    room.ban_list = banned if isinstance(room, ListRoom) else set(banned)
+
+
+# average microseconds per call of op over the given names
+def per_op(op, names):
+    start = time.perf_counter()
+    for name in names:
+        op(name)
+    return (time.perf_counter() - start) / len(names) * 1e6
+
+
+def run(room, size, samples):
+    members = [f"user{random.randrange(1, size)}" for _ in range(samples)]
+    strangers = [f"stranger{i}" for i in range(samples)]
+    leaving = random.sample(range(1, size), samples)
+
+    return {
+        "in_room": per_op(room.in_room, members),
+        "ban check": per_op(lambda name: name in room.ban_list, strangers),
+        "get_owner": per_op(lambda name: room.get_owner(), members),
+        "remove_user": per_op(room.remove_user, [f"user{i}" for i in leaving]),
+        "add_user": per_op(room.add_user, [f"user{i}" for i in leaving]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="membership cost by room size")
+    parser.add_argument("--sizes", default="10000,50000,100000")
+    parser.add_argument("--samples", type=int, default=200, help="operations timed per measurement")
+    args = parser.parse_args(argv)
+
+    print(f"{'members':>8} {'operation':>12} {'lists (us)':>12} {'indexes (us)':>13}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        old = ListRoom("user0")
+        new = chat_room("bench", "user0")
+        fill(old, size)
+        fill(new, size)
+
+        random.seed(size)
+        old_times = run(old, size, args.samples)
+        random.seed(size)
+        new_times = run(new, size, args.samples)
+
+        for op in old_times:
+            print(f"{size:>8} {op:>12} {old_times[op]:>12.2f} {new_times[op]:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# frames the relay sends while a crowd joins one room at once, with a notice and a ROSTER per join (--presence-window 0)
+# and with both coalesced over a window (see presence.py)
+# every client registers and joins in one go, then the frames reaching all of them are counted by type until the relay
+# goes quiet
+# run from the repo root: python -m benchmarks.presence
+
+import argparse
+import collections
+import selectors
+import socket
+import subprocess
+import sys
+
+import codec
+from benchmarks.scaling import wait_for_port, join
+from protocol import encode_frame, send_buffers, FrameReader
+
+
+def mass_join(port, clients, room_name, quiet):
+    owner, owner_reader = join(port, "owner", room_name)
+    socks = [socket.create_connection(("127.0.0.1", port)) for _ in range(clients)]
+
+    for i, sock in enumerate(socks):
+        frames = (encode_frame({"TYPE": "NAME", "NAME": f"user{i}", "CODECS": [codec.VERSION]}, codec.VERSION),
+                  encode_frame({"TYPE": "JOIN_ROOM", "ROOM_NAME": room_name}, codec.VERSION))
+        send_buffers(sock, [part for parts in frames for part in parts])
+
+    selector = selectors.DefaultSelector()
+    for sock, reader in [(owner, owner_reader)] + [(sock, FrameReader(sock)) for sock in socks]:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, reader)
+
+    counts = collections.Counter()
+    while True:
+        events = selector.select(quiet)
+        if not events:
+            break
+        for key, _ in events:
+            reader = key.data
+            try:
+                if not reader.fill():
+                    selector.unregister(key.fileobj)
+                    continue
+            except BlockingIOError:
+                continue
+            for payload in reader.buffer.payloads():
+                counts[codec.decode(payload)["TYPE"]] += 1
+
+    for sock in [owner] + socks:
+        sock.close()
+    return counts
+
+
+def run(port, mode, window, clients, quiet):
+    relay = subprocess.Popen([sys.executable, "relay_server.py", "--host", "127.0.0.1", "--port", str(port), "--mode", mode,
+                              "--presence-window", str(window), "--session-grace", "0"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        return mass_join(port, clients, "crowd", quiet)
+    finally:
+        relay.terminate()
+        relay.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="join / leave notice frames during a mass join")
+    parser.add_argument("--clients", type=int, default=300, help="clients joining at once")
+    parser.add_argument("--windows", default="0,0.25", help="presence windows to compare (seconds)")
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--quiet", type=float, default=2.0, help="seconds without a frame before counting stops")
+    args = parser.parse_args(argv)
+
+    print(f"{'window':>7} {'notices':>9} {'rosters':>9} {'all frames':>11}")
+    for number, window in enumerate(float(w) for w in args.windows.split(",")):
+        counts = run(args.port + number, args.mode, window, args.clients, args.quiet)
+        print(f"{window:>7} {counts['BROADCAST']:>9} {counts['ROSTER']:>9} {sum(counts.values()):>11}")
+
+
+if __name__ == "__main__":
+    main()
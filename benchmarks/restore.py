@@ -0,0 +1,86 @@
+# warm restart: how long the relay takes to bring its rooms back from a snapshot (relay_server.py --snapshot-dir)
+# writes a checkpoint of N rooms plus a journal of later changes, then times reading them back (snapshot.load)
+# and rebuilding the chat_room objects and the room directory the way relay_server.restore_rooms does
+# run from the repo root: python -m benchmarks.restore
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import snapshot
+from chat_room import restore_room
+from directory import RoomDirectory
+
+
+# snapshot records of rooms with a few admins and bans, every fourth one with a password
+# (random bytes stand in for the scrypt hashes, hashing 100k passwords would take minutes)
+def records(rooms, seed=1):
+    rng = random.Random(seed)
+    out = {}
+    for i in range(rooms):
+        room_name = f"room{i}"
+        admins = tuple(f"user{rng.randrange(rooms * 10)}" for _ in range(rng.randint(1, 3)))
+        bans = tuple(f"user{rng.randrange(rooms * 10)}" for _ in range(rng.choice((0, 0, 1, 5))))
+        if i % 4 == 0:
+            out[room_name] = (room_name, admins, bans, os.urandom(16), os.urandom(64))
+        else:
+            out[room_name] = (room_name, admins, bans, None, None)
+    return out
+
+
+def run(rooms, journal, directory):
+    state = records(rooms)
+
+    start = time.perf_counter()
+    snapshot.reshard(directory, state, 1)
+    checkpoint_time = time.perf_counter() - start
+
+    # changes after the checkpoint: new rooms, deleted rooms and admin changes, written like the store's thread does
+    store = snapshot.SnapshotStore(directory, snapshot.store_name(0), checkpoint_every=journal + 1, rooms=state)
+    rng = random.Random(2)
+    for i in range(journal):
+        room_name = f"room{rng.randrange(rooms * 2)}"
+        if rng.random() < 0.2:
+            store.removed(room_name)
+        else:
+            store.pending[room_name] = (room_name, (f"user{i}",), (), None, None)
+    store.stop()
+
+    start = time.perf_counter()
+    with snapshot.bulk_load():
+        loaded = snapshot.load(directory)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    room_directory = RoomDirectory()
+    user_rooms = {}
+    with snapshot.bulk_load():
+        chat_rooms = {room_name: restore_room(record, directory=room_directory, user_rooms=user_rooms) for room_name, record in loaded.items()}
+    rebuild_time = time.perf_counter() - start
+
+    assert len(chat_rooms) == len(room_directory.rooms)
+    return len(chat_rooms), checkpoint_time, load_time, rebuild_time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="restore time of room snapshots")
+    parser.add_argument("--rooms", default="1000,10000,100000", help="room counts to try")
+    parser.add_argument("--journal", type=int, default=5000, help="changes written to the journal after the checkpoint")
+    args = parser.parse_args(argv)
+
+    print(f"{'rooms':>8} {'restored':>9} {'checkpoint s':>13} {'load s':>8} {'rebuild s':>10} {'total s':>8} {'rooms/s':>10}")
+    for rooms in (int(n) for n in args.rooms.split(",")):
+        directory = tempfile.mkdtemp(prefix="snapshot-")
+        try:
+            restored, checkpoint_time, load_time, rebuild_time = run(rooms, args.journal, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        total = load_time + rebuild_time
+        print(f"{rooms:>8,} {restored:>9,} {checkpoint_time:>13.3f} {load_time:>8.3f} {rebuild_time:>10.3f} {total:>8.3f} {restored / total:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
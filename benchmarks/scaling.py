@@ -0,0 +1,139 @@
+# relay throughput (messages delivered per second) with 1..N worker processes (relay_server.py --workers)
+# starts a relay for every worker count and drives it from several load processes, each running a share of the clients
+# the load processes need CPU too, so give the machine more cores than workers to see the relay scale
+# run from the repo root: python -m benchmarks.scaling
+
+import argparse
+import multiprocessing
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+import codec
+from protocol import send_message, encode_frame, send_buffers, FrameReader
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError("relay did not start")
+
+
+# connects, registers and joins (or creates) a room, returns the socket and its reader
+def join(port, name, room_name):
+    sock = socket.create_connection(("127.0.0.1", port))
+    reader = FrameReader(sock)
+    send_message(sock, {"TYPE": "NAME", "NAME": name, "CODECS": [codec.VERSION]}, codec.VERSION)
+
+    request = "JOIN_ROOM"
+    while True:
+        send_message(sock, {"TYPE": request, "ROOM_NAME": room_name}, codec.VERSION)
+        while True:
+            msg = reader.recv_message()
+            if msg["TYPE"] in ("CONNECTED", "REJOIN"):
+                break
+        if msg["TYPE"] == "CONNECTED":
+            return sock, reader
+        # the room doesn't exist yet (or someone else just made it), try the other request
+        request = "CREATE_ROOM" if request == "JOIN_ROOM" else "JOIN_ROOM"
+
+
+# one load process: its clients send their messages, then it counts RECEIVE frames until all expected ones are in
+def load(port, index, processes, clients, rooms, messages, ready, start, results):
+    conns = []
+    for i in range(index, clients, processes):
+        conns.append(join(port, f"load{i}", f"room{i % rooms}"))
+
+    # room sizes decide how many deliveries to expect
+    members = [len(range(r, clients, rooms)) for r in range(rooms)]
+    expected = sum(messages * (members[i % rooms] - 1) for i in range(index, clients, processes))
+
+    ready.wait()
+    start.wait()
+
+    began = time.perf_counter()
+    selector = selectors.DefaultSelector()
+    for number, (sock, reader) in enumerate(conns):
+        room_frame = encode_frame({"TYPE": "SEND", "ROOM_NAME": f"room{(index + number * processes) % rooms}", "MESSAGE": "x" * 40}, codec.VERSION)
+        send_buffers(sock, [part for _ in range(messages) for part in room_frame])
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, reader)
+
+    received = 0
+    deadline = time.monotonic() + 60
+    while received < expected and time.monotonic() < deadline:
+        for key, _ in selector.select(1):
+            reader = key.data
+            try:
+                if not reader.fill():
+                    selector.unregister(key.fileobj)
+                    continue
+            except BlockingIOError:
+                continue
+            received += sum(1 for payload in reader.buffer.payloads() if codec.decode(payload)["TYPE"] == "RECEIVE")
+
+    results.put((received, expected, time.perf_counter() - began))
+    for sock, _ in conns:
+        sock.close()
+
+
+def run(workers, port, args):
+    relay = subprocess.Popen(
+        [sys.executable, "relay_server.py", "--port", str(port), "--host", "127.0.0.1", "--mode", args.mode,
+         "--workers", str(workers), "--overflow", "block", "--queue-limit", "100000"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        context = multiprocessing.get_context("fork")
+        ready = context.Barrier(args.processes + 1)
+        start = context.Barrier(args.processes + 1)
+        results = context.Queue()
+        loaders = [
+            context.Process(target=load, args=(port, i, args.processes, args.clients, args.rooms, args.messages, ready, start, results))
+            for i in range(args.processes)
+        ]
+        for loader in loaders:
+            loader.start()
+
+        ready.wait()
+        start.wait()
+        outcome = [results.get() for _ in loaders]
+        for loader in loaders:
+            loader.join()
+
+        received = sum(r for r, _, _ in outcome)
+        expected = sum(e for _, e, _ in outcome)
+        elapsed = max(t for _, _, t in outcome)
+        return received, expected, elapsed
+    finally:
+        relay.terminate()
+        relay.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="relay throughput by worker count")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="highest worker count to try")
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50, help="messages sent by every client")
+    parser.add_argument("--processes", type=int, default=4, help="load generator processes")
+    parser.add_argument("--port", type=int, default=5600)
+    args = parser.parse_args(argv)
+
+    print(f"{'workers':>7} {'delivered':>10} {'expected':>10} {'seconds':>8} {'msgs/s':>10}")
+    for workers in range(1, args.workers + 1):
+        received, expected, elapsed = run(workers, args.port + workers, args)
+        print(f"{workers:>7} {received:>10,} {expected:>10,} {elapsed:>8.2f} {received / elapsed:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,189 +1,337 @@
 # Relay server uses this class to send messages to everyone in chat room, 
 
-from protocol import send_message
+import collections
+import hashlib
+import hmac
+import itertools
+import os
+
+from history import RoomHistory, SCROLLBACK, PAGE_LIMIT
+from presence import JOINED, notice
+from protocol import send_message, send_frame, Frame
+
+# room passwords are only kept as salted scrypt hashes (~40 ms per check, joins are rare enough for that)
+SCRYPT_PARAMS = {"n": 2 ** 14, "r": 8, "p": 1}
+SALT_SIZE = 16
+
+# membership versions, next() on a count is atomic so two threads changing rooms never get the same one
+MEMBERS_VERSIONS = itertools.count(1)
+
+
+def hash_password(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, **SCRYPT_PARAMS)
+
+
+# Ordered set of user names: constant time add / remove / lookup, and it remembers join order
+# so the oldest member is always first (owner and admin succession rely on that)
+class Members:
+
+    def __init__(self, names=()):
+        self.order = collections.OrderedDict.fromkeys(names)
+
+    # adding someone who is already in keeps their original place
+    def add(self, name):
+        self.order[name] = None
+
+    def remove(self, name):
+        del self.order[name]
+
+    def discard(self, name):
+        self.order.pop(name, None)
+
+    # oldest member, None when empty
+    def first(self):
+        return next(iter(self.order), None)
+
+    def __contains__(self, name):
+        return name in self.order
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __repr__(self):
+        return f"Members({list(self.order)})"
+
 
 class chat_room:
 
     # new instance of chat_room object, creates a users list and automatically adds the user that created the obj to list
-    def __init__(self, room_name, name, password=None):
+    # user_rooms is the relay's user name -> room name index, kept up to date as people join and leave
+    # history is the room's RoomHistory (in memory only if none is given), scrollback is how much of it a new member gets
+    # store is the relay's SnapshotStore, told whenever something that should survive a restart changes
+    # name is None for a room restored from a snapshot (see restore_room), it starts out empty
+    # presence is the relay's PresenceBatcher, join / leave notices are announced right away without one
+    def __init__(self, room_name, name, password=None, directory=None, user_rooms=None, history=None, scrollback=SCROLLBACK, store=None, presence=None):
         self.room_name = room_name
-        self.admins = [name]
-        self.users = [name]
+        founders = [name] if name is not None else []
+        self.admins = Members(founders)
+        self.users = Members(founders)
         self.has_password = False
-        self.ban_list = []
+        self.ban_list = set()
 
         if password:
             self.has_password = True
-            self.password = password
+            self.password_salt = os.urandom(SALT_SIZE)
+            self.password_hash = hash_password(password, self.password_salt)
         
         # The first person in list will be the owner of the room
 
+        # the relay's RoomDirectory, told about every membership change so room listings stay current
+        self.directory = directory
+        self.user_rooms = user_rooms
+
+        self.history = history if history is not None else RoomHistory()
+        self.scrollback = scrollback
+        # HISTORY frame for new members, reused until the next message (seq it was made at, frame)
+        self.scrollback_frame = (None, None)
+
+        self.store = store
+        # ratelimit.Buckets of the room, made by the relay's limiter when --room-rate / --room-bytes are set
+        self.rate_limits = None
+        # join / leave notices waiting for the presence window, user -> kind (see presence.py)
+        self.presence = presence
+        self.presence_pending = {}
+        self.presence_scheduled = False
+        self.roster_pending = False  # someone joined since the last ROSTER
+
+        # files being streamed through the room, (sender, transfer id) -> attachments.Transfer
+        self.transfers = {}
+
+        # copy-on-write recipient list, see recipients(): (members version it was built for, ((user, connection), ...))
+        self.members_version = next(MEMBERS_VERSIONS)
+        self.snapshot = (None, ())
+        if name is not None:
+            self.members_changed(name, joined=True)
+            self.save()
+
+    # the room's admins, bans or password changed
+    def save(self):
+        if self.store is not None:
+            self.store.changed(self)
+
     def get_chat_room_name(self):
         return self.room_name
     
     def add_user(self, name, socket=None, password=""):
 
         if self.has_password:
-            if password == self.password:
-                self.users.append(name)
+            if self.check_password(password):
+                self.users.add(name)
             
             else:
                 # only runs when a user is trying to join a password protected room with the wrong password, socket is provided when joining a password protected room
-                send_message(socket, {"TYPE": "REJOIN", "MESSAGE": "The password entered was incorrect!"})
+                send_message(socket, self.rejoin_message("The password entered was incorrect!"))
+                return
         else:
-            self.users.append(name)
+            self.users.add(name)
+
+        self.members_changed(name, joined=True)
     
-    # removes a user
+    # removes a user, if they were the last admin the longest standing member takes over
     def remove_user(self, user):
         self.users.remove(user)
 
+        if user in self.admins:
+            self.admins.remove(user)
+            if not self.admins and self.users:
+                self.admins.add(self.users.first())
+            if self.users:
+                self.save()
+
+        self.members_changed(user, joined=False)
+
+    # constant time comparison of the hashes, so timing doesn't give away how much of a guess was right
+    def check_password(self, password):
+        return hmac.compare_digest(hash_password(password or "", self.password_salt), self.password_hash)
+
+    def members_changed(self, user, joined):
+        # the recipient snapshot is out of date, the next delivery builds a new one
+        self.members_version = next(MEMBERS_VERSIONS)
+
+        if self.user_rooms is not None:
+            if joined:
+                self.user_rooms[user] = self.room_name
+            elif self.user_rooms.get(user) == self.room_name:
+                del self.user_rooms[user]
+
+        if self.directory is not None:
+            # an empty room is about to be deleted, its summary goes away with it
+            if self.users:
+                self.directory.update(self)
+            else:
+                self.directory.remove(self.room_name)
+
+        # the room is deleted once it's empty, its history and snapshot go with it
+        if not self.users:
+            self.history.delete()
+            if self.store is not None:
+                self.store.removed(self.room_name)
+
+    # a member's connection was swapped (a session dropped or resumed, see sessions.py), the next delivery rebuilds the snapshot
+    def connection_changed(self):
+        self.members_version = next(MEMBERS_VERSIONS)
+
+    # the members and their connections as one immutable tuple, built on the first delivery after the members changed and
+    # swapped in whole. Delivery takes whichever tuple is current: no lock, no clients lookup per recipient, and never a
+    # member list halfway through a change (a change made while it's built just means the next delivery builds it again)
+    # clients is read with one get() per member, other threads add to it while this runs (members only leave it on the
+    # room's actor, see leave_room in relay_server.py)
+    def recipients(self, clients):
+        version, recipients = self.snapshot
+        if version != self.members_version:
+            version = self.members_version
+            present = ((user, clients.get(user)) for user in list(self.users))
+            recipients = tuple((user, client.get_socket()) for user, client in present if client is not None)
+            self.snapshot = (version, recipients)
+        return recipients
+
     # lists user
     def list_users(self):
-        return self.users
+        return list(self.users)
     
     def get_owner(self):
-        return self.users[0]
+        return self.users.first()
 
     # broadcast msg to server, printing that a new user had joined the room, (displays for user that joined too)
-    # passes to the send_message function below for slight optimization
     def broadcast(self, clients, name):
-        self.send_message("BROADCAST", f"Welcome to the chat room {name}!", clients)
+        self.announce(clients, JOINED, name)
+
+    # someone joined, left, was removed or banned (presence.py kinds), the notice may go out together with others
+    def announce(self, clients, kind, name):
+        if self.presence is not None:
+            self.presence.add(self, clients, kind, name)
+        else:
+            self.send_message("BROADCAST", notice(kind, [name]), clients)
+
+    # sends the user back to room selection, the client syncs its room listing from DIRECTORY_VERSION with a LIST_ROOMS request
+    def rejoin_message(self, message):
+        version = self.directory.version if self.directory is not None else None
+        return {"TYPE": "REJOIN", "MESSAGE": message, "DIRECTORY_VERSION": version}
+
+    # someone joined: with a PresenceBatcher the ROSTER waits for the presence window and goes out once for all the joins
+    # in it, a mass join costs every member a ROSTER per window instead of one per newcomer
+    def send_join_roster(self, clients):
+        if self.presence is not None:
+            self.presence.add_roster(self, clients)
+        else:
+            self.send_roster(clients)
+
+    # members and their public keys, sent to everyone in the room right away when someone left (see send_join_roster for joins)
+    # the clients hand out their sender keys from it, and make new ones when someone has left (see e2e.py)
+    def send_roster(self, clients):
+        # this one has the newcomers too
+        self.roster_pending = False
+        present = {user: clients.get(user) for user in list(self.users)}
+        frame = Frame({
+            "TYPE": "ROSTER",
+            "ROOM_NAME": self.room_name,
+            "MEMBERS": [[user, client.get_public_key() if client is not None else None] for user, client in present.items()],
+        })
+        for client in present.values():
+            if client is not None:
+                send_frame(client.get_socket(), frame)
+
+    # passes a member's wrapped sender keys on to the members they are meant for, one SENDER_KEY each
+    def send_sender_keys(self, clients, from_user, msg):
+        if from_user not in self.users:
+            return
+
+        for entry in msg.get("KEYS") or []:
+            if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+                continue
+            to = entry[0]
+            client = clients.get(to) if isinstance(to, str) else None
+            if client is not None and to != from_user and to in self.users:
+                send_message(client.get_socket(), {"TYPE": "SENDER_KEY", "ROOM_NAME": self.room_name, "FROM": from_user, "KEY_ID": msg.get("KEY_ID"), "KEYS": [list(entry)]})
+
+    # end-to-end encrypted message, the ciphertext is forwarded as is (the relay can't read it)
+    def send_sealed(self, clients, from_user, msg):
+        if from_user not in self.users:
+            return
+
+        # kept as ciphertext, only members that got the sender key can read it back
+        seq = self.history.append("SEALED", from_user, msg.get("CIPHERTEXT"), msg.get("KEY_ID"))
+        frame = Frame({"TYPE": "SEALED", "ROOM_NAME": self.room_name, "FROM": from_user, "KEY_ID": msg.get("KEY_ID"), "CIPHERTEXT": msg.get("CIPHERTEXT"), "SEQ": seq})
+        for user, conn in self.recipients(clients):
+            if user != from_user:
+                send_frame(conn, frame)
+
+    # the last messages of the room in one HISTORY frame, sent to someone who just joined
+    def send_scrollback(self, socket):
+        if self.scrollback <= 0:
+            return
+
+        seq, frame = self.scrollback_frame
+        if seq != self.history.last_seq():
+            seq = self.history.last_seq()
+            frame = self.history_frame(self.history.before(None, self.scrollback))
+            self.scrollback_frame = (seq, frame)
+
+        if frame is not None:
+            send_frame(socket, frame)
+
+    # GET_HISTORY from a member paging back, BEFORE is the oldest sequence number they have
+    def send_history(self, clients, from_user, msg):
+        client = clients.get(from_user)
+        if from_user not in self.users or client is None:
+            return
+
+        before = msg.get("BEFORE")
+        limit = msg.get("LIMIT")
+        if not isinstance(before, int):
+            before = None
+        if not isinstance(limit, int) or not 0 < limit <= PAGE_LIMIT:
+            limit = PAGE_LIMIT
+
+        # an empty HISTORY tells the client there is nothing older
+        frame = self.history_frame(self.history.before(before, limit)) or Frame({"TYPE": "HISTORY", "ROOM_NAME": self.room_name, "FIRST": None, "MESSAGES": []})
+        send_frame(client.get_socket(), frame)
+
+    def history_frame(self, entries):
+        if not entries:
+            return None
+        return Frame({"TYPE": "HISTORY", "ROOM_NAME": self.room_name, "FIRST": entries[0][0], "MESSAGES": entries})
 
     # Checks if a username is in a room (string -> boolean)
     def in_room(self, user):
         return user in self.users
     
+    # fans a chat line (RECEIVE) or a notice (BROADCAST) out to the room, commands never come through here (see commands.py)
     # from_user is a default argument so broadcast msg essentially "bypasses" the check within the loop, printing to the user that joined also
-    def send_message(self, type, message, clients, from_user="", chat_rooms=None):
+    def send_message(self, type, message, clients, from_user=""):
 
         # edge case where user was able to send a message to the room but not is allowed anymore (kicked or banned)
-        # TEMPORARY FIX
         if from_user and from_user not in self.users:
             return
-        
-        # commands
-        if message[0] == "!":
-            msglist = message.split(" ")
-            command = msglist[0]
-
-            # handles improper command formats, invalid users or self actions
-            if len(msglist) == 2:
-                if command not in ("!remove", "!makeadmin", "!ban"):
-                    send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": "Invalid command format."})
-                    return
-                elif msglist[1] == from_user:
-                    send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": "You cannot perform this action on yourself."})
-                    return
-                elif msglist[1] not in self.users:
-                    send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": f"{msglist[1]} is not in the room."})
-                    return
-                
-            # handles commands that should require additional arguments
-            if len(msglist) == 1:
-                if command in ("!remove", "!makeadmin", "!ban"):
-                    send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": "Invalid command format."})
-                    return
-                    
-            # admin commands
-            if from_user in self.admins:
-                
-                user = msglist[1] if len(msglist) > 1 else None
-
-                match command:
-                    case "!remove":
-
-                        # send message to client before removing from room to process the message
-                        self.users.remove(user)
-                        send_message(clients[user].get_socket(), {"TYPE": "REJOIN", "CHAT_ROOMS": chat_rooms, "MESSAGE": "You have been removed from the room by an admin."})
-
-                        # message to the rest of the users that the user has been removed
-                        self.send_message("BROADCAST", f"{user} has been removed from the room by an admin.", clients)
-
-                    case "!listusers":
-
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": self.users})
-
-                    case "!makeadmin":
-
-                        # adds user to admin list and sends appropriate messages
-                        self.admins.append(user)
-                        send_message(clients[user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": "You have been made an admin by an existing admin."})
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": f"Made {user} admin"})
-
-                    case "!ban":
-                    
-                        # send message to client before removing from room to process the message
-                        self.ban_list.append(user)
-                        self.users.remove(user)
-                        send_message(clients[user].get_socket(), {"TYPE": "REJOIN", "CHAT_ROOMS": chat_rooms, "MESSAGE": "You have been banned from the room by an admin."})
-
-                        # message to the rest of the users that the user has been banned
-                        self.send_message("BROADCAST", f"{user} has been banned from the room by an admin.", clients)
-
-                    case "!banlist":
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": self.ban_list})
-
-            # base commands
-            match command:
-                # returns what type of role the user has (admin / guest)
-                
-                case "!role":
-                    
-                    if from_user in self.admins:
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": "You are an admin"})
-                    else:
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": "You are a member"})
-
-                case "!leave":
-                        
-                        self.users.remove(from_user)
-
-                        if len(self.users) == 0:
-                            # the only user will be an admin, so delete room
-                            if chat_rooms:
-                                # delete room from server and unassign user from room
-                                del chat_rooms[self.room_name]
-                        else:
-                            if from_user in self.admins:
-                                self.admins.remove(from_user)
-
-                                # the first user in the list becomes admin if admin leaves
-                                if len(self.admins) == 0:
-                                    self.admins.append(self.users[0])
-
-                        send_message(clients[from_user].get_socket(), {"TYPE": "REJOIN", "CHAT_ROOMS": chat_rooms, "MESSAGE": "You have left the room."})
-
-                        # message to the rest of the users that the user has left
-                        self.send_message("BROADCAST", f"{from_user} has left the room.", clients, from_user=from_user)
-                case "!roomname":
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": f"The room name is: {self.room_name}"})
-                case "!help":
-                        help_msg = (
-                            "Available commands:\n"
-                            "!role - Check your role (admin/member)\n"
-                            "!leave - Leave the chat room\n"
-                            "!roomname - Get the name of the chat room\n"
-                            "!help - Show this help message\n\n"
-                        )
-
-                        if from_user in self.admins:
-                            help_msg += (
-                                "Admin commands:\n"
-                                "!remove <username> - Remove a user from the room\n"
-                                "!listusers - List all users in the room\n"
-                                "!makeadmin <username> - Make a user an admin\n"
-                                "!ban <username> - Ban a user from the room\n"
-                                "!banlist - Show the list of banned users\n"
-                            )
-
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": help_msg})
-                case "!admins":
-                        send_message(clients[from_user].get_socket(), {"TYPE": "BROADCAST", "MESSAGE": self.admins})
-                        
-             
-        else:
-            # loops thru every user in that room and sends the corresponding message to them
-            # .get_socket() is function in client.
-            for user in self.users:
-                if user != from_user:
-                    send_message(clients[user].get_socket(), {"TYPE": type, "FROM": from_user, "MESSAGE": message})
\ No newline at end of file
+
+        # the message is the same for everyone so it gets encoded once, not once per recipient
+        frame = {"TYPE": type, "FROM": from_user, "MESSAGE": message}
+        # chat lines go in the room's history, numbered so clients can page back from them
+        if type == "RECEIVE":
+            frame["SEQ"] = self.history.append(type, from_user, message)
+        frame = Frame(frame)
+
+        # loops thru every user in that room and sends the corresponding message to them
+        # (the room's recipient snapshot, other threads may add or remove members while this runs)
+        for user, conn in self.recipients(clients):
+            if user != from_user:
+                send_frame(conn, frame)
+
+
+# rebuilds a room from its snapshot record (see snapshot.py), nobody is in it until people join again
+def restore_room(record, **options):
+    room_name, admins, ban_list, password_salt, password_hash = record
+    room = chat_room(room_name, None, **options)
+    room.admins = Members(admins)
+    room.ban_list = set(ban_list)
+    if password_hash is not None:
+        room.has_password = True
+        room.password_salt = password_salt
+        room.password_hash = password_hash
+
+    if room.directory is not None:
+        room.directory.update(room)
+    return room
@@ -1,257 +1,633 @@
 # Important to note, for vast majority of code "messages" arent actually referring to actual typed messages
-# It refers to the bytes sent between clients & relay_server, these messages for most part contain 
+# It refers to the bytes sent between clients & relay_server, these messages for most part contain
 # socket & a map of instructions
 
+# The console client is a single event loop: one selector waits on the socket and on stdin together, whatever arrives
+# from the server is printed the moment it comes in and nothing runs (no CPU used) while both are quiet.
+# Questions to the user (username, which room, passwords...) are prompts with a function that gets the answer,
+# anything typed while no prompt is open goes to the room.
+
+import codecs
+import os
+import random
+import secrets
+import selectors
 import socket
+import sys
 import threading
-import queue
-from protocol import recv_message, send_message
+import time
+
+import attachments
+import codec
+import compression
+import e2e
+from directory import DirectoryView
+from protocol import send_buffers, encode_frame, decode_payload, FrameReader
+
+SERVER = ("72.62.81.113", 5000)
+
+# after the connection drops the client reconnects and resumes its session (see sessions.py): at least RECONNECT_ATTEMPTS
+# tries and more for as long as the relay keeps the session (the WELCOME's GRACE), so a name still held by the dropped
+# session is tried again until it's ours or free. Waits a random part of RECONNECT_DELAY before the first try and doubles
+# it (up to RECONNECT_MAX_DELAY) after every miss, so everyone dropped by the same blip doesn't come back in the same instant
+RECONNECT_ATTEMPTS = 8
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8.0
+RECONNECT_TIMEOUT = 10.0  # seconds to connect and get the WELCOME
 
 state = {
     "RUNNING": True,
-    "IN_ROOM": False,
-    "ROOM": None,
     "USER": None,
+    "PROMPT": None,      # question the user is answering (dict -> PROMPT, BOUNDARIES, THEN), None = lines typed go to the room
+    "ON_LISTING": None,  # called once the room listing we asked for arrives
+    "PROMPTED": False,   # the prompt is on screen and nothing was printed after it
 }
 
-inbox = queue.Queue()   # messages from server (dicts)
-outbox = queue.Queue()  # messages to be sent to relay server (dicts)
+# end-to-end encryption keys (see e2e.py), None without the cryptography package (messages then go out in plaintext)
+session = e2e.E2ESession() if e2e.AVAILABLE else None
+
+
+# the client's end of the connection, shared by the console client below and GUI.py: registration, wire format and
+# compression, keepalives, end-to-end encryption, the local copy of the room listing, the room we are in and the files
+# being sent to / from it
+# read() is called when the socket is readable and hands back the messages meant for the user
+class ServerConnection:
+
+    def __init__(self, sock, session=None):
+        self.use_socket(sock)
+        self.session = session
+        self.name = None
+        self.token = None  # session token from the WELCOME, sent back when we reconnect
+        self.grace = 0     # seconds the relay keeps our session after the connection drops
+
+        # the GUI sends from its own thread while the network thread answers PINGs, frames have to go out whole and in order
+        # (and with the codec / deflater of the socket they go out on)
+        self.lock = threading.Lock()
+        # the GUI also says lines from its writer thread while the network thread reads: the room, the transfers and the
+        # e2e keys are only looked at or changed under state, so a REJOIN can't land between encrypted() and seal()
+        self.state = threading.RLock()
+
+        # local copy of the server's room listing (summaries only), kept current with ROOM_LIST / ROOM_DELTA messages
+        self.rooms = DirectoryView()
+        self.room = None        # the room we are in
+        self.oldest_seq = None  # sequence number of the oldest room message we have seen, !history pages back from it
+
+        # files going through the room (see attachments.py)
+        self.uploads = {}    # transfer id -> attachments.Upload
+        self.downloads = {}  # (sender, transfer id) -> attachments.Download
+
+    def use_socket(self, sock):
+        self.sock = sock
+        # buffered reader, one read from the socket can return several messages
+        self.reader = FrameReader(sock)
+        self.codec = codec.VERSION  # wire format, the server confirms it in its welcome message
+        self.deflater = None        # compression.Deflater for what we send, if the server accepted compression
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # sends the messages together, in one sendmsg call
+    def send(self, *msgs):
+        msgs = [msg for msg in msgs if msg]
+        if not msgs:
+            return
+        with self.lock:
+            frames = [encode_frame(msg, self.codec) for msg in msgs]
+            if self.deflater is not None:
+                frames = [self.deflater.compress(parts) for parts in frames]
+            send_buffers(self.sock, [part for parts in frames for part in parts])
+
+    # initial registration message
+    # lists the codec versions this client speaks, the server picks one in the welcome message
+    # the public key lets the other members of our rooms send us their sender keys
+    # token resumes the session we had before the connection dropped
+    def register(self, name, token=None):
+        self.name = name
+        registration = {"TYPE": "NAME", "NAME": name, "CODECS": list(codec.SUPPORTED_VERSIONS), "COMPRESSION": list(compression.METHODS), "SESSION": token}
+        if self.session is not None:
+            self.session.name = name
+            registration["PUBLIC_KEY"] = self.session.public_key
+        self.send(registration)
+
+    # connects again after the connection dropped and resumes our session, or logs in again if the relay no longer has it
+    # returns the messages for the user that came with the WELCOME, None when the relay couldn't be reached
+    def reconnect(self, address):
+        self.sock.close()
+        delay = RECONNECT_DELAY
+        deadline = time.monotonic() + self.grace
+        attempts = 0
+        while attempts < RECONNECT_ATTEMPTS or time.monotonic() < deadline:
+            attempts += 1
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            try:
+                sock = socket.create_connection(address, timeout=RECONNECT_TIMEOUT)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                continue
+
+            with self.lock:
+                self.use_socket(sock)
+            self.register(self.name, self.token)
+            out = []
+            while not any(msg.get("TYPE") in ("WELCOME", "ERROR") for msg in out):
+                msgs = self.read()
+                if msgs is None:
+                    break
+                out.extend(msgs)
+
+            if any(msg.get("TYPE") == "WELCOME" for msg in out):
+                sock.settimeout(None)
+                return out
+            # our name is still held (by a session that hasn't expired yet), try again later
+            sock.close()
+        return None
+
+    # leaving for good, the relay doesn't keep our session
+    def logout(self):
+        self.token = None
+        try:
+            self.send({"TYPE": "LOGOUT"})
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    # a line typed into the room: !history pages back, !send PATH sends a file, !plaintext lets lines go out unencrypted,
+    # other commands go to the relay as COMMAND messages, chat lines are encrypted once with our sender key
+    # returns messages for the user about what happened here (a file that can't be read...)
+    def say(self, text):
+        with self.state:
+            return self.said(text)
+
+    def said(self, text):
+        if text == "!history":
+            self.send({"TYPE": "GET_HISTORY", "ROOM_NAME": self.room, "BEFORE": self.oldest_seq})
+        elif text == "!send" or text.startswith("!send "):
+            return self.send_file(text[len("!send"):].strip())
+        elif text == "!plaintext" and self.session is not None:
+            self.session.allow_plaintext(self.room)
+            return [{"TYPE": "BROADCAST", "MESSAGE": "Messages in this room now go out in plaintext while someone can't use encryption."}]
+        elif text.startswith("!"):
+            words = text[1:].split()
+            self.send({"TYPE": "COMMAND", "ROOM_NAME": self.room, "COMMAND": words[0] if words else "", "ARGS": words[1:]})
+        elif self.session is not None and self.session.encrypted(self.room):
+            self.send(self.session.seal(self.room, text))
+        # a room we can't encrypt for (or haven't got the keys of yet) only gets plaintext if the user said so
+        elif self.session is not None and not self.session.plaintext_allowed(self.room):
+            if self.room not in self.session.rooms:
+                return [{"TYPE": "BROADCAST", "MESSAGE": "Not sent: the keys of this room haven't arrived yet."}]
+            return [{"TYPE": "BROADCAST", "MESSAGE": "Not sent: someone in this room can't use encryption. Type !plaintext to send in plaintext anyway."}]
+        else:
+            self.send({"TYPE": "SEND", "ROOM_NAME": self.room, "MESSAGE": text})
+        return []
+
+    # starts an upload, the chunks follow as the relay acknowledges (see handle_attachment)
+    def send_file(self, path):
+        if not path:
+            return [{"TYPE": "BROADCAST", "MESSAGE": "Usage: !send <file>"}]
+        try:
+            upload = attachments.Upload(secrets.token_hex(8), self.room, path)
+        except OSError as e:
+            return [{"TYPE": "BROADCAST", "MESSAGE": f"Can't send {path}: {e.strerror}"}]
+        self.uploads[upload.transfer_id] = upload
+        self.send(upload.start_message())
+        return [{"TYPE": "BROADCAST", "MESSAGE": f"Sending {upload.file_name} ({upload.size} bytes)..."}]
+
+    # one read from the socket, returns the messages in it that are meant for the user (None once the server is gone)
+    # keepalives and key exchange are answered here, sealed messages come out as RECEIVE
+    def read(self):
+        try:
+            if not self.reader.fill():
+                return None
+        except OSError:
+            return None
+
+        with self.state:
+            out, replies = self.handle(self.reader.buffer.payloads())
+        self.send(*replies)
+        return out
+
+    def handle(self, payloads):
+        out = []
+        replies = []
+        for payload in payloads:
+            msg = decode_payload(payload)
+            mType = msg.get("TYPE")
 
-prompts_box = queue.Queue() # prompts that the user answers to (dicts -> PROMPT, RESPONSE BOUNDARIES ie ("y" or "n"))
-user_input_box = queue.Queue() # input messages from client (strings)
+            # the relay checks we're still here
+            if mType == "PING":
+                replies.append({"TYPE": "PONG"})
+            elif self.session is not None and mType in ("ROSTER", "SENDER_KEY", "SEALED"):
+                self.handle_encrypted(msg, out, replies)
+            elif mType in ("ATTACH_START", "ATTACH_CHUNK", "ATTACH_ACK", "ATTACH_END"):
+                self.handle_attachment(msg, out, replies)
+            elif mType == "WELCOME" and msg.get("RESUMED"):
+                self.track(msg)
+                out.append(msg)
+                self.resumed(out, replies)
+            else:
+                self.track(msg)
+                out.append(msg)
+        return out, replies
+
+    # connection and room state carried by the messages themselves
+    def track(self, msg):
+        match msg.get("TYPE"):
+            case "WELCOME":
+                with self.lock:
+                    self.codec = msg.get("CODEC") or codec.VERSION
+                    if msg.get("COMPRESSION"):
+                        self.deflater = compression.Deflater(msg["COMPRESSION"])
+                self.token = msg.get("SESSION")
+                self.grace = msg.get("GRACE") or 0
+                # logged in again from scratch after a reconnect, the room we were in is gone
+                if not msg.get("RESUMED") and self.room is not None:
+                    if self.session is not None:
+                        self.session.leave(self.room)
+                    self.drop_transfers()
+                    self.room = None
+
+            case "ROOM_LIST" | "ROOM_DELTA":
+                self.rooms.apply(msg)
+
+            case "CONNECTED":
+                self.room = msg.get("ROOM_NAME")
+                self.oldest_seq = None
+
+            case "REJOIN":
+                # our keys for that room are useless now, and so are the files going through it
+                if self.session is not None:
+                    self.session.leave(self.room)
+                self.drop_transfers()
+                self.room = None
+
+            case "RECEIVE":
+                if self.oldest_seq is None:
+                    self.oldest_seq = msg.get("SEQ")
+
+            case "HISTORY":
+                self.open_history(msg)
+                if msg.get("FIRST") is not None:
+                    self.oldest_seq = msg.get("FIRST")
+
+    # key exchange is answered as soon as it arrives, sealed messages are opened here and go to the user as RECEIVE
+    def handle_encrypted(self, msg, out, replies):
+        mType = msg.get("TYPE")
+        try:
+            if mType == "ROSTER":
+                reply = self.session.handle_roster(msg)
+                if reply:
+                    replies.append(reply)
+                names = self.session.newly_unencrypted(msg.get("ROOM_NAME"))
+                if names:
+                    out.append({"TYPE": "BROADCAST", "MESSAGE": f"{', '.join(names)} can't use encryption, your messages are not sent unless you type !plaintext."})
+
+            elif mType == "SENDER_KEY":
+                for from_user, text in self.session.handle_sender_key(msg):
+                    out.append({"TYPE": "RECEIVE", "FROM": from_user, "MESSAGE": text})
+
+            elif mType == "SEALED":
+                text = self.session.open(msg)
+                if text is not None:
+                    received = {"TYPE": "RECEIVE", "FROM": msg.get("FROM"), "MESSAGE": text, "SEQ": msg.get("SEQ")}
+                    self.track(received)
+                    out.append(received)
+
+        except e2e.E2EError:
+            out.append({"TYPE": "BROADCAST", "MESSAGE": f"Dropped a message from {msg.get('FROM')} that failed to decrypt."})
+
+    # uploads go on as the relay acknowledges them, downloads are written as the chunks come in
+    def handle_attachment(self, msg, out, replies):
+        transfer_id = msg.get("TRANSFER")
+        match msg.get("TYPE"):
+            case "ATTACH_ACK":
+                upload = self.uploads.get(transfer_id)
+                if upload is None:
+                    return
+                replies.extend(upload.acknowledged(msg))
+                if upload.done():
+                    del self.uploads[transfer_id]
+                    upload.close()
+                    replies.append({"TYPE": "ATTACH_END", "ROOM_NAME": upload.room_name, "TRANSFER": transfer_id})
+                    out.append({"TYPE": "BROADCAST", "MESSAGE": f"Sent {upload.file_name}."})
+
+            case "ATTACH_START":
+                key = (msg.get("FROM"), transfer_id)
+                if key in self.downloads:
+                    return
+                try:
+                    download = attachments.Download(msg.get("FROM"), msg.get("FILE_NAME") or "", msg.get("SIZE"))
+                except OSError as e:
+                    out.append({"TYPE": "BROADCAST", "MESSAGE": f"Can't save {msg.get('FILE_NAME')} from {msg.get('FROM')}: {e.strerror}"})
+                    return
+                self.downloads[key] = download
+                out.append({"TYPE": "BROADCAST", "MESSAGE": f"{download.sender} is sending {download.file_name} ({download.size} bytes)..."})
+
+            case "ATTACH_CHUNK":
+                download = self.downloads.get((msg.get("FROM"), transfer_id))
+                if download is not None:
+                    download.write(msg.get("OFFSET"), msg.get("DATA"))
+
+            case "ATTACH_END":
+                # the relay cancelling one of ours comes without a FROM
+                if msg.get("FROM") is None:
+                    upload = self.uploads.pop(transfer_id, None)
+                    if upload is not None:
+                        upload.close()
+                        out.append({"TYPE": "BROADCAST", "MESSAGE": f"{upload.file_name} was not sent: {msg.get('MESSAGE')}"})
+                    return
+
+                download = self.downloads.pop((msg.get("FROM"), transfer_id), None)
+                if download is None:
+                    return
+                if msg.get("CANCELLED"):
+                    download.discard()
+                    out.append({"TYPE": "BROADCAST", "MESSAGE": f"{download.file_name} from {download.sender} was not sent: {msg.get('MESSAGE')}"})
+                else:
+                    download.close()
+                    out.append({"TYPE": "BROADCAST", "MESSAGE": f"Received {download.file_name} from {download.sender}, saved to {download.path}"})
+
+    # back in our session: our uploads carry on from where the relay got to, downloads missed their chunks while we were away
+    def resumed(self, out, replies):
+        for upload in self.uploads.values():
+            replies.append(upload.start_message())
+        for download in self.downloads.values():
+            download.discard()
+            out.append({"TYPE": "BROADCAST", "MESSAGE": f"{download.file_name} from {download.sender} was interrupted by the reconnect."})
+        self.downloads.clear()
+
+    # left the room, files half sent or received are given up
+    def drop_transfers(self):
+        for upload in self.uploads.values():
+            upload.close()
+        for download in self.downloads.values():
+            download.discard()
+        self.uploads.clear()
+        self.downloads.clear()
+
+    # opens the encrypted entries of a HISTORY message where we still have the sender key
+    # (messages from before we joined were sealed with keys we never got, those stay unreadable)
+    def open_history(self, msg):
+        for entry in msg.get("MESSAGES") or []:
+            seq, mType, from_user, body, key_id = entry
+            if mType != "SEALED":
+                continue
+            text = None
+            if self.session is not None:
+                try:
+                    text = self.session.open({"ROOM_NAME": msg.get("ROOM_NAME"), "FROM": from_user, "KEY_ID": key_id, "CIPHERTEXT": body}, hold=False)
+                except e2e.E2EError:
+                    pass
+            entry[3] = text if text is not None else "[encrypted message]"
+
+
+# everything the console prints goes through here, so the loop knows the prompt has to be shown again
+def say(*args, **kwargs):
+    print(*args, **kwargs)
+    state["PROMPTED"] = False
+
+# asks the user something, then(answer) runs once they typed an answer that is in boundaries (if any are given)
+def ask(prompt, then, boundaries=()):
+    state["PROMPT"] = {"PROMPT": prompt, "BOUNDARIES": boundaries, "THEN": then}
+
+def show_prompt(server):
+    if state["PROMPTED"]:
+        return
+    if state["PROMPT"] is not None:
+        print(state["PROMPT"]["PROMPT"], end="", flush=True)
+    elif server.room is not None:
+        print("> ", end="", flush=True)
+    state["PROMPTED"] = True
+
+# a line typed by the user answers the open prompt, or goes to the room we are in
+def handle_line(server, line):
+    # the cursor is on a new line after the user hit enter
+    state["PROMPTED"] = False
+    line = line.strip()
+
+    prompt = state["PROMPT"]
+    if prompt is not None:
+        # empty answers and answers outside the boundaries ask again
+        if not line or prompt["BOUNDARIES"] and line not in prompt["BOUNDARIES"]:
+            return
+        state["PROMPT"] = None
+        prompt["THEN"](line)
+
+    elif server.room is not None and line:
+        for msg in server.say(line):
+            handle_message(server, msg)
+
+# asks the server for (part of) the room listing, then() runs when it arrives
+def request_listing(server, request, then):
+    state["ON_LISTING"] = then
+    server.send(request)
 
 # user choice to either create a new room or join one currently if there are any available
-def room_assignment_action(chat_rooms):
+def room_assignment(server):
     # display all chat rooms to user via console
-
-    print()
-    if chat_rooms:
-        
-        print("Current Chat Rooms: ")
-        if chat_rooms is not None and chat_rooms:
-            for chat_room_name, chat_room_obj in chat_rooms.items():
-                print(f"{chat_room_name} - Owner: {chat_room_obj.get_owner()} - Users: {chat_room_obj.list_users()}")
-        print()
-
-        # .get() function waits for the user to input a choice
-        prompts_box.put({"PROMPT": "Would you like to join a room on the server? (y/n): ", "BOUNDARIES": ("y", "n")})
-        print()
-        
-        return user_input_box.get() == "n"
+    say()
+    if server.rooms.rooms:
+
+        say("Current Chat Rooms: ")
+        for room in server.rooms.rooms.values():
+            say(f"{room.name} - Owner: {room.owner} - Users: {room.members}")
+        say()
+
+        # the listing comes in pages, the user can ask for the next one
+        if server.rooms.has_more():
+            ask("Would you like to join a room on the server? (y/n, m for more rooms): ", lambda choice: room_choice(server, choice), ("y", "n", "m"))
+        else:
+            ask("Would you like to join a room on the server? (y/n): ", lambda choice: room_choice(server, choice), ("y", "n"))
     else:
 
-        print("There are currently no chat rooms on the server. ", end="")
-
-    # returning none denotes that the user intends / needs to make a new room
-    return True
-
-def room_assignment(chat_rooms):
-
-    # a password that a user decides to create when making a new room / when joining a password-protected room
-    password = None
-
-    # the name of the chat room to create / join
-    room_name = None
-
-    # user intends / needs to make a new room
-    if room_assignment_action(chat_rooms):
-        
-        # gathers the user's new room name
-        prompts_box.put({"PROMPT": "Please enter the room of the new chat room: "})
-        room_name = user_input_box.get()
-        print()
-
-        # asks the user if they'd like to create a password
-        prompts_box.put({"PROMPT": "Would you like to create a password for your room? (y/n): ", "BOUNDARIES": ("y", "n")})
-
-        if user_input_box.get() == "y":
-
-            # the user intends to create a password, store a non-null, non-empty value inside of password
-            prompts_box.put({"PROMPT": "Please create a password for the room: "})
-            password = user_input_box.get()
-            print()
-        
-        # finally add to outbox - will be sent to relay server
-        outbox.put({"TYPE": "CREATE_ROOM", "ROOM_NAME": room_name, "PASSWORD": password})
+        say("There are currently no chat rooms on the server. ", end="")
+        # the user needs to make a new room
+        create_room(server)
 
+def room_choice(server, choice):
+    say()
+    if choice == "m":
+        request_listing(server, {"TYPE": "LIST_ROOMS", "PAGE": server.rooms.pages}, room_assignment)
+    elif choice == "n":
+        create_room(server)
     else:
+        join_room(server)
 
-        # user will now choose what room they want to join
-        prompts_box.put({"PROMPT": "Please enter the room you'd like to join: ", "BOUNDARIES": tuple(chat_rooms.keys())})
-        room_name = user_input_box.get()
-        print()
+def create_room(server):
+    # gathers the user's new room name
+    ask("Please enter the room of the new chat room: ", lambda room_name: ask_room_password(server, room_name))
 
-        # checks to see whether there is a password for the room
-        if chat_rooms[room_name].has_password:
-            # password logic
-            prompts_box.put({"PROMPT": "Please enter the password for the room: "})
-            password = user_input_box.get()
-            print()
+def ask_room_password(server, room_name):
+    say()
 
-        # finally add to outbox - will be sent to relay server
-        outbox.put({"TYPE": "JOIN_ROOM", "ROOM_NAME": room_name, "PASSWORD": password})
+    def answered(choice):
+        # the user intends to create a password
+        if choice == "y":
+            ask("Please create a password for the room: ", lambda password: send_room(server, "CREATE_ROOM", room_name, password))
+        else:
+            send_room(server, "CREATE_ROOM", room_name, None)
 
-# ALL THREAD FUNCTIONS 
-def recieving_thread(s):
-    while state["RUNNING"]:
+    # asks the user if they'd like to create a password
+    ask("Would you like to create a password for your room? (y/n): ", answered, ("y", "n"))
 
-        msg = recv_message(s)
-        # in the case of a null msg sent to socket
-        
-        if msg is None:
-            print("Disconnected from server.")
+def join_room(server):
+    def chosen(room_name):
+        say()
+        # checks to see whether there is a password for the room
+        if server.rooms.rooms[room_name].has_password:
+            ask("Please enter the password for the room: ", lambda password: send_room(server, "JOIN_ROOM", room_name, password))
+        else:
+            send_room(server, "JOIN_ROOM", room_name, None)
+
+    # user will now choose what room they want to join
+    ask("Please enter the room you'd like to join: ", chosen, tuple(server.rooms.rooms.keys()))
+
+def send_room(server, mType, room_name, password):
+    if password is not None:
+        say()
+    server.send({"TYPE": mType, "ROOM_NAME": room_name, "PASSWORD": password})
+
+def register(server, name):
+    state["USER"] = name
+    if session is None:
+        say("[E2E]: the cryptography package is not installed, messages will be sent in plaintext")
+    server.register(name)
+    # the first page of the room listing follows the welcome message
+    state["ON_LISTING"] = room_assignment
+
+# a message from the server, printed as soon as it arrives
+def handle_message(server, msg):
+    match msg.get("TYPE"):
+
+        # prints 'Welcome to the VPS Server, {name}!'
+        case "WELCOME":
+            say(f"[SERVER]: {msg.get('MESSAGE')}")
+            # back in our session after a reconnect, still choosing a room: catch up on the listing
+            if msg.get("RESUMED") and server.room is None:
+                request_listing(server, {"TYPE": "LIST_ROOMS", "SINCE": server.rooms.version}, room_assignment)
+
+        case "ROOM_LIST" | "ROOM_DELTA":
+            then, state["ON_LISTING"] = state["ON_LISTING"], None
+            if then is not None:
+                then(server)
+
+        # inbound messages coming from other users in the assigned room
+        case "RECEIVE":
+            say(f"{msg.get('FROM')}: {msg.get('MESSAGE')}")
+
+        # earlier messages of the room, on joining or asked for with !history
+        case "HISTORY":
+            entries = msg.get("MESSAGES") or []
+            if not entries:
+                say("[BROADCAST]: No older messages.\n")
+
+            for _, _, from_user, text, _ in entries:
+                say(f"{from_user}: {text}")
+
+        # broadcast messages that share important, or relevant information from the chat room
+        case "BROADCAST":
+            say(f"[BROADCAST]: {msg.get('MESSAGE')}\n")
+
+        # message type that confirms connection to a room
+        case "CONNECTED":
+            say("CONNECTED!")
+
+        # message type that disconnected a user from a room, user now needs room reassignment
+        case "REJOIN":
+            say(f"[Server]: {msg.get('MESSAGE')}")
+            state["PROMPT"] = None
+
+            # catch up on rooms created / changed / deleted since our listing, unless nothing changed
+            if msg.get("DIRECTORY_VERSION") != server.rooms.version:
+                request_listing(server, {"TYPE": "LIST_ROOMS", "SINCE": server.rooms.version}, room_assignment)
+            else:
+                room_assignment(server)
+
+        # message type that indicates a logic error (or a refused name)
+        case "ERROR":
+            say(f"[Error]: {msg.get('MESSAGE')}")
             state["RUNNING"] = False
-            s.close()
-            break
-        
-        inbox.put(msg)
 
-def outbox_thread(s):
-    while state["RUNNING"]:
-
-        # waits for contents patiently
-        contents = outbox.get()
-
-        # invalid contents if condition passes; either null or contains nothing
-        if contents is None or not contents:
-            continue
-
-        # else, we send the contents to the relay server
-        send_message(s, contents)
+# stdin as something a selector can wait on, and a function reading what's there
+# windows selectors only take sockets, a thread copies the lines typed into a socket pair there
+def stdin_source():
+    if os.name != "nt":
+        fd = sys.stdin.fileno()
+        return fd, lambda: os.read(fd, 4096)
 
-# helper function to not repeat duplicate computations in user_input_thread()
-def input_helper(prompt_dict={}):
+    inside, outside = socket.socketpair()
 
-    user_inp = None
-    prompt = prompt_dict.get("PROMPT") if prompt_dict else "> "
+    def copy_lines():
+        for line in sys.stdin.buffer:
+            outside.sendall(line)
+        outside.close()
 
-    # extracts the boundaries of the prompt, (the response must be in the tuple passed as "BOUNDARIES" hence boundaries)
-    boundaries = tuple()
-
-    if prompt_dict.get("BOUNDARIES") is not None:
-        boundaries = prompt_dict.get("BOUNDARIES")
-
-    # run code in while loop if user_inp is null, empty, or is NOT in a tuple of accepted inputs IF boundaries WITH contents is passed
-    while user_inp is None or not user_inp or boundaries and user_inp not in boundaries:
-        user_inp = input(prompt).strip()
-    
-    return user_inp
-
-def user_input_thread():
-    while state["RUNNING"]:
-        
-        # if the queue has contents inside - the user is being prompted
-        if not prompts_box.empty():
-            # get user inp
-            user_response = input_helper(prompts_box.get())
-            user_input_box.put(user_response)
-
-        # otherwise, with these conditions checked, we can safely assume that the user is attempting to send a message to the relay server
-        elif state["IN_ROOM"]:
-            user_msg = input_helper()
-            user_input_box.put(user_msg)
+    threading.Thread(target=copy_lines, daemon=True).start()
+    return inside, lambda: inside.recv(4096)
 
 def main():
     # Create a TCP/IP socket, connect to the VPS IP address & port
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(("72.62.81.113", 5000))
+    s = socket.create_connection(SERVER)
+    # messages are small and already batched per read, send them without waiting on Nagle
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    server = ServerConnection(s, session)
 
-    # create threads
-    rec_thread = threading.Thread(target = recieving_thread, args=(s,))
-    input_thread = threading.Thread(target = user_input_thread, args=())
-    outbx_thread = threading.Thread(target = outbox_thread, args=(s,))
+    stdin, read_stdin = stdin_source()
+    selector = selectors.DefaultSelector()
+    selector.register(s, selectors.EVENT_READ, "SERVER")
+    selector.register(stdin, selectors.EVENT_READ, "USER")
 
-    input_thread.start()
-    rec_thread.start()
-    outbx_thread.start()
+    # bytes typed so far that don't make a full line yet
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    typed = ""
 
     # set the username of the client
-    prompts_box.put({"PROMPT": "Please enter your username: "})
-    state["USER"] = user_input_box.get()
-
-    # send initial registration message to server
-    outbox.put({"NAME": state["USER"]})
-    
-    # waits to recieve the message from the relay server
-    server_info = inbox.get()
-    
-    # prints 'Welcome to the VPS Server, {name}!'
-    print(f"[SERVER]: {server_info.get("MESSAGE")}")
-    
-    # initial room assignment
-    room_assignment(server_info.get("CHAT_ROOMS"))
+    ask("Please enter your username: ", lambda name: register(server, name))
 
     while state["RUNNING"]:
-
-        # inbound logic - checks to see if inbox queue is empty
-        while not inbox.empty():
-            msg = inbox.get()
-        
-            # gets the type of the message
-            mType = msg.get("TYPE")
-
-            match mType:
-            
-                # inbound messages coming from other users in the assigned room
-                case "RECEIVE":
-
-                    from_user = msg.get("FROM")
-                    user_message = msg.get("MESSAGE")
-
-                    print(f"{from_user}: {user_message}")
-
-                # broadcast messages that share important, or relevant information from the chat room
-                case "BROADCAST":
-                    
-                    broadcast_message = msg.get("MESSAGE")
-
-                    print(f"[BROADCAST]: {broadcast_message}\n")
-                    
-                # message type that confirms connection to a room
-                case "CONNECTED":
-                    
-                    print("CONNECTED!")
-                    # confirms and flags the user in a room and assigns the corresponding room name
-                    room_name = msg.get("ROOM_NAME")
-                    state["IN_ROOM"] = True
-                    state["ROOM"] = room_name
-            
-                # message type that disconnected a user from a room, user now needs room reassignment
-                case "REJOIN":
-                 
-                    server_message = msg.get("MESSAGE")
-
-                    print(f"[Server]: {server_message}")
-
-                    # unassign user flags
-                    state["IN_ROOM"] = False
-                    state["ROOM"] = None
-                    
-                    # drain queue, clear old messages
-                    try:
-                        while True:
-                            user_input_box.get_nowait()
-                    except queue.Empty:
-                        pass
-
-                    chat_rooms = msg.get("CHAT_ROOMS")
-
-                    # assign user a room
-                    room_assignment(chat_rooms)
-
-                # message type that indicates a logic error
-                case "ERROR":
-                    
-                    error_message = msg.get("MESSAGE")
-
-                    print(f"[Error]: {error_message}")
+        show_prompt(server)
+
+        # sleeps until the server sends something or the user hits enter
+        for key, _ in selector.select():
+            if key.data == "SERVER":
+                msgs = server.read()
+                # in the case of a null msg sent to socket
+                if msgs is None and server.token is not None:
+                    say("\nDisconnected from server, reconnecting...")
+                    selector.unregister(server.sock)
+                    # a fresh login (the session was gone) gets the first page of the listing
+                    state["ON_LISTING"] = room_assignment
+                    msgs = server.reconnect(SERVER)
+                    if msgs is not None:
+                        selector.register(server.sock, selectors.EVENT_READ, "SERVER")
+                        if any(msg.get("RESUMED") for msg in msgs):
+                            state["ON_LISTING"] = None
+                if msgs is None:
+                    say("\nDisconnected from server.")
+                    state["RUNNING"] = False
+                    break
+                for msg in msgs:
+                    handle_message(server, msg)
+
+            else:
+                data = read_stdin()
+                # end of input (Ctrl-D)
+                if not data:
                     state["RUNNING"] = False
-            
+                    break
+                typed += decoder.decode(data)
+                *lines, typed = typed.split("\n")
+                for line in lines:
+                    handle_line(server, line)
+
+            if not state["RUNNING"]:
+                break
 
-        # User message to room logic
-        user_message = user_input_box.get()
-        send_message(s, {"TYPE": "SEND", "ROOM_NAME": state["ROOM"], "MESSAGE": user_message})
+    selector.close()
+    # the relay doesn't keep a session for a user that quit
+    server.logout()
+    server.sock.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
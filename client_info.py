@@ -1,16 +1,25 @@
 class Client:
     
-    def __init__(self, socket, user_name, assigned_room):
+    # public_key is the client's X25519 key for end-to-end encryption (None if it can't encrypt), see e2e.py
+    def __init__(self, socket, user_name, assigned_room, public_key=None):
         self.socket = socket
         self.user_name = user_name
         self.assigned_room = assigned_room
+        self.public_key = public_key
 
     def get_name(self):
         return self.user_name
     
     def get_socket(self):
         return self.socket
+
+    # a resumed session's new connection, or the SessionBuffer standing in for a dropped one (see sessions.py)
+    def change_socket(self, socket):
+        self.socket = socket
     
+    def get_public_key(self):
+        return self.public_key
+
     def get_assigned_room(self):
         return self.assigned_room
     
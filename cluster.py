@@ -0,0 +1,357 @@
+# Multi-process relay (relay_server.py --workers N).
+# N worker processes accept on the same port (SO_REUSEPORT) and each room belongs to one of them, picked by a hash
+# of its name. A client stays on the worker that accepted it; room traffic (CREATE_ROOM, JOIN_ROOM, SEND, ...) for a
+# room owned by another worker is forwarded there over a local Unix socket. The owner keeps a Client for every remote
+# member whose "socket" is a RemoteConnection, so chat_room works the same as for local members: frames for those
+# members go back to their worker and out through its Connection.
+#
+# what has to be global lives on a single worker:
+#   - user names: the worker picked by hashing the name holds the reservation (RESERVE / RELEASE) and knows which
+#     worker the client is on; a client back with its session token on another worker gets the session handed over
+#     from the old one (HANDOFF), which from then on reaches it like any remote member
+#   - room listing versions: worker 0 numbers every directory change and sends it to the others (see directory.py)
+#
+# worker <-> worker messages are pickled dicts framed like client traffic, each worker has one outgoing link
+# to every other worker and reads the incoming ones on their own threads. Pickle is only ever read from these links,
+# Unix sockets in the relay's private mkdtemp directory, never from a client
+
+import collections
+import itertools
+import os
+import pickle
+import socket
+import threading
+import time
+import zlib
+
+from directory import RoomSummary
+from protocol import HEADER, send_buffers, FrameReader
+
+CONNECT_TIMEOUT = 10.0  # seconds to wait for the other workers at start up
+RESERVE_TIMEOUT = 5.0   # seconds to wait for the name registry
+DIRECTORY_WORKER = 0    # numbers the room listing changes
+
+
+def shard_of(key, workers):
+    return zlib.crc32(key.encode()) % workers
+
+
+def encode_link(msg):
+    payload = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(payload)), payload
+
+
+# outgoing side of a worker -> worker link, a writer thread flushes whatever is queued in one vectored write
+# frames for remote members are grouped: a room message going to several members on the same worker
+# travels once with the list of its recipients
+class PeerLink:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.messages = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, msg):
+        with self.cond:
+            self.messages.append(msg)
+            self.cond.notify()
+
+    # payload is an encoded frame, consecutive deliveries of the same one are merged
+    def deliver(self, user, payload):
+        with self.cond:
+            last = self.messages[-1] if self.messages else None
+            if last is not None and last.get("PAYLOAD") is payload:
+                last["USERS"].append(user)
+            else:
+                self.messages.append({"TYPE": "DELIVER", "USERS": [user], "PAYLOAD": payload})
+                self.cond.notify()
+
+    def writer_loop(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.messages or self.closed)
+                    if not self.messages:
+                        break
+                    batch = list(self.messages)
+                    self.messages.clear()
+                send_buffers(self.sock, [part for msg in batch for part in encode_link(msg)])
+        except OSError as e:
+            print(f"[-] Worker link lost: {e}")
+        finally:
+            self.sock.close()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+# stands in for the Connection of a member that is connected to another worker
+class RemoteConnection:
+
+    def __init__(self, link, name, session, codec):
+        self.link = link
+        self.name = name
+        self.session = session  # registry token, tells this login apart from an earlier one with the same name
+        self.codec = codec
+        self.slow_consumer = False
+
+    def send_parts(self, parts):
+        self.link.deliver(self.name, parts[1])
+
+
+class Cluster:
+
+    # directory is the worker's RoomDirectory, dispatch(msg) handles CLIENT / DELIVER / DISCONNECT / HANDOFF / MOVED (set by start())
+    def __init__(self, worker_id, workers, socket_dir, directory):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.directory = directory
+        self.dispatch = None
+        self.call = None
+
+        self.links = {}  # worker id -> PeerLink
+        self.lock = threading.Lock()
+
+        # name registry, only holds the names that hash to this worker
+        self.names = {}    # name -> session token
+        self.holders = {}  # name -> worker the client is on
+        self.session_ids = itertools.count(1)
+
+        # this worker's clients
+        self.sessions = {}  # name -> session token
+        self.touched = collections.defaultdict(set)  # name -> workers its room traffic was forwarded to
+
+        # RESERVE requests waiting for an answer, id -> (name, done, timeout timer)
+        self.request_ids = itertools.count(1)
+        self.requests = {}
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, f"worker{worker_id}.sock")
+
+    def shard_of(self, key):
+        return shard_of(key, self.workers)
+
+    # listens for the other workers and connects to each of them, returns once every outgoing link is up
+    # call(fn, *args) runs fn where relay state is touched (hops onto the event loop in async mode), the answers to
+    # reserve() go through it
+    def start(self, dispatch, call=None):
+        self.dispatch = dispatch
+        self.call = call or (lambda fn, *args: fn(*args))
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path(self.worker_id))
+        server.listen()
+        threading.Thread(target=self.accept_loop, args=(server,), daemon=True).start()
+
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        for worker_id in range(self.workers):
+            if worker_id == self.worker_id:
+                continue
+            while True:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.socket_path(worker_id))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    sock.close()
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Worker {worker_id} did not come up")
+                    time.sleep(0.05)
+            self.links[worker_id] = PeerLink(sock)
+
+    def accept_loop(self, server):
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=self.reader_loop, args=(sock,), daemon=True).start()
+
+    def reader_loop(self, sock):
+        reader = FrameReader(sock, decode=pickle.loads)
+        try:
+            while True:
+                msgs = reader.recv_messages()
+                if msgs is None:
+                    break
+                for msg in msgs:
+                    self.handle(msg)
+        except Exception as e:
+            print(f"[-] Worker link error: {e}")
+        finally:
+            sock.close()
+
+    # registry and directory messages are handled right here, the rest goes to the relay
+    def handle(self, msg):
+        match msg.get("TYPE"):
+            case "RESERVE":
+                self.settle(msg)
+
+            case "RESERVED":
+                # an answer that came in after we gave up on it holds a name nobody uses, it's given back
+                # (a session handed over to us is ended on the workers that still have it)
+                if not self.answer(msg.get("ID"), msg.get("SESSION"), msg.get("TOUCHED")) and msg.get("SESSION") is not None:
+                    for worker_id in msg.get("TOUCHED") or ():
+                        self.tell(worker_id, {"TYPE": "DISCONNECT", "NAME": msg.get("NAME"), "SESSION": msg.get("SESSION")})
+                    self.tell(self.shard_of(msg.get("NAME")), {"TYPE": "RELEASE", "NAME": msg.get("NAME"), "SESSION": msg.get("SESSION")})
+
+            case "RELEASE":
+                self.release_local(msg.get("NAME"), msg.get("SESSION"))
+
+            case "HELD":
+                with self.lock:
+                    if self.names.get(msg.get("NAME")) == msg.get("SESSION"):
+                        self.holders[msg.get("NAME")] = msg.get("WORKER")
+
+            case "DIRECTORY":
+                self.publish(msg.get("OP"), RoomSummary(*msg.get("SUMMARY")))
+
+            case "DIRECTORY_CHANGE":
+                self.directory.replay(msg.get("VERSION"), msg.get("OP"), RoomSummary(*msg.get("SUMMARY")))
+
+            case _:
+                self.dispatch(msg)
+
+    # name registry
+
+    def reserve_local(self, name, worker_id):
+        with self.lock:
+            if name in self.names:
+                return None
+            session = self.names[name] = next(self.session_ids)
+            self.holders[name] = worker_id
+            return session
+
+    def release_local(self, name, session):
+        with self.lock:
+            if self.names.get(name) == session:
+                del self.names[name]
+                del self.holders[name]
+
+    # msg goes to worker_id, or is handled right here when that's us
+    def tell(self, worker_id, msg):
+        if worker_id == self.worker_id:
+            self.handle(msg)
+        else:
+            self.links[worker_id].send(msg)
+
+    # the registry's side of a RESERVE: a taken name asked for with a session token is passed on to the worker holding
+    # it, which answers the asking worker itself (HANDOFF, see relay_server.hand_off)
+    def settle(self, msg):
+        name = msg.get("NAME")
+        session = self.reserve_local(name, msg.get("WORKER"))
+        with self.lock:
+            holder = self.holders.get(name)
+        if session is None and msg.get("TOKEN") is not None and holder != msg.get("WORKER"):
+            self.tell(holder, dict(msg, TYPE="HANDOFF"))
+        else:
+            self.tell(msg.get("WORKER"), {"TYPE": "RESERVED", "ID": msg.get("ID"), "NAME": name, "SESSION": session})
+
+    # claims a name for one of this worker's clients, done(reserved, resumed) is called with reserved False if someone
+    # anywhere already has it, resumed True if it was token's session on another worker and was handed over to us
+    # a name held here is settled right away; otherwise the registry's worker is asked and done is called through
+    # self.call when its answer comes in (or after RESERVE_TIMEOUT without one), nothing waits for it in between
+    def reserve(self, name, done, token=None, codec=None):
+        home = self.shard_of(name)
+        if home == self.worker_id and token is None:
+            self.reserved(name, self.reserve_local(name, self.worker_id), None, done)
+            return
+
+        request_id = next(self.request_ids)
+        timer = threading.Timer(RESERVE_TIMEOUT, self.answer, args=(request_id, None))
+        timer.daemon = True
+        with self.lock:
+            self.requests[request_id] = (name, done, timer)
+        timer.start()
+        self.tell(home, {"TYPE": "RESERVE", "NAME": name, "ID": request_id, "WORKER": self.worker_id, "TOKEN": token, "CODEC": codec})
+
+    # the answer to a RESERVE (session None: the name is taken, or there was no answer in time), touched is set when
+    # the session was handed over: the workers that still have the client as a member somewhere
+    # False if the request was already answered
+    def answer(self, request_id, session, touched=None):
+        with self.lock:
+            request = self.requests.pop(request_id, None)
+        if request is None:
+            return False
+        name, done, timer = request
+        timer.cancel()
+        self.call(self.reserved, name, session, touched, done)
+        return True
+
+    def reserved(self, name, session, touched, done):
+        if session is not None:
+            self.sessions[name] = session
+        if touched is not None:
+            self.touched[name] = set(touched)
+        done(session is not None, touched is not None)
+
+    # the worker holding name's session gives it to the one its client came back on (the HANDOFF's WORKER): that one
+    # gets the session and where the client is a member, the others hear where it went and the registry who holds it now
+    # returns the RemoteConnection the client is reached through from here on
+    def hand_off(self, msg):
+        name = msg.get("NAME")
+        worker_id = msg.get("WORKER")
+        session = self.sessions.pop(name)
+        touched = self.touched.pop(name, set())
+        for other in touched - {worker_id}:
+            self.links[other].send({"TYPE": "MOVED", "NAME": name, "SESSION": session, "WORKER": worker_id, "CODEC": msg.get("CODEC")})
+        touched = (touched | {self.worker_id}) - {worker_id}
+        self.tell(worker_id, {"TYPE": "RESERVED", "ID": msg.get("ID"), "NAME": name, "SESSION": session, "TOUCHED": sorted(touched)})
+        self.tell(self.shard_of(name), {"TYPE": "HELD", "NAME": name, "SESSION": session, "WORKER": worker_id})
+        return RemoteConnection(self.links[worker_id], name, session, msg.get("CODEC"))
+
+    # the session isn't here (any more) or the token is wrong: the name is taken
+    def refuse(self, msg):
+        self.tell(msg.get("WORKER"), {"TYPE": "RESERVED", "ID": msg.get("ID"), "NAME": msg.get("NAME"), "SESSION": None})
+
+    # one of this worker's clients disconnected: the workers holding its rooms drop it, then the name is freed
+    def client_gone(self, name):
+        session = self.sessions.pop(name, None)
+        if session is None:
+            return
+
+        for worker_id in self.touched.pop(name, ()):
+            self.links[worker_id].send({"TYPE": "DISCONNECT", "NAME": name, "SESSION": session})
+
+        home = self.shard_of(name)
+        self.tell(home, {"TYPE": "RELEASE", "NAME": name, "SESSION": session})
+
+    # room traffic
+
+    # sends a client's message to the worker that owns its room
+    def forward(self, worker_id, client, msg):
+        name = client.get_name()
+        self.touched[name].add(worker_id)
+        self.links[worker_id].send({
+            "TYPE": "CLIENT",
+            "NAME": name,
+            "SESSION": self.sessions.get(name),
+            "WORKER": self.worker_id,
+            "CODEC": client.get_socket().codec,
+            "PUBLIC_KEY": client.get_public_key(),
+            "MESSAGE": msg,
+        })
+
+    # connection for the sender of a forwarded CLIENT message
+    def remote_connection(self, msg):
+        return RemoteConnection(self.links[msg.get("WORKER")], msg.get("NAME"), msg.get("SESSION"), msg.get("CODEC"))
+
+    # room listing
+
+    # RoomDirectory.forward, worker 0 numbers the change and sends it to everyone else in that order
+    def publish(self, op, summary):
+        if self.worker_id != DIRECTORY_WORKER:
+            self.links[DIRECTORY_WORKER].send({"TYPE": "DIRECTORY", "OP": op, "SUMMARY": list(summary)})
+            return
+
+        with self.lock:
+            change = self.directory.apply(op, summary)
+            if change is None:
+                return
+            version, op, summary = change
+            for link in self.links.values():
+                link.send({"TYPE": "DIRECTORY_CHANGE", "VERSION": version, "OP": op, "SUMMARY": list(summary)})
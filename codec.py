@@ -0,0 +1,265 @@
+# Compact binary wire format of everything the relay and its clients send each other, negotiated in NAME registration.
+#
+# payload = [version u8][type u8][schema fields...][extra fields]
+#   - every message type has a fixed list of fields, written in order without their keys
+#   - keys that are not in the schema go into a trailing list of (key, value) pairs so nothing is lost
+#   - there is no pickle fallback: a payload in any other format (an old client's pickle starts with 0x80) is a CodecError
+#
+# version 2: room listings moved out of WELCOME / REJOIN into the directory messages (LIST_ROOMS, ROOM_LIST, ROOM_DELTA)
+# version 3: end-to-end encryption, PUBLIC_KEY in NAME and the key / ciphertext messages (ROSTER, SENDER_KEY, SEALED)
+# version 4: room history, SEQ on RECEIVE / SEALED and the scrollback messages (GET_HISTORY, HISTORY)
+# version 5: keepalives (PING, PONG)
+# version 6: room commands in their own COMMAND message instead of SEND lines starting with "!"
+# version 7: file attachments (ATTACH_START, ATTACH_CHUNK, ATTACH_ACK, ATTACH_END)
+# version 8: session resumption, SESSION in NAME / WELCOME, RESUMED in WELCOME, LOGOUT
+
+VERSION = 8
+SUPPORTED_VERSIONS = (8,)
+
+# field kinds
+STR = 0      # text (None / absent allowed)
+VALUE = 1    # small tagged value: None, bool, int, str, bytes or a list of those
+
+# message type name -> (type id, ((field, kind), ...))
+SCHEMA = {
+    "NAME": (1, (("NAME", STR), ("CODECS", VALUE), ("PUBLIC_KEY", VALUE), ("SESSION", STR))),
+    "WELCOME": (2, (("MESSAGE", STR), ("CODEC", VALUE), ("DIRECTORY_VERSION", VALUE), ("SESSION", STR), ("RESUMED", VALUE))),
+    "SEND": (3, (("ROOM_NAME", STR), ("MESSAGE", VALUE))),
+    "RECEIVE": (4, (("FROM", STR), ("MESSAGE", VALUE), ("SEQ", VALUE))),
+    "BROADCAST": (5, (("FROM", STR), ("MESSAGE", VALUE))),
+    "REJOIN": (6, (("MESSAGE", STR), ("DIRECTORY_VERSION", VALUE))),
+    "CONNECTED": (7, (("ROOM_NAME", STR),)),
+    "ERROR": (8, (("MESSAGE", STR),)),
+    "CREATE_ROOM": (9, (("ROOM_NAME", STR), ("PASSWORD", STR))),
+    "JOIN_ROOM": (10, (("ROOM_NAME", STR), ("PASSWORD", STR))),
+    "LIST_ROOMS": (11, (("PAGE", VALUE), ("SINCE", VALUE))),
+    "ROOM_LIST": (12, (("VERSION", VALUE), ("PAGE", VALUE), ("PAGES", VALUE), ("ROOMS", VALUE))),
+    "ROOM_DELTA": (13, (("FROM_VERSION", VALUE), ("VERSION", VALUE), ("CHANGES", VALUE))),
+    "ROSTER": (14, (("ROOM_NAME", STR), ("MEMBERS", VALUE))),
+    "SENDER_KEY": (15, (("ROOM_NAME", STR), ("FROM", STR), ("KEY_ID", VALUE), ("KEYS", VALUE))),
+    "SEALED": (16, (("ROOM_NAME", STR), ("FROM", STR), ("KEY_ID", VALUE), ("CIPHERTEXT", VALUE), ("SEQ", VALUE))),
+    "GET_HISTORY": (17, (("ROOM_NAME", STR), ("BEFORE", VALUE), ("LIMIT", VALUE))),
+    "HISTORY": (18, (("ROOM_NAME", STR), ("FIRST", VALUE), ("MESSAGES", VALUE))),
+    "PING": (19, ()),
+    "PONG": (20, ()),
+    "COMMAND": (21, (("ROOM_NAME", STR), ("COMMAND", STR), ("ARGS", VALUE))),
+    "ATTACH_START": (22, (("ROOM_NAME", STR), ("TRANSFER", STR), ("FROM", STR), ("FILE_NAME", STR), ("SIZE", VALUE))),
+    "ATTACH_CHUNK": (23, (("ROOM_NAME", STR), ("TRANSFER", STR), ("FROM", STR), ("OFFSET", VALUE), ("DATA", VALUE))),
+    "ATTACH_ACK": (24, (("TRANSFER", STR), ("OFFSET", VALUE), ("WINDOW", VALUE), ("RESUME", VALUE))),
+    "ATTACH_END": (25, (("ROOM_NAME", STR), ("TRANSFER", STR), ("FROM", STR), ("CANCELLED", VALUE), ("MESSAGE", STR))),
+    "LOGOUT": (26, ()),
+}
+
+TYPES_BY_ID = {type_id: (name, fields) for name, (type_id, fields) in SCHEMA.items()}
+FIELD_NAMES = {name: {key for key, _ in fields} for name, (_, fields) in SCHEMA.items()}
+
+# VALUE tags
+ABSENT, NONE, FALSE, TRUE, INT, NEG_INT, TEXT, BYTES, LIST = range(9)
+
+# STR lengths are stored +2 so 0 and 1 can mean "absent" and None
+STR_ABSENT = 0
+STR_NONE = 1
+
+MAX_VARINT_SHIFT = 63  # longer varints than 64 bits are garbage, not a number
+
+
+class CodecError(ValueError):
+    pass
+
+
+def write_varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift > MAX_VARINT_SHIFT:
+            raise CodecError("Varint too long")
+
+def write_str(out, text):
+    raw = text.encode()
+    write_varint(out, len(raw) + 2)
+    out += raw
+
+# a length of 0 or 1 means absent / None, only the schema's STR fields may use those
+def read_str(data, pos):
+    length, pos = read_varint(data, pos)
+    end = pos + length - 2
+    if length < 2 or end > len(data):
+        raise CodecError(f"Invalid string length: {length}")
+    return str(data[pos:end], "utf-8"), end
+
+def write_value(out, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, str):
+        out.append(TEXT)
+        write_str(out, value)
+    elif isinstance(value, int):
+        out.append(INT if value >= 0 else NEG_INT)
+        write_varint(out, abs(value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(BYTES)
+        write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item)
+    else:
+        raise CodecError(f"Can't encode value of type {type(value).__name__}")
+
+def read_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == TEXT:
+        return read_str(data, pos)
+    if tag == NONE:
+        return None, pos
+    if tag == INT or tag == NEG_INT:
+        n, pos = read_varint(data, pos)
+        return (n if tag == INT else -n), pos
+    if tag == BYTES:
+        length, pos = read_varint(data, pos)
+        if pos + length > len(data):
+            raise CodecError(f"Invalid bytes length: {length}")
+        return bytes(data[pos:pos + length]), pos + length
+    if tag == LIST:
+        count, pos = read_varint(data, pos)
+        # every item takes at least a byte
+        if count > len(data) - pos:
+            raise CodecError(f"Invalid list length: {count}")
+        items = []
+        for _ in range(count):
+            item, pos = read_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    raise CodecError(f"Unknown value tag: {tag}")
+
+
+# message dict -> payload bytes
+def encode(msg, version=VERSION):
+    if version not in SUPPORTED_VERSIONS:
+        raise CodecError(f"Unsupported codec version: {version}")
+
+    msg_type = msg.get("TYPE")
+    if msg_type not in SCHEMA:
+        raise CodecError(f"Unknown message type: {msg_type}")
+    type_id, fields = SCHEMA[msg_type]
+
+    out = bytearray((version, type_id))
+    present = 1  # TYPE
+    for key, kind in fields:
+        if key not in msg:
+            out.append(0)  # STR_ABSENT and ABSENT are both 0
+            continue
+
+        present += 1
+        value = msg[key]
+        if kind == STR:
+            if value is None:
+                out.append(STR_NONE)
+            else:
+                # inlined write_str, nearly every string here is shorter than 126 bytes
+                raw = value.encode()
+                length = len(raw) + 2
+                if length < 0x80:
+                    out.append(length)
+                else:
+                    write_varint(out, length)
+                out += raw
+        else:
+            write_value(out, value)
+
+    # anything the schema doesn't know about
+    if present == len(msg):
+        out.append(0)
+    else:
+        extras = [key for key in msg if key != "TYPE" and key not in FIELD_NAMES[msg_type]]
+        write_varint(out, len(extras))
+        for key in extras:
+            write_str(out, key)
+            write_value(out, msg[key])
+
+    return bytes(out)
+
+# payload (bytes or memoryview) -> message dict
+# anything that isn't a well formed payload (truncated, lengths past its end, nested too deep) is a CodecError
+def decode(data):
+    try:
+        return decode_message(data)
+    except (IndexError, UnicodeDecodeError, RecursionError) as e:
+        raise CodecError(f"Malformed payload: {e!r}")
+
+def decode_message(data):
+    version = data[0]
+    if version not in SUPPORTED_VERSIONS:
+        raise CodecError(f"Unsupported codec version: {version}")
+
+    entry = TYPES_BY_ID.get(data[1])
+    if entry is None:
+        raise CodecError(f"Unknown message type id: {data[1]}")
+    msg_type, fields = entry
+
+    msg = {"TYPE": msg_type}
+    pos = 2
+    for key, kind in fields:
+        marker = data[pos]
+        if kind == STR:
+            if marker > STR_NONE and marker < 0x80:
+                # inlined read_str for the one byte length case
+                end = pos + marker - 1
+                if end > len(data):
+                    raise CodecError(f"Truncated {msg_type} message")
+                msg[key] = str(data[pos + 1:end], "utf-8")
+                pos = end
+            elif marker == STR_ABSENT:
+                pos += 1
+            elif marker == STR_NONE:
+                msg[key] = None
+                pos += 1
+            else:
+                msg[key], pos = read_str(data, pos)
+        elif marker == ABSENT:
+            pos += 1
+        else:
+            msg[key], pos = read_value(data, pos)
+
+    if data[pos] == 0:
+        return msg
+
+    count, pos = read_varint(data, pos)
+    # every extra field takes at least two bytes (the length of an empty key and a value tag)
+    if count > (len(data) - pos) // 2:
+        raise CodecError(f"Invalid extra field count: {count}")
+    for _ in range(count):
+        key, pos = read_str(data, pos)
+        msg[key], pos = read_value(data, pos)
+
+    return msg
+
+# highest version both sides support, None if there is none (the relay turns the client away)
+def negotiate(offered):
+    if not isinstance(offered, (list, tuple)):
+        return None
+    common = [version for version in offered if version in SUPPORTED_VERSIONS]
+    return max(common) if common else None
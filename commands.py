@@ -0,0 +1,177 @@
+# Room commands (!role, !leave, !ban ...) come in their own COMMAND frame, apart from chat lines:
+#   {"TYPE": "COMMAND", "ROOM_NAME": room, "COMMAND": "ban", "ARGS": ["bob"]}
+# so a SEND is never parsed, it goes straight to the room's fan-out. Commands are looked up in the COMMANDS registry,
+# which also checks what a command needs (admin rights, another member of the room as its argument) before the handler
+# runs, and builds the !help text.
+
+from presence import LEFT, REMOVED, BANNED
+from protocol import send_message
+
+COMMANDS = {}  # command name (without the "!") -> Command
+
+# commands the client handles itself, only here so !help lists them
+CLIENT_COMMANDS = (("history", "Show older messages of the room"), ("send <file>", "Send a file to the room"),
+                   ("plaintext", "Send in plaintext while someone in the room can't use encryption"))
+
+
+class Command:
+
+    def __init__(self, name, handler, help, admin=False, target=False):
+        self.name = name
+        self.handler = handler
+        self.help = help
+        self.admin = admin
+        self.target = target
+
+    def usage(self):
+        return f"!{self.name} <username>" if self.target else f"!{self.name}"
+
+
+# registers the decorated function as a command, called as handler(room, clients, from_user, args, chat_rooms)
+# admin: only the room's admins can run it, target: takes the name of another member of the room as its one argument
+def command(name, help, admin=False, target=False):
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, help, admin, target)
+        return handler
+    return register
+
+
+# msg to user, if they are still connected
+def send_to(clients, user, msg):
+    client = clients.get(user)
+    if client is not None:
+        send_message(client.get_socket(), msg)
+
+def notify(clients, user, message):
+    send_to(clients, user, {"TYPE": "BROADCAST", "MESSAGE": message})
+
+
+# runs a COMMAND frame from_user sent to room
+def run(room, clients, from_user, msg, chat_rooms=None):
+    # edge case where user was able to send a command to the room but is not allowed anymore (kicked or banned)
+    if from_user not in room.users:
+        return
+
+    name = msg.get("COMMAND")
+    args = msg.get("ARGS") or []
+    if not isinstance(name, str) or not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        notify(clients, from_user, "Invalid command format.")
+        return
+
+    cmd = COMMANDS.get(name)
+    if cmd is None:
+        notify(clients, from_user, f"Unknown command !{name}, !help lists the commands.")
+        return
+
+    # handles improper command formats, invalid users or self actions
+    if cmd.target:
+        if len(args) != 1:
+            notify(clients, from_user, "Invalid command format.")
+            return
+        if args[0] == from_user:
+            notify(clients, from_user, "You cannot perform this action on yourself.")
+            return
+        if args[0] not in room.users:
+            notify(clients, from_user, f"{args[0]} is not in the room.")
+            return
+    elif args:
+        notify(clients, from_user, "Invalid command format.")
+        return
+
+    if cmd.admin and from_user not in room.admins:
+        notify(clients, from_user, f"Only admins can use !{name}.")
+        return
+
+    cmd.handler(room, clients, from_user, args, chat_rooms)
+
+
+def help_text(admin):
+    text = "Available commands:\n"
+    for cmd in COMMANDS.values():
+        if not cmd.admin:
+            text += f"{cmd.usage()} - {cmd.help}\n"
+    for name, help in CLIENT_COMMANDS:
+        text += f"!{name} - {help}\n"
+    text += "\n"
+
+    if admin:
+        text += "Admin commands:\n"
+        for cmd in COMMANDS.values():
+            if cmd.admin:
+                text += f"{cmd.usage()} - {cmd.help}\n"
+    return text
+
+
+# base commands
+
+@command("role", "Check your role (admin/member)")
+def role(room, clients, from_user, args, chat_rooms):
+    notify(clients, from_user, "You are an admin" if from_user in room.admins else "You are a member")
+
+@command("leave", "Leave the chat room")
+def leave(room, clients, from_user, args, chat_rooms):
+    # remove_user also hands admin to the first user in the list if the last admin leaves
+    room.remove_user(from_user)
+
+    # the only user will be an admin, so delete room from server
+    if len(room.users) == 0 and chat_rooms:
+        del chat_rooms[room.room_name]
+
+    send_to(clients, from_user, room.rejoin_message("You have left the room."))
+
+    # message to the rest of the users that the user has left, they rotate their sender keys
+    room.announce(clients, LEFT, from_user)
+    room.send_roster(clients)
+
+@command("roomname", "Get the name of the chat room")
+def roomname(room, clients, from_user, args, chat_rooms):
+    notify(clients, from_user, f"The room name is: {room.room_name}")
+
+@command("admins", "List the admins of the room")
+def admins(room, clients, from_user, args, chat_rooms):
+    send_to(clients, from_user, {"TYPE": "BROADCAST", "MESSAGE": list(room.admins)})
+
+@command("help", "Show this help message")
+def help(room, clients, from_user, args, chat_rooms):
+    notify(clients, from_user, help_text(from_user in room.admins))
+
+
+# admin commands
+
+@command("remove", "Remove a user from the room", admin=True, target=True)
+def remove(room, clients, from_user, args, chat_rooms):
+    user = args[0]
+    room.remove_user(user)
+    send_to(clients, user, room.rejoin_message("You have been removed from the room by an admin."))
+
+    # message to the rest of the users that the user has been removed, the others rotate their sender keys
+    room.announce(clients, REMOVED, user)
+    room.send_roster(clients)
+
+@command("listusers", "List all users in the room", admin=True)
+def listusers(room, clients, from_user, args, chat_rooms):
+    send_to(clients, from_user, {"TYPE": "BROADCAST", "MESSAGE": room.list_users()})
+
+@command("makeadmin", "Make a user an admin", admin=True, target=True)
+def makeadmin(room, clients, from_user, args, chat_rooms):
+    user = args[0]
+    room.admins.add(user)
+    room.save()
+    notify(clients, user, "You have been made an admin by an existing admin.")
+    notify(clients, from_user, f"Made {user} admin")
+
+@command("ban", "Ban a user from the room", admin=True, target=True)
+def ban(room, clients, from_user, args, chat_rooms):
+    user = args[0]
+    room.ban_list.add(user)
+    room.remove_user(user)
+    room.save()
+    send_to(clients, user, room.rejoin_message("You have been banned from the room by an admin."))
+
+    # message to the rest of the users that the user has been banned
+    room.announce(clients, BANNED, user)
+    room.send_roster(clients)
+
+@command("banlist", "Show the list of banned users", admin=True)
+def banlist(room, clients, from_user, args, chat_rooms):
+    send_to(clients, from_user, {"TYPE": "BROADCAST", "MESSAGE": sorted(room.ban_list)})
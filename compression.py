@@ -0,0 +1,97 @@
+# Per-connection streaming compression, negotiated at registration.
+# A client lists the methods it accepts in its NAME message ("COMPRESSION": [...]) and the relay picks one in WELCOME.
+# Each direction of a connection has one long lived zlib stream, every frame is compressed into it and flushed
+# (Z_SYNC_FLUSH) so it can be decoded as soon as it arrives, while later frames still reuse what came before
+# (user names, room names, keys and the usual broadcast texts end up as short back references).
+# Compressed frames have the top bit of their length header set, frames under the threshold are sent as they are,
+# so a reader never needs to be told what is coming. See protocol.FrameBuffer for the reading side.
+
+import zlib
+
+ZLIB = "zlib"
+ZLIB_DICT = "zlib-dict-1"  # zlib primed with DICTIONARY, the number goes up if the dictionary ever changes
+METHODS = (ZLIB_DICT, ZLIB)  # in order of preference
+
+COMPRESSED = 0x80000000  # flag in the frame length header
+THRESHOLD = 64           # frames smaller than this (bytes) are not worth compressing
+LEVEL = 6
+
+# preset dictionary, strings that show up in almost every frame (the most common ones go last, zlib favours those)
+# never change it in place, add a new method name instead
+DICTIONARY = "".join((
+    "ROOM_LISTROOM_DELTAFROM_VERSIONCHANGESPAGESPAGEROOMSVERSIONDIRECTORY_VERSIONLIST_ROOMSSINCE",
+    "CREATE_ROOMJOIN_ROOMPASSWORDCONNECTEDERRORWELCOMEREJOINCODEC",
+    "ROSTERMEMBERSSENDER_KEYKEYSKEY_IDSEALEDCIPHERTEXT",
+    "You have been made an admin by an existing admin.You are an adminYou are a member",
+    "You have been removed from the room by an admin.You have been banned from the room by an admin.",
+    " has been removed from the room by an admin. has been banned from the room by an admin.",
+    "You have left the room.Welcome to the chat room  has left the room.",
+    "TYPEFROMROOM_NAMEMESSAGEBROADCASTSENDRECEIVE",
+)).encode()
+
+
+# method both sides support, None means no compression
+def negotiate(offered, allowed=METHODS):
+    if not isinstance(offered, (list, tuple)):
+        return None
+    for method in allowed:
+        if method in offered:
+            return method
+    return None
+
+
+# compressing side of one connection, only ever used by one writer (frames must be compressed in the order they are sent)
+class Deflater:
+
+    def __init__(self, method=ZLIB_DICT, threshold=THRESHOLD, level=LEVEL):
+        if method == ZLIB_DICT:
+            self.stream = zlib.compressobj(level, zdict=DICTIONARY)
+        elif method == ZLIB:
+            self.stream = zlib.compressobj(level)
+        else:
+            raise ValueError(f"Unknown compression method: {method}")
+
+        self.method = method
+        self.threshold = threshold
+
+        # counters
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    # (header, payload) -> the frame to send, compressed if it is big enough
+    def compress(self, parts):
+        header, payload = parts
+        size = len(payload)
+        self.raw_bytes += size
+
+        if size < self.threshold:
+            self.wire_bytes += size
+            return parts
+
+        data = self.stream.compress(payload) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_bytes += len(data)
+        return (COMPRESSED | len(data)).to_bytes(4, "big"), data
+
+    def stats(self):
+        return {
+            "COMPRESSION": self.method,
+            "RAW_BYTES": self.raw_bytes,
+            "WIRE_BYTES": self.wire_bytes,
+        }
+
+
+# decompressing side, created by the reader on the first compressed frame
+# the dictionary is only used when the peer's stream asks for it, so one Inflater reads both methods
+class Inflater:
+
+    def __init__(self):
+        self.stream = zlib.decompressobj(zdict=DICTIONARY)
+
+    def decompress(self, data, max_length=0):
+        try:
+            payload = self.stream.decompress(data, max_length)
+        except zlib.error as e:
+            raise ValueError(f"Bad compressed frame: {e}")
+        if self.stream.unconsumed_tail:
+            raise ValueError("Compressed frame too large")
+        return payload
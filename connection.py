@@ -0,0 +1,420 @@
+# Outbound side of a relay connection.
+# Every connection gets its own bounded queue of encoded frames and its own writer (a thread in thread mode,
+# a task in async mode), so fan-out in chat_room only appends to queues and never waits on a slow reader.
+# The writer takes every frame that is ready (up to a size budget) and writes them with one vectored call,
+# so a burst of chat lines costs one syscall instead of one each.
+# Frames are compressed by the writer too when the client negotiated it (compression.py), that keeps the zlib stream
+# in the same order as the socket and the CPU cost off the fan-out path.
+# Connection objects expose send_parts() so protocol.send_message() can be handed one in place of a socket
+# File chunks (attachments.py) go in a second, bulk lane: the writer takes the chat frames first and at most one bulk
+# frame per flush, so text never waits behind a file. The bulk lane isn't bounded by the overflow policy, the transfer
+# windows bound it instead
+
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+import codec
+from protocol import send_buffers
+
+# what happens when a queue is full
+DROP_OLDEST = "drop_oldest"  # throw away the oldest queued frame to make room
+DISCONNECT = "disconnect"    # the consumer is too slow, disconnect it
+BLOCK = "block"              # wait (up to BLOCK_TIMEOUT seconds) for the writer to make room, then disconnect
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+QUEUE_LIMIT = 1024      # frames per connection
+OVERFLOW_POLICY = DROP_OLDEST
+BLOCK_TIMEOUT = 5.0     # seconds
+
+# write budget: one flush carries at most FLUSH_FRAMES frames / FLUSH_BYTES bytes, and the writer may wait up to
+# FLUSH_LATENCY seconds for more frames before flushing a batch that is under budget (0 = flush right away)
+FLUSH_FRAMES = 64
+FLUSH_BYTES = 256 * 1024
+FLUSH_LATENCY = 0.0
+
+
+def frame_size(parts):
+    return sum(len(part) for part in parts)
+
+
+class OutboundQueue:
+
+    def __init__(self, limit=QUEUE_LIMIT, policy=OVERFLOW_POLICY, block_timeout=BLOCK_TIMEOUT):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+
+        self.limit = limit
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        # every frame is a tuple of buffers (header, payload)
+        self.frames = collections.deque()
+        self.bytes = 0
+        # bulk frames and what to call once the writer took them: (parts, done)
+        self.bulk = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # time the queue went over its limit (only used by BLOCK when the caller can't block)
+        self.full_since = None
+
+        # counters
+        self.enqueued = 0
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    # adds a frame, returns False when the overflow policy says the consumer should be disconnected
+    # can_block is False on the event loop thread, there BLOCK lets the queue run over its limit for block_timeout seconds
+    def put(self, parts, can_block=True):
+        with self.cond:
+            if self.closed:
+                return True
+
+            if len(self.frames) >= self.limit:
+                if self.policy == DROP_OLDEST:
+                    self.bytes -= frame_size(self.frames.popleft())
+                    self.dropped += 1
+
+                elif self.policy == DISCONNECT:
+                    return False
+
+                elif can_block:
+                    if not self.cond.wait_for(lambda: self.closed or len(self.frames) < self.limit, self.block_timeout):
+                        return False
+                    if self.closed:
+                        return True
+
+                else:
+                    now = time.monotonic()
+                    if self.full_since is None:
+                        self.full_since = now
+                    elif now - self.full_since > self.block_timeout:
+                        return False
+
+            self.frames.append(parts)
+            self.bytes += frame_size(parts)
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.frames))
+            self.cond.notify_all()
+            return True
+
+    # adds a bulk frame, done() is called once the writer took it (or the queue threw it away)
+    # returns False when the queue is closed, the caller calls done itself then
+    def put_bulk(self, parts, done=None):
+        with self.cond:
+            if self.closed:
+                return False
+            self.bulk.append((parts, done))
+            self.enqueued += 1
+            self.cond.notify_all()
+            return True
+
+    # waits for frames and returns the next batch that fits the flush budget,
+    # None once the queue is closed and drained
+    def get_batch(self, max_frames=FLUSH_FRAMES, max_bytes=FLUSH_BYTES, latency=FLUSH_LATENCY):
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.bulk or self.closed)
+
+            # under budget, give the room a moment to produce more frames for this flush
+            if latency > 0:
+                deadline = time.monotonic() + latency
+                while not self.closed and len(self.frames) < max_frames and self.bytes < max_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+        # popped after the lock is let go, done callbacks may queue frames on other connections
+        return self.pop_batch(max_frames, max_bytes)
+
+    # frames that are ready right now, within the budget (at least one if any are queued), None if empty
+    # chat frames first, then one bulk frame if the budget has room for it
+    def pop_batch(self, max_frames=FLUSH_FRAMES, max_bytes=FLUSH_BYTES):
+        with self.cond:
+            if not self.frames and not self.bulk:
+                return None
+
+            batch = []
+            size = 0
+            while self.frames and len(batch) < max_frames:
+                parts_size = frame_size(self.frames[0])
+                if batch and size + parts_size > max_bytes:
+                    break
+                batch.append(self.frames.popleft())
+                size += parts_size
+            self.bytes -= size
+
+            done = None
+            if self.bulk and len(batch) < max_frames:
+                parts_size = frame_size(self.bulk[0][0])
+                if not batch or size + parts_size <= max_bytes:
+                    parts, done = self.bulk.popleft()
+                    batch.append(parts)
+                    size += parts_size
+
+            self.sent += len(batch)
+            self.bytes_sent += size
+            if len(self.frames) < self.limit:
+                self.full_since = None
+            # wakes up producers blocked by the BLOCK policy
+            self.cond.notify_all()
+
+        if done is not None:
+            done()
+        return batch
+
+    # discard=True throws away frames that were not written yet (used when the connection is aborted),
+    # the chat frames thrown away are returned (a dropped session keeps them, see sessions.py)
+    def close(self, discard=False):
+        frames = []
+        bulk = ()
+        with self.cond:
+            self.closed = True
+            if discard:
+                frames = list(self.frames)
+                self.frames.clear()
+                self.bytes = 0
+                bulk = list(self.bulk)
+                self.bulk.clear()
+            self.cond.notify_all()
+
+        # a transfer doesn't wait for a connection that's gone
+        for _, done in bulk:
+            if done is not None:
+                done()
+        return frames
+
+    def __len__(self):
+        return len(self.frames) + len(self.bulk)
+
+    def stats(self):
+        return {
+            "DEPTH": len(self),
+            "MAX_DEPTH": self.max_depth,
+            "ENQUEUED": self.enqueued,
+            "SENT": self.sent,
+            "BYTES_SENT": self.bytes_sent,
+            "DROPPED": self.dropped,
+        }
+
+
+# how well the writer coalesces: frames written vs write calls (syscalls in thread mode)
+class WriteStats:
+
+    def __init__(self):
+        self.frames = 0
+        self.writes = 0
+
+    def record(self, frames, writes):
+        self.frames += frames
+        self.writes += writes
+
+    def stats(self):
+        return {
+            "FRAMES_WRITTEN": self.frames,
+            "WRITES": self.writes,
+            "FRAMES_PER_WRITE": self.frames / self.writes if self.writes else 0.0,
+        }
+
+
+# TCP_NODELAY: batching happens in the writer, so don't let Nagle hold back the last frame of a batch
+def set_nodelay(sock):
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+# thread mode connection, a daemon writer thread drains the queue with vectored sendmsg calls
+class Connection:
+
+    def __init__(self, sock, limit=QUEUE_LIMIT, policy=OVERFLOW_POLICY, block_timeout=BLOCK_TIMEOUT,
+                 flush_frames=FLUSH_FRAMES, flush_bytes=FLUSH_BYTES, flush_latency=FLUSH_LATENCY):
+        self.sock = sock
+        self.queue = OutboundQueue(limit, policy, block_timeout)
+        self.slow_consumer = False
+        # wire format picked during the NAME handshake, see protocol.py
+        self.codec = codec.VERSION
+        # when the last frame came in, the reader updates it and heartbeat.Reaper checks it
+        self.last_seen = time.monotonic()
+        # ratelimit.Buckets of this connection, made on its first message when --conn-rate / --conn-bytes are set
+        self.rate_limits = None
+
+        self.flush_frames = flush_frames
+        self.flush_bytes = flush_bytes
+        self.flush_latency = flush_latency
+        self.write_stats = WriteStats()
+        # compression.Deflater, set once the client negotiated compression
+        self.deflater = None
+        set_nodelay(sock)
+
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def send_parts(self, parts):
+        if not self.queue.put(parts):
+            self.slow_consumer = True
+            self.abort()
+
+    def send_bulk(self, parts, done=None):
+        if not self.queue.put_bulk(parts, done) and done is not None:
+            done()
+
+    def writer_loop(self):
+        try:
+            while True:
+                batch = self.queue.get_batch(self.flush_frames, self.flush_bytes, self.flush_latency)
+                if batch is None:
+                    break
+                if self.deflater is not None:
+                    batch = [self.deflater.compress(parts) for parts in batch]
+                calls = send_buffers(self.sock, [part for parts in batch for part in parts])
+                self.write_stats.record(len(batch), calls)
+        except OSError:
+            pass
+        finally:
+            self.queue.close(discard=True)
+            self.sock.close()
+
+    # closes once everything already queued has been written (used for normal disconnects)
+    def close(self):
+        self.queue.close()
+
+    # drops the connection right away, the reader thread sees the socket close and runs the usual cleanup
+    # (shut down before the queue closes, the writer closes the socket as soon as it sees the closed queue
+    # and a recv blocked on a closed socket never returns)
+    def abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.queue.close(discard=True)
+
+    def stats(self):
+        stats = {**self.queue.stats(), **self.write_stats.stats()}
+        if self.deflater is not None:
+            stats.update(self.deflater.stats())
+        return stats
+
+
+# async mode connection, a writer task drains the queue into the asyncio transport and stops while the transport
+# has paused writing (its buffer is over the high-water mark), so a slow reader backs up in its own bounded queue
+class AsyncConnection:
+
+    def __init__(self, transport, limit=QUEUE_LIMIT, policy=OVERFLOW_POLICY, block_timeout=BLOCK_TIMEOUT,
+                 flush_frames=FLUSH_FRAMES, flush_bytes=FLUSH_BYTES, flush_latency=FLUSH_LATENCY):
+        self.transport = transport
+        self.queue = OutboundQueue(limit, policy, block_timeout)
+        self.slow_consumer = False
+        # wire format picked during the NAME handshake, see protocol.py
+        self.codec = codec.VERSION
+        # when the last frame came in, the reader updates it and heartbeat.Reaper checks it
+        self.last_seen = time.monotonic()
+        # ratelimit.Buckets of this connection, made on its first message when --conn-rate / --conn-bytes are set
+        self.rate_limits = None
+
+        self.flush_frames = flush_frames
+        self.flush_bytes = flush_bytes
+        self.flush_latency = flush_latency
+        self.write_stats = WriteStats()
+        # compression.Deflater, set once the client negotiated compression
+        self.deflater = None
+        set_nodelay(transport.get_extra_info("socket"))
+
+        # must be created on the event loop thread
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.task = self.loop.create_task(self.writer_loop())
+
+    # safe to call from the loop thread or from any other thread
+    def send_parts(self, parts):
+        on_loop = threading.get_ident() == self.loop_thread
+        if not self.queue.put(parts, can_block=not on_loop):
+            self.slow_consumer = True
+            self.abort()
+            return
+        self.wake(on_loop)
+
+    def send_bulk(self, parts, done=None):
+        if not self.queue.put_bulk(parts, done):
+            if done is not None:
+                done()
+            return
+        self.wake(threading.get_ident() == self.loop_thread)
+
+    def wake(self, on_loop=True):
+        if on_loop:
+            self.wakeup.set()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def writer_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+
+                # under budget, let the room produce more frames before flushing
+                if self.flush_latency > 0 and len(self.queue) < self.flush_frames and not self.queue.closed:
+                    await asyncio.sleep(self.flush_latency)
+
+                while True:
+                    await self.can_write.wait()
+                    batch = self.queue.pop_batch(self.flush_frames, self.flush_bytes)
+                    if batch is None:
+                        break
+                    if self.deflater is not None:
+                        batch = [self.deflater.compress(parts) for parts in batch]
+                    # the selector transport joins these and tries a single send() right away
+                    self.transport.writelines([part for parts in batch for part in parts])
+                    self.write_stats.record(len(batch), 1)
+
+                if self.queue.closed and not len(self.queue):
+                    break
+        finally:
+            self.queue.close(discard=True)
+            self.transport.close()
+
+    # flow control callbacks, forwarded by the protocol
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def connection_lost(self):
+        self.queue.close(discard=True)
+        self.can_write.set()
+        self.wakeup.set()
+
+    def close(self):
+        self.queue.close()
+        self.wake(threading.get_ident() == self.loop_thread)
+
+    def abort(self):
+        self.queue.close(discard=True)
+        # transports are not thread safe, hop onto the loop when called from elsewhere
+        if threading.get_ident() == self.loop_thread:
+            self.abort_transport()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.abort_transport)
+
+    def abort_transport(self):
+        self.transport.abort()
+        self.wakeup.set()
+
+    def stats(self):
+        stats = {**self.queue.stats(), **self.write_stats.stats()}
+        if self.deflater is not None:
+            stats.update(self.deflater.stats())
+        return stats
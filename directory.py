@@ -0,0 +1,178 @@
+# Room directory: what clients see when they pick a room to join.
+# The relay keeps one lightweight summary per room (name, owner, member count, password flag) and a version number
+# that goes up on every change. Listing pages are encoded once and reused until the next change, and recent changes
+# are kept as a log so a client that already has an older listing only gets the add/remove/update deltas since then.
+
+import collections
+import threading
+
+from protocol import Frame
+
+PAGE_SIZE = 50        # rooms per ROOM_LIST page
+DELTA_HISTORY = 1024  # changes kept for ROOM_DELTA, older listings have to be fetched again
+
+ADD = "ADD"
+UPDATE = "UPDATE"
+REMOVE = "REMOVE"
+
+# summaries travel as plain lists ([name, owner, members, has_password]) so they fit the codec's VALUE fields
+RoomSummary = collections.namedtuple("RoomSummary", ("name", "owner", "members", "has_password"))
+
+
+def summarize(room):
+    # len of the Members index itself, list_users() would copy every member on each join and leave
+    return RoomSummary(room.get_chat_room_name(), room.get_owner(), len(room.users), room.has_password)
+
+
+class RoomDirectory:
+
+    def __init__(self, page_size=PAGE_SIZE, history=DELTA_HISTORY):
+        self.page_size = page_size
+        self.version = 0
+        self.rooms = {}  # room name -> RoomSummary, in creation order
+        self.changes = collections.deque(maxlen=history)  # (version, op, summary)
+        self.lock = threading.Lock()
+
+        # encoded frames, thrown away whenever the version changes
+        self.page_frames = {}
+        self.delta_frames = {}
+
+        # multi-process relay (cluster.py): changes are sent to the worker that numbers them instead of applied here,
+        # they come back through replay() in the same order on every worker so versions mean the same everywhere
+        self.forward = None
+
+    def record(self, op, summary):
+        self.version += 1
+        self.changes.append((self.version, op, summary))
+        self.page_frames.clear()
+        self.delta_frames.clear()
+
+    # called whenever a room is created or its members change, does nothing if the summary is the same
+    def update(self, room):
+        summary = summarize(room)
+        if self.forward is not None:
+            self.forward(UPDATE, summary)
+        else:
+            self.apply(UPDATE, summary)
+
+    def remove(self, room_name):
+        summary = RoomSummary(room_name, None, 0, False)
+        if self.forward is not None:
+            self.forward(REMOVE, summary)
+        else:
+            self.apply(REMOVE, summary)
+
+    # records a change, returns (version, op, summary) or None if it didn't change anything
+    def apply(self, op, summary):
+        with self.lock:
+            if op == REMOVE:
+                summary = self.rooms.pop(summary.name, None)
+                if summary is None:
+                    return None
+            else:
+                old = self.rooms.get(summary.name)
+                if old == summary:
+                    return None
+                self.rooms[summary.name] = summary
+                op = UPDATE if old else ADD
+            self.record(op, summary)
+            return self.version, op, summary
+
+    # a change that was numbered by another process
+    def replay(self, version, op, summary):
+        with self.lock:
+            if op == REMOVE:
+                self.rooms.pop(summary.name, None)
+            else:
+                self.rooms[summary.name] = summary
+            self.version = version - 1
+            self.record(op, summary)
+
+    def page_count(self):
+        return max(1, -(-len(self.rooms) // self.page_size))
+
+    # ROOM_LIST frame for one page of the directory
+    def page(self, number=0):
+        with self.lock:
+            number = min(max(0, number), self.page_count() - 1)
+            frame = self.page_frames.get(number)
+            if frame is None:
+                start = number * self.page_size
+                rooms = list(self.rooms.values())[start:start + self.page_size]
+                frame = Frame({
+                    "TYPE": "ROOM_LIST",
+                    "VERSION": self.version,
+                    "PAGE": number,
+                    "PAGES": self.page_count(),
+                    "ROOMS": [list(summary) for summary in rooms],
+                })
+                self.page_frames[number] = frame
+            return frame
+
+    # ROOM_DELTA frame with every change after since, None if the log doesn't reach back that far
+    def delta(self, since):
+        with self.lock:
+            if since > self.version:
+                return None
+            oldest = self.changes[0][0] if self.changes else self.version + 1
+            if since < oldest - 1 and since != self.version:
+                return None
+
+            frame = self.delta_frames.get(since)
+            if frame is None:
+                # the last change per room is enough, older ones are overwritten by it
+                latest = {}
+                for version, op, summary in self.changes:
+                    if version > since:
+                        latest.pop(summary.name, None)
+                        latest[summary.name] = (op, summary)
+                frame = Frame({
+                    "TYPE": "ROOM_DELTA",
+                    "FROM_VERSION": since,
+                    "VERSION": self.version,
+                    "CHANGES": [[op, *summary] for op, summary in latest.values()],
+                })
+                self.delta_frames[since] = frame
+            return frame
+
+    # answer to a LIST_ROOMS request: deltas when the client's listing is recent enough, a page otherwise
+    def listing(self, page=0, since=None):
+        if since is not None:
+            frame = self.delta(since)
+            if frame is not None:
+                return frame
+        return self.page(page)
+
+
+# Client side copy of the directory, built from ROOM_LIST pages and kept current with ROOM_DELTA messages
+class DirectoryView:
+
+    def __init__(self):
+        self.version = None
+        self.rooms = {}   # room name -> RoomSummary
+        self.pages = 0    # pages fetched so far
+        self.total_pages = 1
+
+    def apply(self, msg):
+        if msg.get("TYPE") == "ROOM_LIST":
+            # a first page means a fresh listing
+            if msg.get("PAGE", 0) == 0:
+                self.rooms = {}
+            for room in msg.get("ROOMS", []):
+                summary = RoomSummary(*room)
+                self.rooms[summary.name] = summary
+            self.pages = msg.get("PAGE", 0) + 1
+            self.total_pages = msg.get("PAGES", 1)
+
+        elif msg.get("TYPE") == "ROOM_DELTA":
+            for op, *room in msg.get("CHANGES", []):
+                summary = RoomSummary(*room)
+                if op == REMOVE:
+                    self.rooms.pop(summary.name, None)
+                else:
+                    self.rooms[summary.name] = summary
+
+        self.version = msg.get("VERSION", self.version)
+
+    def has_more(self):
+        return self.pages < self.total_pages
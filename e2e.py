@@ -0,0 +1,222 @@
+# End-to-end encryption of room messages (client side, the relay never sees a key).
+#
+# Every client has an X25519 identity key, the public half goes to the relay in the NAME message and the relay hands
+# out the keys of a room's members in ROSTER messages whenever the members change.
+# Each member encrypts its own messages with a random AES-GCM "sender key" for the room, so a message is encrypted once
+# no matter how many people are in the room. A sender key is sent to every other member wrapped with the pairwise key
+# of the two (X25519 + HKDF), the relay only ever forwards wrapped keys (SENDER_KEY) and ciphertext (SEALED).
+# When someone leaves (!leave, !remove, !ban or a disconnect) everyone left makes a new sender key, so whoever left
+# can't read what comes after. Someone joining just gets the current keys.
+#
+# A member without a key (one that can't encrypt, or one the relay left the key out for) doesn't quietly turn the room
+# to plaintext: the user is told once and nothing goes out until they agree to send in plaintext in that room.
+#
+# the relay is trusted to hand out the right public keys, there is no key verification between users yet
+# needs the cryptography package, without it AVAILABLE is False and the client stays on plaintext
+
+import os
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+KEY_SIZE = 32     # AES-256-GCM
+NONCE_SIZE = 12
+PENDING_LIMIT = 100  # sealed messages held per room while waiting for their sender key
+OWN_KEYS = 50        # our own past sender keys kept per room, our lines in HISTORY are sealed with them
+
+
+class E2EError(ValueError):
+    pass
+
+
+# associated data, ties a ciphertext to its room / sender / key so the relay can't move it somewhere else
+def message_aad(room_name, sender, key_id):
+    return f"{room_name}|{sender}|{key_id}".encode()
+
+def wrap_aad(room_name, sender, to, key_id):
+    return f"{room_name}|{sender}|{to}|{key_id}".encode()
+
+def encrypt(aead, data, aad):
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + aead.encrypt(nonce, data, aad)
+
+def decrypt(aead, sealed, aad):
+    try:
+        return aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], aad)
+    except InvalidTag:
+        raise E2EError("Message failed authentication")
+
+
+# key state of one room
+class RoomKeys:
+
+    def __init__(self):
+        self.members = {}      # name -> public key (None for clients that can't encrypt)
+        self.key_id = 0
+        self.raw_key = None    # our current sender key
+        self.key = None
+        self.sender_keys = {}  # (name, key id) -> AESGCM of the other members
+        self.pending = []      # SEALED messages that arrived before their sender key
+        self.warned = False    # the user was told some members can't encrypt
+        self.plaintext = False  # the user agreed to send in plaintext while they can't
+
+    # me is our own name, our keys go in sender_keys too so we can read back what we sent
+    def rotate(self, me):
+        self.key_id += 1
+        self.raw_key = AESGCM.generate_key(bit_length=KEY_SIZE * 8)
+        self.key = AESGCM(self.raw_key)
+        self.sender_keys[(me, self.key_id)] = self.key
+        old = self.key_id - OWN_KEYS
+        self.sender_keys.pop((me, old), None)
+
+    def add_sender_key(self, name, key_id, raw_key):
+        self.sender_keys[(name, key_id)] = AESGCM(raw_key)
+        # the previous key stays around for messages that were already on their way
+        for old in [entry for entry in self.sender_keys if entry[0] == name and entry[1] < key_id - 1]:
+            del self.sender_keys[old]
+
+    def forget(self, name):
+        for old in [entry for entry in self.sender_keys if entry[0] == name]:
+            del self.sender_keys[old]
+        self.pending = [msg for msg in self.pending if msg.get("FROM") != name]
+
+    # every other member can decrypt
+    def encrypted(self, me):
+        return self.key is not None and not self.unencrypted(me)
+
+    # the other members that have no public key
+    def unencrypted(self, me):
+        return [name for name, key in self.members.items() if key is None and name != me]
+
+
+class E2ESession:
+
+    def __init__(self, name=None):
+        self.name = name
+        self.private_key = X25519PrivateKey.generate()
+        self.public_key = self.private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        self.rooms = {}     # room name -> RoomKeys
+        self.pairwise = {}  # peer public key -> AESGCM used to wrap sender keys
+
+    def pairwise_key(self, peer_public):
+        key = self.pairwise.get(peer_public)
+        if key is None:
+            shared = self.private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+            raw = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=None, info=b"EncryptionMessenger sender key wrap").derive(shared)
+            key = self.pairwise[peer_public] = AESGCM(raw)
+        return key
+
+    # ROSTER from the relay, returns the SENDER_KEY message to send (None if there is nothing to hand out)
+    def handle_roster(self, msg):
+        room_name = msg.get("ROOM_NAME")
+        room = self.rooms.setdefault(room_name, RoomKeys())
+
+        members = {name: key for name, key in msg.get("MEMBERS") or []}
+        left = [name for name in room.members if name not in members]
+        joined = [name for name in members if name not in room.members and name != self.name]
+        room.members = members
+
+        for name in left:
+            room.forget(name)
+
+        # new key for everyone if someone left (or we just got here), otherwise the newcomers get the current one
+        if room.key is None or left:
+            room.rotate(self.name)
+            targets = [name for name in members if name != self.name]
+        else:
+            targets = joined
+
+        return self.sender_key_message(room_name, room, targets)
+
+    def sender_key_message(self, room_name, room, targets):
+        keys = []
+        for to in targets:
+            peer = room.members.get(to)
+            if peer is not None:
+                sealed = encrypt(self.pairwise_key(peer), room.raw_key, wrap_aad(room_name, self.name, to, room.key_id))
+                keys.append([to, sealed])
+
+        if not keys:
+            return None
+        return {"TYPE": "SENDER_KEY", "ROOM_NAME": room_name, "KEY_ID": room.key_id, "KEYS": keys}
+
+    # SENDER_KEY from another member, returns [(sender, text), ...] for held back messages it unlocked
+    def handle_sender_key(self, msg):
+        room_name = msg.get("ROOM_NAME")
+        room = self.rooms.get(room_name)
+        sender = msg.get("FROM")
+        # our own keys are never handed to us
+        if room is None or sender == self.name or room.members.get(sender) is None:
+            return []
+
+        key_id = msg.get("KEY_ID")
+        for to, sealed in msg.get("KEYS") or []:
+            if to == self.name:
+                raw_key = decrypt(self.pairwise_key(room.members[sender]), sealed, wrap_aad(room_name, sender, to, key_id))
+                room.add_sender_key(sender, key_id, raw_key)
+
+        pending, room.pending = room.pending, []
+        opened = []
+        for held in pending:
+            text = self.open(held)
+            if text is not None:
+                opened.append((held.get("FROM"), text))
+        return opened
+
+    def encrypted(self, room_name):
+        room = self.rooms.get(room_name)
+        return room is not None and room.encrypted(self.name)
+
+    # the members of room_name that can't decrypt, only the first time there are any (again) so the user is told once
+    def newly_unencrypted(self, room_name):
+        room = self.rooms.get(room_name)
+        if room is None:
+            return []
+        names = room.unencrypted(self.name)
+        if not names:
+            room.warned = False
+            return []
+        if room.warned:
+            return []
+        room.warned = True
+        return names
+
+    # the user agreed to send in plaintext in room_name while someone there can't encrypt (until they leave the room)
+    def allow_plaintext(self, room_name):
+        self.rooms.setdefault(room_name, RoomKeys()).plaintext = True
+
+    def plaintext_allowed(self, room_name):
+        room = self.rooms.get(room_name)
+        return room is not None and room.plaintext
+
+    # SEALED message for the relay to forward
+    def seal(self, room_name, text):
+        room = self.rooms[room_name]
+        ciphertext = encrypt(room.key, text.encode(), message_aad(room_name, self.name, room.key_id))
+        return {"TYPE": "SEALED", "ROOM_NAME": room_name, "KEY_ID": room.key_id, "CIPHERTEXT": ciphertext}
+
+    # text of a SEALED message, None if its sender key hasn't arrived yet (the message is held until it does, unless hold is False)
+    def open(self, msg, hold=True):
+        room_name = msg.get("ROOM_NAME")
+        room = self.rooms.get(room_name)
+        if room is None:
+            return None
+
+        sender = msg.get("FROM")
+        key = room.sender_keys.get((sender, msg.get("KEY_ID")))
+        if key is None:
+            if hold and len(room.pending) < PENDING_LIMIT:
+                room.pending.append(msg)
+            return None
+
+        return decrypt(key, msg.get("CIPHERTEXT"), message_aad(room_name, sender, msg.get("KEY_ID"))).decode()
+
+    def leave(self, room_name):
+        self.rooms.pop(room_name, None)
@@ -0,0 +1,140 @@
+# Keepalives and the idle connection reaper (relay_server.py --ping-interval / --idle-timeout).
+# A connection that has been quiet for --ping-interval seconds gets a PING, clients answer with PONG. One that has sent
+# nothing at all for --idle-timeout seconds is half-open or gone: it is aborted, which ends its reader the same way a
+# disconnect does, so the usual cleanup (room, roster, name) runs.
+#
+# Connections only note the time of their last frame (last_seen), nothing is rescheduled per message. Every connection
+# has one timer in a hierarchical timer wheel, when it fires the reaper looks at last_seen and either pings, reaps,
+# or sets the timer again for when the connection could next be idle. Each tick of the wheel only looks at one slot,
+# so tracking 100k connections costs the same per tick as tracking ten.
+
+import math
+import threading
+import time
+
+from protocol import send_message
+
+PING_INTERVAL = 30.0  # seconds of silence before a PING
+IDLE_TIMEOUT = 90.0   # seconds of silence before the connection is dropped (0 = never)
+TICK = 1.0            # timer wheel resolution in seconds
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS  # slots per level
+LEVELS = 4              # range: SLOTS ** LEVELS ticks (~194 days at one second per tick)
+
+
+# Hierarchical timer wheel: level 0 has one slot per tick, every level above has slots SLOTS times as wide.
+# A timer goes in the lowest level that reaches its deadline and moves down a level (cascades) when the level below
+# wraps around to its slot, so it is only ever touched LEVELS times. Keys can be any hashable, cancel is a dict delete.
+class TimerWheel:
+
+    def __init__(self, tick=TICK, start=None):
+        self.tick = tick
+        self.now = self.ticks(time.monotonic() if start is None else start)
+        self.slots = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]  # key -> deadline in ticks
+        self.where = {}  # key -> slot dict it's in
+
+    def ticks(self, seconds):
+        return math.ceil(seconds / self.tick)
+
+    # (re)arms key's timer for the given time (time.monotonic() seconds)
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        self.place(key, max(self.ticks(deadline), self.now + 1))
+
+    def place(self, key, deadline):
+        delta = deadline - self.now
+        level = 0
+        while level < LEVELS - 1 and delta >= SLOTS ** (level + 1):
+            level += 1
+        # past the last level's range, parked in its furthest slot and placed again when that one cascades
+        at = min(deadline, self.now + SLOTS ** LEVELS - 1)
+        slot = self.slots[level][(at >> (SLOT_BITS * level)) & (SLOTS - 1)]
+        slot[key] = deadline
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def __len__(self):
+        return len(self.where)
+
+    # moves the wheel up to the given time, returns the keys whose timers went off
+    def advance(self, now):
+        target = self.ticks(now)
+        expired = []
+        while self.now < target:
+            self.now += 1
+
+            # a level wrapped around, the next slot of the level above moves down
+            level = 1
+            while level < LEVELS and (self.now & ((1 << (SLOT_BITS * level)) - 1)) == 0:
+                slot = self.slots[level][(self.now >> (SLOT_BITS * level)) & (SLOTS - 1)]
+                timers = list(slot.items())
+                slot.clear()
+                for key, deadline in timers:
+                    self.place(key, deadline)
+                level += 1
+
+            slot = self.slots[0][self.now & (SLOTS - 1)]
+            for key in slot:
+                del self.where[key]
+            expired.extend(slot)
+            slot.clear()
+        return expired
+
+
+# watches the relay's connections on a thread of its own, pings the quiet ones and aborts the dead ones
+class Reaper:
+
+    def __init__(self, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, tick=TICK):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+        self.reaped = 0
+
+    # conn is a Connection / AsyncConnection, its reader keeps conn.last_seen up to date
+    def watch(self, conn):
+        with self.lock:
+            self.wheel.schedule(conn, conn.last_seen + min(self.ping_interval, self.idle_timeout))
+
+    def forget(self, conn):
+        with self.lock:
+            self.wheel.cancel(conn)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            self.check(time.monotonic())
+
+    def check(self, now):
+        with self.lock:
+            expired = self.wheel.advance(now)
+
+        for conn in expired:
+            # closing anyway
+            if conn.queue.closed:
+                continue
+
+            idle = now - conn.last_seen
+            if idle >= self.idle_timeout:
+                print(f"[-] Dropping a connection that was silent for {idle:.0f}s")
+                self.reaped += 1
+                conn.abort()
+                continue
+
+            if idle >= self.ping_interval:
+                # quiet for a while, the PONG (or anything else) will show it's still there
+                send_message(conn, {"TYPE": "PING"})
+                deadline = conn.last_seen + self.idle_timeout
+            else:
+                deadline = conn.last_seen + min(self.ping_interval, self.idle_timeout)
+
+            with self.lock:
+                self.wheel.schedule(conn, deadline)
@@ -0,0 +1,261 @@
+# Per-room message history.
+# Every chat line (RECEIVE, and SEALED ciphertext for end-to-end encrypted rooms) gets the room's next sequence number
+# and goes into a bounded ring of recent messages, new members get the tail of it in one HISTORY frame when they join.
+# With a log directory (relay_server.py --history-dir) messages are also appended to an on-disk log, so clients can
+# page back further than the ring with GET_HISTORY.
+#
+# the log of a room is a series of fixed size segment files named after the first sequence number they hold, each
+# segment keeps the offset of every record in memory, so reading a message is a bisect over the segments plus one
+# index lookup, the log is never scanned (except once when a room's log is opened again).
+# Only the newest max_segments segments are kept, older ones are deleted as new ones fill up.
+# Only the segment being written is memory-mapped (a map holds a file descriptor of its own); full segments are read
+# with a plain read when someone pages back that far. A room's log is opened on first use (see RoomHistory), so a
+# relay restoring a thousand rooms doesn't hold a thousand logs open before anyone has joined them.
+#
+# history entries travel as plain lists: [seq, type, from, body, key id] (body is the ciphertext for SEALED)
+
+import array
+import bisect
+import collections
+import hashlib
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import threading
+
+HISTORY_SIZE = 200        # messages kept in memory per room
+SCROLLBACK = 50           # messages sent to someone joining
+PAGE_LIMIT = 100          # most messages one GET_HISTORY answer holds
+SEGMENT_SIZE = 1024 * 1024
+MAX_SEGMENTS = 8          # per room, so a room's log is at most SEGMENT_SIZE * MAX_SEGMENTS bytes
+
+RECORD = struct.Struct("!I")  # length of the pickled entry, 0 marks the end of a segment
+
+
+class Segment:
+
+    def __init__(self, path, base, size=SEGMENT_SIZE):
+        self.path = path
+        self.base = base  # sequence number of the first record
+        self.offsets = array.array("Q")
+        self.end = 0
+
+        exists = os.path.exists(path)
+        with open(path, "r+b" if exists else "w+b") as f:
+            if not exists:
+                f.truncate(size)
+            # the map keeps its own handle on the file until seal()
+            self.map = mmap.mmap(f.fileno(), 0)
+
+        if exists:
+            self.scan()
+
+    # rebuilds the offset index of a segment written before
+    def scan(self):
+        while self.end + RECORD.size <= len(self.map):
+            (length,) = RECORD.unpack_from(self.map, self.end)
+            if length == 0 or self.end + RECORD.size + length > len(self.map):
+                break
+            self.offsets.append(self.end)
+            self.end += RECORD.size + length
+
+    def last_seq(self):
+        return self.base + len(self.offsets) - 1
+
+    # False when the record doesn't fit, the log starts a new segment then
+    def append(self, data):
+        end = self.end + RECORD.size + len(data)
+        # room for the zero length that marks the end
+        if end + RECORD.size > len(self.map):
+            return False
+        RECORD.pack_into(self.map, self.end, len(data))
+        self.map[self.end + RECORD.size:end] = data
+        self.offsets.append(self.end)
+        self.end = end
+        return True
+
+    # entries first .. last - 1, in one slice of the map or one read of the file
+    def read(self, first, last):
+        start = self.offsets[first - self.base]
+        stop = self.offsets[last - self.base] if last - self.base < len(self.offsets) else self.end
+        if self.map is not None:
+            data = self.map[start:stop]
+        else:
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                data = f.read(stop - start)
+
+        entries = []
+        pos = 0
+        while pos < len(data):
+            (length,) = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            entries.append(pickle.loads(data[pos:pos + length]))
+            pos += length
+        return entries
+
+    # full, nothing is written to it anymore: the map and its file descriptor go, reads go to the file
+    def seal(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+    def close(self):
+        self.seal()
+
+
+class SegmentLog:
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        os.makedirs(path, exist_ok=True)
+
+        # oldest first, self.bases[i] is self.segments[i].base (kept apart for bisect)
+        self.segments = []
+        self.bases = []
+        for file_name in sorted(os.listdir(path)):
+            if file_name.endswith(".seg"):
+                self.add_segment(Segment(os.path.join(path, file_name), int(file_name[:-4])))
+
+    def add_segment(self, segment):
+        if self.segments:
+            self.segments[-1].seal()
+        self.segments.append(segment)
+        self.bases.append(segment.base)
+
+    def first_seq(self):
+        return self.bases[0] if self.segments else None
+
+    def last_seq(self):
+        return self.segments[-1].last_seq() if self.segments else 0
+
+    def append(self, seq, entry):
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        if not self.segments or not self.segments[-1].append(data):
+            size = max(self.segment_size, RECORD.size * 2 + len(data))
+            self.add_segment(Segment(os.path.join(self.path, f"{seq:020d}.seg"), seq, size))
+            self.segments[-1].append(data)
+            self.evict()
+
+    # oldest segments go once there are too many
+    def evict(self):
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.pop(0)
+            self.bases.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    def get(self, seq):
+        entries = self.read(seq, seq + 1)
+        return entries[0] if entries else None
+
+    # the entries from first up to (not including) last that are still in the log, oldest first
+    def read(self, first, last):
+        entries = []
+        i = max(bisect.bisect_right(self.bases, first) - 1, 0)
+        while i < len(self.segments) and first < last:
+            segment = self.segments[i]
+            first = max(first, segment.base)
+            end = min(last, segment.last_seq() + 1)
+            if first < end:
+                entries.extend(segment.read(first, end))
+                first = end
+            i += 1
+        return entries
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    # the room is gone, so is its log
+    def delete(self):
+        self.close()
+        self.segments = []
+        self.bases = []
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+# log directory of one room, the name is hashed so any room name makes a valid file name
+def log_path(history_dir, room_name):
+    return os.path.join(history_dir, hashlib.sha1(room_name.encode()).hexdigest())
+
+
+class RoomHistory:
+
+    # log is an optional SegmentLog, its newest messages are loaded back into the ring
+    # open_log instead opens it the first time the history is used (a restored room nobody has joined yet holds no files)
+    def __init__(self, size=HISTORY_SIZE, log=None, open_log=None):
+        self.ring = collections.deque(maxlen=size)
+        self.log = None
+        self.open_log = open_log
+        self.lock = threading.Lock()
+        self.next_seq = 1
+
+        if log is not None:
+            self.load(log)
+
+    def load(self, log):
+        self.log = log
+        if log.segments:
+            self.next_seq = log.last_seq() + 1
+            self.ring.extend(log.read(max(log.first_seq(), self.next_seq - self.ring.maxlen), self.next_seq))
+
+    # called with the lock held
+    def opened(self):
+        if self.open_log is not None:
+            open_log, self.open_log = self.open_log, None
+            self.load(open_log())
+
+    # adds a message, returns its sequence number
+    def append(self, msg_type, sender, body, key_id=None):
+        with self.lock:
+            self.opened()
+            seq = self.next_seq
+            self.next_seq += 1
+            entry = [seq, msg_type, sender, body, key_id]
+            self.ring.append(entry)
+            if self.log is not None:
+                self.log.append(seq, entry)
+            return seq
+
+    def last_seq(self):
+        if self.open_log is not None:
+            with self.lock:
+                self.opened()
+        return self.next_seq - 1
+
+    # oldest message that can still be read
+    def first_seq(self):
+        if self.log is not None and self.log.segments:
+            return self.log.first_seq()
+        return self.ring[0][0] if self.ring else self.next_seq
+
+    # up to limit messages older than before (everything up to the newest if before is None), oldest first
+    def before(self, before=None, limit=SCROLLBACK):
+        with self.lock:
+            self.opened()
+            end = self.next_seq if before is None else min(before, self.next_seq)
+            start = max(self.first_seq(), end - limit)
+            # the ring holds consecutive sequence numbers, whatever is older than it comes from the log in one read
+            ring_first = self.ring[0][0] if self.ring else end
+            entries = []
+            if start < ring_first and self.log is not None:
+                entries = self.log.read(start, min(end, ring_first))
+            entries.extend(self.ring[seq - ring_first] for seq in range(max(start, ring_first), end))
+        return entries
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def delete(self):
+        with self.lock:
+            self.opened()
+        self.ring.clear()
+        if self.log is not None:
+            self.log.delete()
@@ -0,0 +1,165 @@
+# Relay metrics (relay_server.py --stats-socket PATH).
+# Counters and histograms are only kept while the relay runs with a stats socket, otherwise relay_server.metrics is None
+# and the message path skips them with a single check.
+#
+# every connection to the stats socket gets one JSON snapshot and is closed:
+#   UPTIME       seconds since the relay started
+#   COUNTERS     running totals (messages in by type, frames / bytes sent, ...)
+#   RATES        per second change of every counter since the previous snapshot
+#   HISTOGRAMS   fan-out latency in microseconds (all rooms and by room size), room sizes
+#   GAUGES       values right now: connections, threads, queue depths, bytes per frame
+#
+# read it with: python metrics.py PATH   (or anything that can read a Unix socket, e.g. socat - UNIX-CONNECT:PATH)
+
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+BUCKETS = 40  # power of two histogram buckets, the last one takes everything from 2**38 up
+
+
+# Histogram with power of two buckets: bucket i counts the values v with v.bit_length() == i (0 is bucket 0)
+# recording is one bit_length() and an index, percentiles are read back as the upper bound of their bucket
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = int(value)
+        self.counts[min(value.bit_length(), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # upper bound of the bucket holding the q-th quantile
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "COUNT": self.count,
+            "MEAN": self.total / self.count if self.count else 0.0,
+            "MAX": self.max,
+            "P50": self.percentile(0.5),
+            "P99": self.percentile(0.99),
+            "P999": self.percentile(0.999),
+            # upper bound of the bucket -> values in it
+            "BUCKETS": {(1 << i) - 1: count for i, count in enumerate(self.counts) if count},
+        }
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+
+        # name -> function, called for every snapshot
+        self.gauges = {}
+        # functions returning running totals kept elsewhere (the connections' queues), added to COUNTERS
+        self.sources = []
+
+        self.started = time.monotonic()
+        self.last = (self.started, {})  # time and counters of the previous snapshot, for RATES
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].record(value)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def add_source(self, fn):
+        self.sources.append(fn)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+        for source in self.sources:
+            for name, value in source().items():
+                counters[name] = counters.get(name, 0) + value
+
+        now = time.monotonic()
+        last_time, last_counters = self.last
+        self.last = (now, counters)
+        elapsed = max(now - last_time, 1e-9)
+
+        gauges = {}
+        for name, fn in self.gauges.items():
+            value = fn()
+            # histograms made on the spot (room sizes) go with the others
+            if isinstance(value, Histogram):
+                histograms[name] = value.snapshot()
+            else:
+                gauges[name] = value
+
+        return {
+            "UPTIME": now - self.started,
+            "COUNTERS": counters,
+            "RATES": {name: (value - last_counters.get(name, 0)) / elapsed for name, value in counters.items()},
+            "HISTOGRAMS": histograms,
+            "GAUGES": gauges,
+        }
+
+
+# answers every connection on the Unix socket at path with a JSON snapshot, on a daemon thread
+def serve_stats(path, metrics):
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def accept_loop():
+        while True:
+            conn, _ = server.accept()
+            try:
+                conn.sendall(json.dumps(metrics.snapshot()).encode() + b"\n")
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return server
+
+
+def read_stats(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python metrics.py STATS_SOCKET")
+    print(json.dumps(read_stats(sys.argv[1]), indent=2))
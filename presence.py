@@ -0,0 +1,105 @@
+# Join / leave notices, coalesced per room (relay_server.py --presence-window / --presence-cap).
+# A room's notices are held for --presence-window seconds from the first one, then go out as one BROADCAST per kind
+# ("12 users joined: alice, bob, ... and 2 more"), so a mass join costs every member a notice per window instead of one
+# per newcomer. Someone joining and leaving again within the window cancels out.
+# The ROSTER a join causes waits for the window too, one full ROSTER per window goes to every member however many joined.
+# A departure's ROSTER goes out right away: the members left rotate their sender keys from it (see e2e.py), that can't
+# wait, and it already has whoever joined since the last one.
+#
+# every window is the same length, so rooms come due in the order they were scheduled and a deque is all the timer
+# this needs; the flush itself runs on the room's actor like any other room job
+
+import collections
+import threading
+import time
+
+PRESENCE_WINDOW = 0.25  # seconds notices are held (0 = every join / leave is announced right away)
+PRESENCE_CAP = 10       # names listed in one notice, the rest are only counted
+
+JOINED = "joined"
+LEFT = "left"
+REMOVED = "removed"
+BANNED = "banned"
+
+# kind -> (one name, several)
+NOTICES = {
+    JOINED: ("Welcome to the chat room {}!", "{} users joined: {}"),
+    LEFT: ("{} has left the room.", "{} users left: {}"),
+    REMOVED: ("{} has been removed from the room by an admin.", "{} users were removed from the room by an admin: {}"),
+    BANNED: ("{} has been banned from the room by an admin.", "{} users were banned from the room by an admin: {}"),
+}
+
+
+def notice(kind, names, cap=PRESENCE_CAP):
+    one, several = NOTICES[kind]
+    if len(names) == 1:
+        return one.format(names[0])
+    listed = ", ".join(names[:cap])
+    if len(names) > cap:
+        listed += f" and {len(names) - cap} more"
+    return several.format(len(names), listed)
+
+
+class PresenceBatcher:
+
+    # run(room_name, fn, *args) runs fn as a job of the room's actor
+    def __init__(self, run, window=PRESENCE_WINDOW, cap=PRESENCE_CAP):
+        self.run_in_room = run
+        self.window = window
+        self.cap = cap
+        self.due = collections.deque()  # (time, room, clients) in the order they come due
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # called on the room's actor, the notice goes out with the others of this window
+    def add(self, room, clients, kind, name):
+        pending = room.presence_pending
+        # joined and left again (or the other way round) before anyone was told
+        if {pending.get(name), kind} == {JOINED, LEFT}:
+            del pending[name]
+        else:
+            pending[name] = kind
+
+        self.schedule(room, clients)
+
+    # called on the room's actor when someone joined, the ROSTER goes out with the window's notices
+    def add_roster(self, room, clients):
+        room.roster_pending = True
+        self.schedule(room, clients)
+
+    def schedule(self, room, clients):
+        if not room.presence_scheduled:
+            room.presence_scheduled = True
+            with self.cond:
+                self.due.append((time.monotonic() + self.window, room, clients))
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.due:
+                    self.cond.wait()
+                when, room, clients = self.due[0]
+                wait = when - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                self.due.popleft()
+            self.run_in_room(room.room_name, self.flush, room, clients)
+
+    # the notices held for room, one per kind, then the ROSTER if anyone joined since the last one
+    def flush(self, room, clients):
+        pending = room.presence_pending
+        room.presence_pending = {}
+        room.presence_scheduled = False
+
+        kinds = {}
+        for name, kind in pending.items():
+            kinds.setdefault(kind, []).append(name)
+        for kind, names in kinds.items():
+            room.send_message("BROADCAST", notice(kind, names, self.cap), clients)
+
+        if room.roster_pending:
+            room.send_roster(clients)
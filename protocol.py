@@ -1,28 +1,234 @@
-import pickle, struct
+import socket, struct
+import codec
+from compression import COMPRESSED, Inflater
 
 MAX_LEN = 10 * 1024 * 1024  # 10 MB safety cap
+READ_BUFFER_SIZE = 64 * 1024  # starting size of a connection's receive buffer
 
-def send_message(sock, obj):
-    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
-    sock.sendall(struct.pack("!I", len(payload)) + payload)
+HEADER = struct.Struct("!I")
 
+# most buffers one sendmsg call takes (IOV_MAX, 1024 on linux)
+MAX_IOVECS = getattr(socket, "IOV_MAX", None) or 1024
+
+# wire format a socket / Connection negotiated (a codec.py version number), raw sockets speak the current one
+def codec_of(sock):
+    return getattr(sock, "codec", codec.VERSION)
+
+# encodes obj into a length-prefixed frame in the given wire format
+# the frame is kept as (header, payload) so the payload is never copied just to glue the header on,
+# writers pass both parts to one vectored write
+def encode_frame(obj, wire_format=codec.VERSION):
+    payload = codec.encode(obj, wire_format)
+    return HEADER.pack(len(payload)), payload
+
+# every payload starts with its codec version, anything else (an old pickle client's 0x80) is a CodecError
+def decode_payload(payload):
+    return codec.decode(payload)
+
+# One outgoing message shared by every recipient of a broadcast.
+# It is encoded at most once per wire format, no matter how many sockets it goes to
+class Frame:
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.encoded = {}
+
+    def for_codec(self, wire_format):
+        data = self.encoded.get(wire_format)
+        if data is None:
+            data = self.encoded[wire_format] = encode_frame(self.obj, wire_format)
+        return data
+
+# writes every buffer with as few sendmsg (scatter / gather) calls as possible, returns the number of calls
+def send_buffers(sock, buffers):
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return 1
+
+    views = [memoryview(buf).cast("B") for buf in buffers if len(buf)]
+    calls = 0
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + MAX_IOVECS])
+        calls += 1
+        # skip what was written, a partial write can stop in the middle of a buffer
+        while i < len(views) and sent >= len(views[i]):
+            sent -= len(views[i])
+            i += 1
+        if sent:
+            views[i] = views[i][sent:]
+    return calls
+
+# raw sockets are written straight away, Connection objects (connection.py) queue the parts for their writer
+def write_frame(sock, parts):
+    if isinstance(sock, socket.socket):
+        send_buffers(sock, parts)
+    else:
+        sock.send_parts(parts)
+
+def send_frame(sock, frame):
+    write_frame(sock, frame.for_codec(codec_of(sock)))
+
+# a file chunk (attachments.py), Connection objects queue it behind their chat frames and call done once their writer took
+# it. Anything else has no such lane, it's written like any other frame and done is called straight away
+def send_bulk_frame(sock, frame, done=None):
+    parts = frame.for_codec(codec_of(sock))
+    if hasattr(sock, "send_bulk"):
+        sock.send_bulk(parts, done)
+        return
+    write_frame(sock, parts)
+    if done is not None:
+        done()
+
+# wire_format defaults to whatever the socket negotiated
+def send_message(sock, obj, wire_format=None):
+    if wire_format is None:
+        wire_format = codec_of(sock)
+    write_frame(sock, encode_frame(obj, wire_format))
+
+# reads exactly n bytes into one preallocated buffer
 def recv_exact(sock, n):
-    data = b""
-    while len(data) < n:
-        chunk = sock.recv(n - len(data))
+    data = bytearray(n)
+    view = memoryview(data)
+    got = 0
+    while got < n:
+        chunk = sock.recv_into(view[got:])
         if not chunk:
             return b""
-        data += chunk
+        got += chunk
     return data
 
+# one-off read of a single frame, long lived connections should use a FrameReader instead
+# (don't mix the two on one socket, the FrameReader may already hold the next frames)
 def recv_message(sock):
     header = recv_exact(sock, 4)
     if not header:
         return None
-    (length,) = struct.unpack("!I", header)
+    (length,) = HEADER.unpack(header)
+    if length & COMPRESSED:
+        raise ValueError("Compressed frames need a FrameReader")
     if length > MAX_LEN:
         raise ValueError(f"Message too large: {length}")
     payload = recv_exact(sock, length)
-    if not payload:
+    if not payload and length:
         return None
-    return pickle.loads(payload)
\ No newline at end of file
+    return decode_payload(payload)
+
+
+# Receive buffer of one connection. Bytes are read straight into a preallocated bytearray (recv_into / asyncio's
+# get_buffer) and frames are parsed in place with memoryviews, so a frame is never rebuilt chunk by chunk and
+# one read can hand back every complete frame that arrived with it.
+# The buffer grows for a frame bigger than itself (up to MAX_LEN) and shrinks back once it is drained.
+# Compressed frames (see compression.py) are inflated here, the peer's zlib stream is set up on the first one.
+class FrameBuffer:
+
+    def __init__(self, size=READ_BUFFER_SIZE):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first byte not parsed yet
+        self.end = 0    # end of the bytes received so far
+        self.inflater = None
+
+    # size of the frame at the front of the buffer (just the header if it's not complete yet)
+    def needed(self):
+        if self.end - self.start < 4:
+            return 4
+        (length,) = HEADER.unpack_from(self.buf, self.start)
+        length &= ~COMPRESSED
+        if length > MAX_LEN:
+            raise ValueError(f"Message too large: {length}")
+        return 4 + length
+
+    # free space to receive into, makes room for the whole pending frame first
+    def writable(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.size:
+                self.resize(self.size)
+
+        needed = self.needed()
+        if self.start + needed > len(self.buf) or self.end == len(self.buf):
+            self.compact(needed)
+
+        return self.view[self.end:]
+
+    # moves the unparsed bytes to the front, growing the buffer if the pending frame doesn't fit
+    def compact(self, needed):
+        pending = bytes(self.view[self.start:self.end])
+        if needed > len(self.buf):
+            self.resize(needed)
+        self.buf[:len(pending)] = pending
+        self.start = 0
+        self.end = len(pending)
+
+    def resize(self, size):
+        self.view.release()
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    # records that n bytes were received into the last writable() view
+    def filled(self, n):
+        self.end += n
+
+    # payload of the next complete frame as a memoryview into the buffer (bytes if it was compressed), or None
+    # the view is only valid until the next writable() call, decode it before reading again
+    def next_payload(self):
+        needed = self.needed()
+        if self.end - self.start < needed:
+            return None
+        compressed = self.buf[self.start] & 0x80
+        payload = self.view[self.start + 4:self.start + needed]
+        self.start += needed
+
+        if compressed:
+            if self.inflater is None:
+                self.inflater = Inflater()
+            return self.inflater.decompress(payload, MAX_LEN)
+        return payload
+
+    # every complete frame currently buffered
+    def payloads(self):
+        while True:
+            payload = self.next_payload()
+            if payload is None:
+                return
+            yield payload
+
+
+# blocking reader for a socket, one recv_into call can fill the buffer with several frames
+# which are then returned without touching the socket again
+# decode turns a payload into a message, the worker links of cluster.py bring their own
+class FrameReader:
+
+    def __init__(self, sock, size=READ_BUFFER_SIZE, decode=decode_payload):
+        self.sock = sock
+        self.buffer = FrameBuffer(size)
+        self.decode = decode
+
+    # reads more bytes from the socket, False once the peer has closed it
+    def fill(self):
+        n = self.sock.recv_into(self.buffer.writable())
+        if not n:
+            return False
+        self.buffer.filled(n)
+        return True
+
+    # next message (dict), None when the connection is closed
+    def recv_message(self):
+        while True:
+            payload = self.buffer.next_payload()
+            if payload is not None:
+                return self.decode(payload)
+            if not self.fill():
+                return None
+
+    # every message that is already buffered, reading from the socket only if there are none yet
+    # returns None when the connection is closed
+    def recv_messages(self):
+        while True:
+            messages = [self.decode(payload) for payload in self.buffer.payloads()]
+            if messages:
+                return messages
+            if not self.fill():
+                return None
@@ -0,0 +1,147 @@
+# Token bucket rate limits on what clients send (relay_server.py --user-rate / --room-rate / --conn-rate ...).
+# Three scopes, each with a messages/s and a bytes/s bucket (0 = no limit):
+#   connection   every frame the connection sends after registering
+#   user         chat lines (SEND / SEALED) of one user name
+#   room         chat lines going into one room, whoever sends them
+# bytes are the size of the chat line (the text, or the ciphertext of a SEALED message)
+#
+# over the limit the relay either delays the message (stops reading from that connection until the tokens are there),
+# drops it with a BROADCAST notice to the sender, or disconnects the sender (--over-limit).
+# A bucket is a few numbers, so a user / room / connection costs the same memory whatever it sends, and checking a message
+# only takes the locks of its own buckets, never the relay's.
+
+import threading
+import time
+
+DELAY = "delay"
+DROP = "drop"
+DISCONNECT = "disconnect"
+ACTIONS = (DELAY, DROP, DISCONNECT)
+OVER_LIMIT = DROP
+
+BURST = 2.0  # seconds worth of tokens a bucket can save up
+
+CHAT_MESSAGES = ("SEND", "SEALED")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    # seconds until n tokens will be there (0 = they are), refills the bucket but takes nothing
+    # anything bigger than the bucket passes once the bucket is full
+    def wait(self, n, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        n = min(n, self.burst)
+        return max(0.0, (n - self.tokens) / self.rate)
+
+    # takes n tokens, going into debt if they aren't all there (DELAY's waiting pays it back)
+    def take(self, n):
+        self.tokens -= min(n, self.burst)
+
+
+# the message and byte buckets of one user / room / connection, lock is held around wait() and take()
+class Buckets:
+    __slots__ = ("messages", "bytes", "lock")
+
+    def __init__(self, messages, bytes, lock):
+        self.messages = messages
+        self.bytes = bytes
+        self.lock = lock
+
+    def wait(self, size, now):
+        wait = self.messages.wait(1, now) if self.messages is not None else 0.0
+        if self.bytes is not None:
+            wait = max(wait, self.bytes.wait(size, now))
+        return wait
+
+    def take(self, size):
+        if self.messages is not None:
+            self.messages.take(1)
+        if self.bytes is not None:
+            self.bytes.take(size)
+
+
+# messages/s and bytes/s for one scope, 0 = unlimited
+class Limit:
+
+    def __init__(self, messages=0.0, bytes=0.0, burst=BURST):
+        self.messages = messages
+        self.bytes = bytes
+        self.burst = burst
+
+    def __bool__(self):
+        return bool(self.messages or self.bytes)
+
+    def buckets(self, now):
+        return Buckets(
+            TokenBucket(self.messages, max(1.0, self.messages * self.burst), now) if self.messages else None,
+            TokenBucket(self.bytes, max(1.0, self.bytes * self.burst), now) if self.bytes else None,
+            threading.Lock(),
+        )
+
+
+def message_size(msg):
+    body = msg.get("MESSAGE") if msg.get("TYPE") == "SEND" else msg.get("CIPHERTEXT")
+    return len(body) if isinstance(body, (str, bytes)) else 0
+
+
+class RateLimiter:
+
+    def __init__(self, user=None, room=None, connection=None, action=OVER_LIMIT):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown over-limit action: {action}")
+        self.user = user or Limit()
+        self.room = room or Limit()
+        self.connection = connection or Limit()
+        self.action = action
+
+        self.users = {}  # user name -> Buckets, dropped when the user disconnects
+
+    # seconds msg has to wait before it may be handled (0 = right away)
+    # conn is None for a message forwarded by another worker, its connection and user were checked there
+    # room is the chat_room it goes to if that room is here
+    # every bucket is checked before any is taken from: a message one limit drops costs nothing in the others
+    # (reserve takes from all of them anyway, that's how DELAY queues up)
+    def check(self, conn, name, msg, room=None, reserve=False):
+        now = time.monotonic()
+        chat = msg.get("TYPE") in CHAT_MESSAGES
+        size = message_size(msg) if chat else 0
+        buckets = []  # always locked in this order (connection, user, room) so two checks can't deadlock
+
+        if conn is not None and self.connection:
+            if conn.rate_limits is None:
+                conn.rate_limits = self.connection.buckets(now)
+            buckets.append(conn.rate_limits)
+
+        if chat and conn is not None and name is not None and self.user:
+            user_buckets = self.users.get(name)
+            if user_buckets is None:
+                user_buckets = self.users.setdefault(name, self.user.buckets(now))
+            buckets.append(user_buckets)
+
+        if chat and room is not None and self.room:
+            if room.rate_limits is None:
+                room.rate_limits = self.room.buckets(now)
+            buckets.append(room.rate_limits)
+
+        for scope in buckets:
+            scope.lock.acquire()
+        try:
+            wait = max((scope.wait(size, now) for scope in buckets), default=0.0)
+            if wait <= 0 or reserve:
+                for scope in buckets:
+                    scope.take(size)
+        finally:
+            for scope in reversed(buckets):
+                scope.lock.release()
+        return wait
+
+    def forget(self, name):
+        self.users.pop(name, None)
@@ -1,45 +1,217 @@
+import argparse
+import asyncio
+import math
+import multiprocessing
+import multiprocessing.connection
+import shutil
+import signal
 import socket
+import sys
+import tempfile
+import time
 
 # we need threading to stop multiple clients using same function anyway
 import threading
-from chat_room import chat_room
-from protocol import send_message, recv_message
+import actors
+import attachments
+import codec
+import commands
+import compression
+import heartbeat
+import history
+import metrics as relay_metrics
+import presence
+import ratelimit
+import sessions
+import snapshot
+from chat_room import chat_room, restore_room
+from directory import RoomDirectory
+from protocol import send_message, send_frame, write_frame, decode_payload, FrameBuffer, FrameReader, HEADER
 from client_info import Client
+from cluster import Cluster, RemoteConnection, shard_of
+from sessions import SessionBuffer
+from connection import Connection, AsyncConnection, OVERFLOW_POLICIES, QUEUE_LIMIT, OVERFLOW_POLICY, BLOCK_TIMEOUT
+from connection import FLUSH_FRAMES, FLUSH_BYTES, FLUSH_LATENCY
 
 HOST = "0.0.0.0"   # Listen on all network interfaces
 PORT = 5000        # Port clients will connect to
 
 clients = dict()     # dict, maps user name -> client obj
 chat_rooms = dict()  # Dictionary to hold chat room instances, maps room name -> Room instance
-lock = threading.Lock()
+user_rooms = dict()  # reverse index, maps user name -> name of the room they are in (kept up to date by chat_room)
+lock = threading.RLock()  # only used when room jobs run on the thread that hands them in (--room-workers 0)
+directory = RoomDirectory()  # room summaries handed out to clients choosing a room
+
+# settings for every connection's outbound queue and writer, see connection.py
+connection_options = {
+    "limit": QUEUE_LIMIT, "policy": OVERFLOW_POLICY, "block_timeout": BLOCK_TIMEOUT,
+    "flush_frames": FLUSH_FRAMES, "flush_bytes": FLUSH_BYTES, "flush_latency": FLUSH_LATENCY,
+}
+
+# room actors, see actors.py: every room's jobs run in order on a fixed pool of threads (None = --room-workers 0)
+room_options = {"workers": actors.ROOM_WORKERS, "batch": actors.BATCH}
+rooms = None
+
+def start_rooms():
+    global rooms
+    if room_options["workers"] > 0:
+        rooms = actors.ActorPool(room_options["workers"], room_options["batch"])
+        rooms.start()
+
+# runs fn(*args) as a job of the room's actor, or right here without a pool
+# the reading threads, the presence batcher and disconnect cleanup all hand in room jobs, without a pool they take turns
+# on the lock (reentrant: a job that hands in another runs it right away, as before)
+def in_room(room_name, fn, *args):
+    if rooms is not None:
+        rooms.submit(room_name, fn, *args)
+    else:
+        with lock:
+            fn(*args)
+
+# join / leave notices and join rosters are held for a short window and sent together, see presence.py (None when --presence-window is 0)
+presence_options = {"window": presence.PRESENCE_WINDOW, "cap": presence.PRESENCE_CAP}
+presence_batcher = None
+
+# run(room_name, fn, *args) runs a batch of notices where room jobs run (hopping onto the event loop in async mode
+# when rooms run there)
+def start_presence(run=None):
+    global presence_batcher
+    if presence_options["window"] > 0:
+        presence_batcher = presence.PresenceBatcher(run or in_room, presence_options["window"], presence_options["cap"])
+        presence_batcher.start()
+
+# set in each worker process of a multi-process relay (--workers), see cluster.py
+cluster = None
+
+# keepalives and the idle connection reaper, see heartbeat.py (None when --idle-timeout is 0)
+heartbeat_options = {"ping_interval": heartbeat.PING_INTERVAL, "idle_timeout": heartbeat.IDLE_TIMEOUT, "tick": heartbeat.TICK}
+reaper = None
+
+def start_reaper():
+    global reaper
+    if heartbeat_options["idle_timeout"] > 0:
+        reaper = heartbeat.Reaper(**heartbeat_options)
+        reaper.start()
+
+# session resumption, see sessions.py (None when --session-grace is 0)
+session_options = {"grace": sessions.GRACE, "limit": sessions.BUFFER_LIMIT}
+session_store = None
+
+# expired(name, buffer) runs wherever relay state is touched (the event loop in async mode)
+def start_sessions(expired=None):
+    global session_store
+    if session_options["grace"] > 0:
+        session_store = sessions.SessionStore(session_options["grace"], session_options["limit"], heartbeat_options["tick"])
+        session_store.start(expired or session_expired)
+
+# token bucket limits on what clients send, see ratelimit.py (None when no limit is set)
+ratelimit_options = {
+    "user": ratelimit.Limit(), "room": ratelimit.Limit(), "connection": ratelimit.Limit(), "action": ratelimit.OVER_LIMIT,
+}
+limiter = None
+
+# counters and histograms, only kept when the relay runs with --stats-socket (see metrics.py)
+metrics = None
+stats_options = {"socket": None}
+
+# fan-out latency is also kept per room size, rooms up to each of these sizes get their own histogram
+FANOUT_SIZES = (2, 10, 100, 1000)
+
+# messages that belong to a room, in a multi-process relay they are handled by the worker that owns the room
+ROOM_MESSAGES = ("CREATE_ROOM", "JOIN_ROOM", "SEND", "COMMAND", "SENDER_KEY", "SEALED", "GET_HISTORY",
+                 "ATTACH_START", "ATTACH_CHUNK", "ATTACH_END")
+
+# compression the relay offers its clients, see compression.py
+compression_options = {"methods": compression.METHODS, "threshold": compression.THRESHOLD, "level": compression.LEVEL}
+
+# room history, see history.py (no directory = in memory only)
+history_options = {
+    "size": history.HISTORY_SIZE, "scrollback": history.SCROLLBACK, "directory": None,
+    "segment_size": history.SEGMENT_SIZE, "max_segments": history.MAX_SEGMENTS,
+}
+
+# the room's log is only opened once the room is used (joined, or a message goes into it)
+def room_history(room_name):
+    open_log = None
+    if history_options["directory"]:
+        path = history.log_path(history_options["directory"], room_name)
+        open_log = lambda: history.SegmentLog(path, history_options["segment_size"], history_options["max_segments"])
+    return history.RoomHistory(history_options["size"], open_log=open_log)
+
+# room snapshots, see snapshot.py (no directory = rooms are lost on restart)
+snapshot_options = {"directory": None, "interval": snapshot.SNAPSHOT_INTERVAL, "checkpoint_every": snapshot.CHECKPOINT_EVERY}
+restored = dict()  # room name -> snapshot record, read in main() before the server (or its workers) start
+store = None       # this process's SnapshotStore
+
+# brings back the rooms of the last run (the ones this worker owns), called before the server starts listening
+def restore_rooms(worker_id=0, workers=1):
+    global store
+    if not snapshot_options["directory"]:
+        return
+
+    own = {room_name: record for room_name, record in restored.items() if workers == 1 or shard_of(room_name, workers) == worker_id}
+    store = snapshot.SnapshotStore(snapshot_options["directory"], snapshot.store_name(worker_id),
+                                   snapshot_options["interval"], snapshot_options["checkpoint_every"], own)
+
+    start = time.perf_counter()
+    with snapshot.bulk_load():
+        for room_name, record in own.items():
+            chat_rooms[room_name] = restore_room(record, directory=directory, user_rooms=user_rooms, history=room_history(room_name),
+                                                 scrollback=history_options["scrollback"], store=store, presence=presence_batcher)
+    print(f"[+] Restored {len(own)} rooms in {time.perf_counter() - start:.3f}s")
+
+    store.start()
 
 def create_room(room_name, owner, password=None):
     # create a new chat_room obj and assign respective room name to room object
 
     # check to see if the room already exists
     if room_name in chat_rooms:
-        send_message(clients[owner].get_socket(), {"TYPE": "REJOIN", "MESSAGE": "Room already exists!"})
-        return
+        send_message(clients[owner].get_socket(), rejoin_message("Room already exists!"))
+        return None
     
-    temp_room = chat_room(room_name, owner, password)
+    temp_room = chat_room(room_name, owner, password, directory=directory, user_rooms=user_rooms,
+                          history=room_history(room_name), scrollback=history_options["scrollback"], store=store, presence=presence_batcher)
     chat_rooms[room_name] = temp_room
     # Prints out the room name and its creator
+    return temp_room
+
+# sends a client back to room selection, it catches up on the room listing from DIRECTORY_VERSION
+def rejoin_message(message):
+    return {"TYPE": "REJOIN", "MESSAGE": message, "DIRECTORY_VERSION": directory.version}
 
 # the computation for assigning a user to a room, prompts user to join or create one
+# a user is in one room at a time: a second CREATE / JOIN used to leave a ghost member behind in the first room (in its
+# rosters, recipients and member count, never cleaned up). The claim in user_rooms is made first and in one step, so a JOIN
+# for another room running on that room's actor at the same time can't get in too. Returns the room the user is in now
 def assign_room(conn, name, msg):
     room_name = msg["ROOM_NAME"] if msg else None
 
+    current = user_rooms.setdefault(name, room_name)
+    if current != room_name or (room_name in chat_rooms and chat_rooms[room_name].in_room(name)):
+        send_message(conn, {"TYPE": "BROADCAST", "MESSAGE": "You are already in a room, !leave it first."})
+        return current
+
+    joined = enter_room(conn, name, msg, room_name)
+    # didn't get in, the claim is given back
+    if joined is None and user_rooms.get(name) == room_name:
+        del user_rooms[name]
+    return joined
+
+def enter_room(conn, name, msg, room_name):
+
     # handles whether the client wants to join or create a room
     if msg and msg.get("TYPE") == "CREATE_ROOM":
 
-        create_room(room_name, name, msg.get("PASSWORD"))
+        if not create_room(room_name, name, msg.get("PASSWORD")):
+            return None
         
     elif msg and msg.get("TYPE") == "JOIN_ROOM":
         # if user intends to join a room, it utilizes the add_user() function and adds the respective user
         
         # handles if the user is banned from the room or if the room does not exist
         if room_name not in chat_rooms or name in chat_rooms[room_name].ban_list:
-            send_message(conn, {"TYPE": "REJOIN", "CHAT_ROOMS": chat_rooms, "MESSAGE": "Room does not exist or you are banned from it!"})
+            send_message(conn, rejoin_message("Room does not exist or you are banned from it!"))
             return None
         
         room = chat_rooms.get(room_name)
@@ -51,109 +223,730 @@ def assign_room(conn, name, msg):
         else:
             return None
 
+        # wrong password, add_user already sent the REJOIN
+        if not room.in_room(name):
+            return None
+
     print(f"[DEBUG] {name} has joined room: {room_name}")
     chat_rooms[room_name].broadcast(clients, name)
     send_message(conn, {"TYPE": "CONNECTED", "ROOM_NAME": room_name})
+    # what was said before they got here
+    chat_rooms[room_name].send_scrollback(conn)
+    # everyone gets the new member list, key exchange for the newcomer starts from there
+    chat_rooms[room_name].send_join_roster(clients)
 
     return room_name
 
-# Every client thats connected to the relay server will have an instance of this (the instance is hosted here ofc)
-def handle_client(conn, addr):
-    # prints the ip address of the client that connects to the relay
-    print(f"[+] Connected: {addr}")
-
-    msg = recv_message(conn)
+# checks the NAME registration message, registered(name) is called once it's settled (name None if it was refused)
+# an accepted name is added to clients right away, the client then picks a room with CREATE_ROOM / JOIN_ROOM
+# with several workers a name that hashes to another worker is reserved over the link: nothing waits for the answer,
+# registered is called when it comes in (where relay state is touched, see Cluster.start)
+def register_name(conn, msg, registered):
     name = None
+    version = None
 
     # recieves the name from the client
     if msg:
         name = msg.get("NAME")
 
-    # if the name is empty, then it closes the TCP socket of that client and returns
+        # the highest codec version both sides speak, from here on (including the errors below)
+        version = codec.negotiate(msg.get("CODECS"))
+        if version:
+            conn.codec = version
+
+    # if the name is empty, the caller closes the connection of that client
     if not name:
         send_message(conn, {"TYPE": "ERROR", "MESSAGE": "Invalid registration message"})
-        conn.close()
+        registered(None)
         return
-        
+
+    # a client without a codec version in common can't read anything the relay sends
+    if not version:
+        send_message(conn, {"TYPE": "ERROR", "MESSAGE": "Unsupported client version"})
+        registered(None)
+        return
+
+    # a client back from a dropped connection picks up its session, if it's still there
+    if session_store is not None and name in clients and session_store.valid(name, msg.get("SESSION")):
+        if resume_session(conn, name, msg):
+            registered(name)
+            return
+
     # checks if the name is already taken, gives an "ERROR" type message
-    if name in clients:
+    # (a member of one of our rooms connected to another worker is left to the registry, it may be back here)
+    if name in clients and not isinstance(clients[name].get_socket(), RemoteConnection):
         send_message(conn, {"TYPE": "ERROR", "MESSAGE": "Name already taken"})
-        conn.close()
+        registered(None)
         return
 
-    # send message with chat_room info
-    send_message(conn, {"CHAT_ROOMS": chat_rooms, "MESSAGE": f"Welcome to the VPS server, {name}!"})
+    if cluster is None:
+        registered(accept_name(conn, name, msg))
+        return
+
+    # with several workers the name also has to be free on all of them, or be the session of the token on another worker
+    def reserved(ok, resumed):
+        if resumed:
+            registered(accept_handed_off(conn, name, msg))
+        elif ok:
+            registered(accept_name(conn, name, msg))
+        else:
+            send_message(conn, {"TYPE": "ERROR", "MESSAGE": "Name already taken"})
+            registered(None)
 
-    # receives msg for room assignment
-    client_registration = recv_message(conn)
+    token = msg.get("SESSION")
+    cluster.reserve(name, reserved, token if session_store is not None and isinstance(token, str) else None, conn.codec)
 
-    # assigns the client as a key - value pair in the clients dict
-    clients[name] = Client(conn, name, client_registration)
-    chat_room_name = assign_room(conn, name, client_registration)
+# register_name for a reading thread, which has nothing else to do until the name is settled
+def register_name_blocking(conn, msg):
+    answer = [threading.Event(), None]
+
+    def registered(name):
+        answer[1] = name
+        answer[0].set()
+
+    register_name(conn, msg, registered)
+    answer[0].wait()
+    return answer[1]
+
+# the name is free: the client is added and welcomed, returns its name
+def accept_name(conn, name, msg):
+    # the client's public key for end-to-end encryption, only passed on to the other members of its rooms
+    public_key = msg.get("PUBLIC_KEY")
+    if not isinstance(public_key, bytes):
+        public_key = None
 
     # maps client name -> client object
+    clients[name] = Client(conn, name, None, public_key)
+
+    # the token the client can resume this session with after its connection drops
+    token = session_store.issue(name) if session_store is not None else None
+
+    # send the welcome message followed by the first page of the room listing
+    welcome(conn, msg, {"MESSAGE": f"Welcome to the VPS server, {name}!", "SESSION": token})
+    send_frame(conn, directory.page(0))
+    return name
+
+# name's session came over from the worker it was on (see hand_off): welcomed back, the frames kept for it follow
+# from that worker and its rooms reach it through us from now on
+def accept_handed_off(conn, name, msg):
+    public_key = msg.get("PUBLIC_KEY")
+    if not isinstance(public_key, bytes):
+        public_key = None
+
+    # a member of a room here already, it stays one
+    client = clients.get(name)
+    if client is not None:
+        swap_connection(client, conn)
+    else:
+        clients[name] = Client(conn, name, None, public_key)
+
+    token = session_store.issue(name, msg.get("SESSION"))
+    welcome(conn, msg, {"MESSAGE": f"Welcome back, {name}!", "SESSION": token, "RESUMED": True})
+    return name
+
+# the WELCOME, with the wire format and compression picked for the client, compression starts right after it
+# GRACE tells the client how long (whole seconds) its session outlives a dropped connection
+def welcome(conn, msg, fields):
+    method = compression.negotiate(msg.get("COMPRESSION"), compression_options["methods"])
+    grace = math.ceil(session_options["grace"]) if session_store is not None else 0
+    send_message(conn, {"TYPE": "WELCOME", "CODEC": conn.codec, "DIRECTORY_VERSION": directory.version, "COMPRESSION": method, "GRACE": grace, **fields})
+    if method:
+        conn.deflater = compression.Deflater(method, compression_options["threshold"], compression_options["level"])
+
+# name is back on conn with its session token: it gets what was sent while it was away and everything after,
+# it's still in its room with its roles, nobody else hears about it. False if the session expired in the meantime
+def resume_session(conn, name, msg):
+    client = clients[name]
+    old = client.get_socket()
+    # the old connection still looks alive (the relay hasn't noticed it's gone yet), the client knows better
+    if not isinstance(old, SessionBuffer):
+        detach_client(old, name)
+        old.abort()
+
+    buffer = session_store.resume(name)
+    if buffer is None:
+        return False
+
+    welcome(conn, msg, {"MESSAGE": f"Welcome back, {name}!", "SESSION": msg.get("SESSION"), "RESUMED": True})
+    missed = buffer.attach(conn)
+    swap_connection(client, conn)
+    if missed:
+        send_message(conn, {"TYPE": "BROADCAST", "MESSAGE": f"{missed} messages were missed while you were away, !history pages back through them."})
+    return True
+
+# name is back with its session token on the worker in msg: the session goes there if it's still ours and the token
+# fits, and we reach the client through that worker from now on (like a member of our rooms connected there)
+def hand_off(msg):
+    name = msg.get("NAME")
+    client = clients.get(name)
+    conn = client.get_socket() if client is not None else None
+    if session_store is None or conn is None or isinstance(conn, RemoteConnection) or not session_store.valid(name, msg.get("TOKEN")):
+        cluster.refuse(msg)
+        return
+    if not isinstance(conn, SessionBuffer):
+        detach_client(conn, name)
+        conn.abort()
+
+    buffer = session_store.resume(name)
+    if buffer is None:
+        cluster.refuse(msg)
+        return
+    session_store.forget(name)
+
+    remote = cluster.hand_off(msg)
+    missed = buffer.attach(remote)
+    swap_connection(client, remote)
+    if missed:
+        send_message(remote, {"TYPE": "BROADCAST", "MESSAGE": f"{missed} messages were missed while you were away, !history pages back through them."})
+
+# points client at a new connection, the room's fan-out picks it up from its next delivery
+def swap_connection(client, conn):
+    client.change_socket(conn)
+    room = chat_rooms.get(user_rooms.get(client.get_name()))
+    if room is not None:
+        room.connection_changed()
+
+# name's connection dropped: a SessionBuffer takes its place for the grace period, False if it has no session
+def detach_client(conn, name):
+    if session_store is None:
+        return False
+    buffer = session_store.detach(name, conn.codec)
+    if buffer is None:
+        return False
+    swap_connection(clients[name], buffer)
+    # whatever the connection hadn't written yet, deliveries after the swap already went to the buffer
+    buffer.prepend(conn.queue.close(discard=True))
+    return True
+
+# a registered client's connection is gone, shared by the thread and event-loop handlers
+def client_disconnected(conn, name):
+    client = clients.get(name)
+    # resumed on another connection already
+    if client is None or client.get_socket() is not conn:
+        return
+    if not detach_client(conn, name):
+        cleanup_client(name)
+
+# nobody came back for the session, the user is cleaned up like any disconnect
+def session_expired(name, buffer):
+    client = clients.get(name)
+    if client is not None and client.get_socket() is buffer:
+        print(f"[-] Session of {name} expired")
+        cleanup_client(name)
+
+# handles one message from a registered client
+def handle_message(conn, name, msg):
+    mType = msg.get("TYPE")
+
+    started = None
+    if metrics is not None:
+        started = time.perf_counter()
+        metrics.count("MESSAGES_IN")
+        metrics.count(f"IN_{mType}")
+
+    # a room owned by another worker, it handles the message and answers the client through us
+    if cluster is not None and mType in ROOM_MESSAGES and isinstance(msg.get("ROOM_NAME"), str):
+        shard = cluster.shard_of(msg["ROOM_NAME"])
+        if shard != cluster.worker_id:
+            cluster.forward(shard, clients[name], msg)
+            return
+
+    # everything that touches a room runs on the room's actor, one job at a time and in the order they came in
+    if mType in ROOM_MESSAGES:
+        room_name = msg.get("ROOM_NAME")
+        if isinstance(room_name, str):
+            in_room(room_name, handle_room_message, conn, name, msg, started)
+        return
+
+    match mType:
+        # keepalives, receiving anything already counts as a sign of life
+        case "PING":
+            send_message(conn, {"TYPE": "PONG"})
+
+        # the client is leaving for good, its session isn't kept
+        case "LOGOUT":
+            if session_store is not None:
+                session_store.forget(name)
+            conn.close()
+
+        case "LIST_ROOMS":
+            # a page of the room listing, or just the changes since the listing the client already has
+            send_frame(conn, directory.listing(msg.get("PAGE", 0), msg.get("SINCE")))
+
+# a room message (ROOM_MESSAGES), run by the room's actor
+def handle_room_message(conn, name, msg, started):
+    # the sender disconnected (or logged in again) before the message's turn came
+    client = clients.get(name)
+    if client is None or client.get_socket() is not conn:
+        return
+
+    mType = msg.get("TYPE")
+    match mType:
+        case "CREATE_ROOM" | "JOIN_ROOM":
+            print("CREATING ROOM!!")
+            client.change_room(assign_room(conn, name, msg))
+
+        case "SEND":
+            # operation for a user sending a message to the room they are in
+            message = msg.get("MESSAGE")
+            room_name = msg.get("ROOM_NAME")
+            room = chat_rooms.get(room_name)
+            # chat lines are never parsed, whatever they start with
+            if room is not None and isinstance(message, str):
+                room.send_message("RECEIVE", message, clients, from_user=name)
+                if metrics is not None:
+                    record_fanout(room, started)
+
+        # !role, !leave, !ban ... (see commands.py)
+        case "COMMAND":
+            room = chat_rooms.get(msg.get("ROOM_NAME"))
+            if room is not None:
+                commands.run(room, clients, name, msg, chat_rooms)
+
+        # end-to-end encryption, the relay only routes these (see e2e.py)
+        case "SENDER_KEY":
+            room_name = msg.get("ROOM_NAME")
+            if room_name in chat_rooms:
+                chat_rooms[room_name].send_sender_keys(clients, name, msg)
+
+        case "SEALED":
+            room_name = msg.get("ROOM_NAME")
+            room = chat_rooms.get(room_name)
+            if room is not None:
+                room.send_sealed(clients, name, msg)
+                if metrics is not None:
+                    record_fanout(room, started)
+
+        case "GET_HISTORY":
+            room_name = msg.get("ROOM_NAME")
+            if room_name in chat_rooms:
+                chat_rooms[room_name].send_history(clients, name, msg)
+
+        # files streamed through the room (see attachments.py)
+        case "ATTACH_START" | "ATTACH_CHUNK" | "ATTACH_END":
+            room = chat_rooms.get(msg.get("ROOM_NAME"))
+            if room is not None:
+                ATTACH_HANDLERS[mType](room, clients, name, conn, msg)
+
+ATTACH_HANDLERS = {"ATTACH_START": attachments.start, "ATTACH_CHUNK": attachments.chunk, "ATTACH_END": attachments.end}
+
+# rate limits on a message from conn, checked before it's handled (and before any fan-out, without a relay-wide lock):
+# returns the seconds it has to wait (0 = handle it now) or None when it was dropped or the sender was disconnected
+# remote = forwarded by another worker, the connection and user were checked there so only the room's limit is left,
+# and a message over it is dropped, waiting here would hold up the link for everyone behind it
+def admit(conn, name, msg, remote=False):
+    room_name = msg.get("ROOM_NAME")
+    room = chat_rooms.get(room_name) if isinstance(room_name, str) else None
+    delay = limiter.action == ratelimit.DELAY and not remote
+
+    wait = limiter.check(None if remote else conn, name, msg, room, reserve=delay)
+    if wait <= 0:
+        return 0.0
+
+    if metrics is not None:
+        metrics.count("RATE_LIMITED")
+    if delay:
+        return wait
+    if limiter.action == ratelimit.DISCONNECT and not remote:
+        print(f"[-] Disconnecting {name}: over the rate limit")
+        conn.abort()
+        return None
+    send_message(conn, {"TYPE": "BROADCAST", "MESSAGE": "You are sending messages too fast, your last message was dropped."})
+    return None
+
+# time from reading a room message to queueing it for the last member, in microseconds
+# (the writers send it from there, see connection.py)
+def record_fanout(room, started):
+    elapsed = (time.perf_counter() - started) * 1e6
+    metrics.observe("FANOUT_US", elapsed)
+
+    members = len(room.users)
+    for size in FANOUT_SIZES:
+        if members <= size:
+            metrics.observe(f"FANOUT_US_UP_TO_{size}_MEMBERS", elapsed)
+            break
+    else:
+        metrics.observe(f"FANOUT_US_OVER_{FANOUT_SIZES[-1]}_MEMBERS", elapsed)
+
+def room_sizes():
+    sizes = relay_metrics.Histogram()
+    for room in list(chat_rooms.values()):
+        sizes.record(len(room.users))
+    return sizes
+
+# starts collecting metrics and answering on the stats socket (one per worker in a multi-process relay)
+def start_metrics(path):
+    global metrics
+    if cluster is not None:
+        path = f"{path}.{cluster.worker_id}"
+
+    metrics = relay_metrics.Metrics()
+    stats = {}
+
+    # one pass over the connections per snapshot feeds the counters and the gauges below
+    def outbound():
+        stats.update(outbound_stats())
+        return {"MESSAGES_OUT": stats["SENT"], "BYTES_OUT": stats["BYTES_SENT"], "DROPPED": stats["DROPPED"]}
+
+    metrics.add_source(outbound)
+    metrics.gauge("CONNECTIONS", lambda: stats["CONNECTIONS"])
+    metrics.gauge("THREADS", threading.active_count)
+    metrics.gauge("ROOMS", lambda: len(chat_rooms))
+    metrics.gauge("QUEUE_DEPTH", lambda: stats["DEPTH"])
+    metrics.gauge("MAX_QUEUE_DEPTH", lambda: stats["MAX_DEPTH"])
+    metrics.gauge("SLOW_CONSUMERS", lambda: stats["SLOW_CONSUMERS"])
+    metrics.gauge("FRAMES_PER_WRITE", lambda: stats["FRAMES_PER_WRITE"])
+    metrics.gauge("BYTES_PER_FRAME", lambda: stats["BYTES_SENT"] / stats["SENT"] if stats["SENT"] else 0.0)
+    metrics.gauge("ROOM_SIZES", room_sizes)
+    metrics.gauge("REAPED", lambda: reaper.reaped if reaper is not None else 0)
+    # room jobs waiting for their actor, and rooms waiting for a worker
+    metrics.gauge("ROOM_BACKLOG", lambda: rooms.backlog()[0] if rooms is not None else 0)
+    metrics.gauge("ROOMS_WAITING", lambda: rooms.backlog()[1] if rooms is not None else 0)
+
+    relay_metrics.serve_stats(path, metrics)
+    print(f"[+] Stats on {path}")
+
+# cleanup on disconnect, shared by the thread and event-loop handlers
+def cleanup_client(name):
+    client = clients.get(name)
+    # if the user was in a room, their room's actor takes them out (found through the reverse index, no searching)
+    # and drops them from clients in the same job: a room job never sees a member without a Client (a !remove running
+    # in between used to find the member but not its connection, and the leave that followed found nobody to announce)
+    chat_room_name = user_rooms.get(name)
+    if chat_room_name:
+        in_room(chat_room_name, leave_room, name, chat_room_name, client)
+    else:
+        forget_client(name, client)
+
+    if limiter is not None:
+        limiter.forget(name)
+
+    # one of our own clients, the workers it reached and the name registry are told too
+    if cluster is not None and client is not None and not isinstance(client.get_socket(), RemoteConnection):
+        cluster.client_gone(name)
+
+    if session_store is not None:
+        session_store.forget(name)
+
+    # what the connection sent stays in the totals after it's gone
+    if metrics is not None and client is not None and not isinstance(client.get_socket(), (RemoteConnection, SessionBuffer)):
+        stats = client.get_socket().stats()
+        metrics.count("MESSAGES_OUT", stats["SENT"])
+        metrics.count("BYTES_OUT", stats["BYTES_SENT"])
+        metrics.count("DROPPED", stats["DROPPED"])
+
+# only that login's Client goes, not one a new login with the same name got in the meantime
+def forget_client(name, client):
+    if client is not None and clients.get(name) is client:
+        del clients[name]
+
+# a disconnected user leaves their room, run by the room's actor
+def leave_room(name, chat_room_name, client=None):
+    room = chat_rooms.get(chat_room_name)
+    if room is None:
+        forget_client(name, client)
+        return
+
+    if name in room.users:
+        room.remove_user(name)
+        # send a message to the rest of the users that the user has left
+        room.announce(clients, presence.LEFT, name)
+        # the ones still there rotate their sender keys
+        room.send_roster(clients)
+    forget_client(name, client)
+
+    if len(room.users) == 0:
+        del chat_rooms[chat_room_name]
+        print(f"[+] Room '{chat_room_name}' deleted due to no users remaining.")
+
+# messages from the other workers (cluster.py)
+def handle_peer_message(msg):
+    name = msg.get("NAME")
+
+    match msg.get("TYPE"):
+        case "CLIENT":
+            # room traffic from a client of another worker, it gets a Client here that sends through that worker
+            client = clients.get(name)
+            conn = client.get_socket() if client else None
+            if client is not None and not isinstance(conn, RemoteConnection):
+                return
+            if conn is None or conn.session != msg.get("SESSION"):
+                # left over from an earlier login with the same name
+                if conn is not None:
+                    cleanup_client(name)
+                conn = cluster.remote_connection(msg)
+                clients[name] = Client(conn, name, None, msg.get("PUBLIC_KEY"))
+            inner = msg.get("MESSAGE") or {}
+            if limiter is not None and admit(conn, name, inner, remote=True) is None:
+                return
+            handle_message(conn, name, inner)
+
+        case "DELIVER":
+            # a frame from a room on another worker, for some of our clients
+            # (one whose session was just handed to another worker gets it through there, once: it's not passed on again)
+            payload = msg.get("PAYLOAD")
+            parts = (HEADER.pack(len(payload)), payload)
+            for user in msg.get("USERS", ()):
+                client = clients.get(user)
+                if client is None:
+                    continue
+                conn = client.get_socket()
+                if not isinstance(conn, RemoteConnection):
+                    write_frame(conn, parts)
+                elif not msg.get("PASSED_ON"):
+                    conn.link.send({"TYPE": "DELIVER", "USERS": [user], "PAYLOAD": payload, "PASSED_ON": True})
+
+        case "HANDOFF":
+            hand_off(msg)
+
+        case "MOVED":
+            # a member of our rooms took its session to another worker, it's reached through that one now
+            client = clients.get(name)
+            conn = client.get_socket() if client is not None else None
+            if isinstance(conn, RemoteConnection) and conn.session == msg.get("SESSION"):
+                swap_connection(client, cluster.remote_connection(msg))
+
+        case "DISCONNECT":
+            client = clients.get(name)
+            if client is not None and getattr(client.get_socket(), "session", None) == msg.get("SESSION"):
+                cleanup_client(name)
+
+# queue-depth and write counters summed over every connected client, plus the deepest queue right now
+# FRAMES_PER_WRITE is how many frames the writers managed to put in one write call on average
+def outbound_stats():
+    totals = {"CONNECTIONS": 0, "DEPTH": 0, "MAX_DEPTH": 0, "ENQUEUED": 0, "SENT": 0, "BYTES_SENT": 0, "DROPPED": 0, "SLOW_CONSUMERS": 0,
+              "FRAMES_WRITTEN": 0, "WRITES": 0, "RAW_BYTES": 0, "WIRE_BYTES": 0}
+
+    for client in list(clients.values()):
+        conn = client.get_socket()
+        # members connected to another worker are counted there, detached sessions aren't connections
+        if isinstance(conn, (RemoteConnection, SessionBuffer)):
+            continue
+        stats = conn.stats()
+        totals["CONNECTIONS"] += 1
+        totals["DEPTH"] += stats["DEPTH"]
+        totals["MAX_DEPTH"] = max(totals["MAX_DEPTH"], stats["DEPTH"])
+        totals["ENQUEUED"] += stats["ENQUEUED"]
+        totals["SENT"] += stats["SENT"]
+        totals["BYTES_SENT"] += stats["BYTES_SENT"]
+        totals["DROPPED"] += stats["DROPPED"]
+        totals["SLOW_CONSUMERS"] += conn.slow_consumer
+        totals["FRAMES_WRITTEN"] += stats["FRAMES_WRITTEN"]
+        totals["WRITES"] += stats["WRITES"]
+        # compressed connections only
+        totals["RAW_BYTES"] += stats.get("RAW_BYTES", 0)
+        totals["WIRE_BYTES"] += stats.get("WIRE_BYTES", 0)
+
+    totals["FRAMES_PER_WRITE"] = totals["FRAMES_WRITTEN"] / totals["WRITES"] if totals["WRITES"] else 0.0
+    return totals
+
+# Every client thats connected to the relay server will have an instance of this (the instance is hosted here ofc)
+def handle_client(sock, addr):
+    # prints the ip address of the client that connects to the relay
+    print(f"[+] Connected: {addr}")
+
+    # reads happen on this thread straight from the socket, writes go through conn's queue and writer thread
+    conn = Connection(sock, **connection_options)
+    reader = FrameReader(sock)
+
+    # a connection that goes quiet (even before it registers) is pinged and then dropped, see heartbeat.py
+    if reaper is not None:
+        reaper.watch(conn)
+
+    # anything that isn't a frame in a codec version (an old pickle client) is an invalid registration
+    try:
+        msg = reader.recv_message()
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        msg = None
+    conn.last_seen = time.monotonic()
+    name = register_name_blocking(conn, msg)
+    if not name:
+        if reaper is not None:
+            reaper.forget(conn)
+        conn.close()
+        return
 
     # broadcasts user to room regardless if they created it or joined
     try:
         while True:
-           
-            # waits for message in the main loop
-            print(f"[DEBUG] Waiting for message from {name}")
-            msg = recv_message(conn)
-            print(f"MESSAGE RECEIVED FROM {name}: {msg}")
+
+            # waits for message in the main loop (never logged: it can hold a room password, a file chunk or ciphertext)
+            msg = reader.recv_message()
 
             if msg is None:
                 break
-            
-            mType = msg.get("TYPE")
+            conn.last_seen = time.monotonic()
 
-            if mType in ("CREATE_ROOM", "JOIN_ROOM"):
-                print("CREATING ROOM!!")
-                chat_room_name = assign_room(conn, name, msg)
+            if limiter is not None:
+                wait = admit(conn, name, msg)
+                if wait is None:
+                    continue
+                # delay: nothing more is read from this connection until the message's turn comes
+                if wait > 0:
+                    time.sleep(wait)
 
-            match mType:
-                case "SEND":
-                    # operation for a user sending a message to the room they are in
-                    message = msg.get("MESSAGE")
-                    room_name = msg.get("ROOM_NAME")
-                    if room_name in chat_rooms:
-                        chat_rooms[room_name].send_message("RECEIVE", message, clients, from_user=name, chat_rooms=chat_rooms)
+            handle_message(conn, name, msg)
 
     except Exception as e:
         print(f"Error: {e}")
-    
+
     finally:
         print(f"[-] User disconnected: {name} from {addr}")
-        # cleanup on disconnect
-        with lock:
-            if name in clients:
-                del clients[name]
-            # if the user was in a room, remove them from it
-            if chat_room_name and chat_room_name in chat_rooms:
-                room = chat_rooms[chat_room_name]
-                if name in room.users:
-                    room.remove_user(name)
-                    room.send_message("BROADCAST", f"{name} has left the room.", clients, from_user=name)
-                
-                if len(chat_rooms[chat_room_name].users) == 0:
-                    del chat_rooms[chat_room_name]
-                    print(f"[+] Room '{chat_room_name}' deleted due to no users remaining.")
-            # send a message to the rest of the users that the user has left
+        if reaper is not None:
+            reaper.forget(conn)
+        client_disconnected(conn, name)
         conn.close()
 
 
-def main():
+# event-loop version of handle_client. Instead of a thread (or a coroutine) per connection, asyncio calls into
+# this protocol whenever bytes arrive: they land straight in the connection's FrameBuffer and every complete frame
+# is handled right away, so one read can process a whole burst of messages
+class RelayProtocol(asyncio.BufferedProtocol):
+
+    def __init__(self):
+        self.frames = FrameBuffer()
+        self.conn = None
+        self.addr = None
+        self.name = None
+        # message held back by the rate limiter (delay), reading is paused until it's handled
+        self.held = None
+        # the NAME is being checked, waiting is set while reading is paused for an answer from another worker
+        self.registering = False
+        self.waiting = False
+
+    def connection_made(self, transport):
+        self.addr = transport.get_extra_info("peername")
+        self.conn = AsyncConnection(transport, **connection_options)
+        if reaper is not None:
+            reaper.watch(self.conn)
+        print(f"[+] Connected: {self.addr}")
+
+    def get_buffer(self, sizehint):
+        return self.frames.writable()
+
+    def buffer_updated(self, nbytes):
+        self.frames.filled(nbytes)
+        self.conn.last_seen = time.monotonic()
+        # closing (rejected name or dropped), ignore anything else the client sends
+        if self.conn.queue.closed:
+            return
+        self.process()
+
+    # handles the complete frames in the buffer, the rest stays there for the next read
+    def process(self):
+        try:
+            for payload in self.frames.payloads():
+                msg = decode_payload(payload)
+                if limiter is not None and self.name:
+                    wait = admit(self.conn, self.name, msg)
+                    if wait is None:
+                        if self.conn.queue.closed:
+                            break
+                        continue
+                    if wait > 0:
+                        # delay: stop reading, the message and whatever is behind it wait for the tokens
+                        self.held = msg
+                        self.conn.transport.pause_reading()
+                        asyncio.get_running_loop().call_later(wait, self.release)
+                        return
+                self.handle(msg)
+                if self.conn.queue.closed or self.waiting:
+                    break
+        except Exception as e:
+            print(f"Error: {e}")
+            self.conn.abort()
+
+    # the held back message's turn came
+    def release(self):
+        msg, self.held = self.held, None
+        if self.conn.queue.closed:
+            return
+        try:
+            self.handle(msg)
+        except Exception as e:
+            print(f"Error: {e}")
+            self.conn.abort()
+            return
+        self.conn.transport.resume_reading()
+        self.process()
+
+    # same steps as handle_client: name registration, then room assignment and chat messages
+    def handle(self, msg):
+        if self.name is None:
+            self.registering = True
+            register_name(self.conn, msg, self.registered)
+            # the name registry is on another worker: nothing more is read until its answer is in
+            if self.registering:
+                self.waiting = True
+                self.conn.transport.pause_reading()
+
+        else:
+            handle_message(self.conn, self.name, msg)
+
+    # register_name's answer, right away or later on when it had to ask another worker
+    def registered(self, name):
+        self.registering = False
+        if not name:
+            self.conn.close()
+            return
+        # the client went away while its name was being reserved
+        if self.conn.queue.closed:
+            client_disconnected(self.conn, name)
+            return
+
+        self.name = name
+        if self.waiting:
+            self.waiting = False
+            self.conn.transport.resume_reading()
+            self.process()
+
+    def pause_writing(self):
+        self.conn.pause_writing()
+
+    def resume_writing(self):
+        self.conn.resume_writing()
+
+    def connection_lost(self, exc):
+        self.conn.connection_lost()
+        if reaper is not None:
+            reaper.forget(self.conn)
+        if self.name:
+            print(f"[-] User disconnected: {self.name} from {self.addr}")
+            client_disconnected(self.conn, self.name)
+
+
+# (worker id, workers) of this process
+def worker_position():
+    return (cluster.worker_id, cluster.workers) if cluster is not None else (0, 1)
+
+def serve_threads(host, port, reuse_port=False):
+    # links to the other workers first, their messages are handled on the link threads like client messages
+    if cluster is not None:
+        cluster.start(handle_peer_message)
+
+    start_presence()
+    restore_rooms(*worker_position())
+    start_rooms()
+    start_reaper()
+    start_sessions()
+    if stats_options["socket"]:
+        start_metrics(stats_options["socket"])
+
     # This creates a tcp socket
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     # bypasses "Address already in use" error
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # every worker listens on the same port, the kernel spreads new connections over them
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     # Incoming traffic requests get sent to server
-    server.bind((HOST, PORT))
+    server.bind((host, port))
     # Socket is now listening (bascially open to requests)
     server.listen()
 
-    print(f"[+] Relay server listening on {HOST}:{PORT}")
+    print(f"[+] Relay server listening on {host}:{port} (thread mode)")
     print("[+] Waiting for clients to connect...")
 
     # Loop running forever waiting for clients
@@ -170,7 +963,196 @@ def main():
         thread.start()
 
 
+async def serve_async(host, port, reuse_port=False):
+    # one event loop serves every connection, no thread per client
+    loop = asyncio.get_running_loop()
+
+    # messages from the other workers arrive on link threads, relay state is only touched on the loop
+    if cluster is not None:
+        cluster.start(lambda msg: loop.call_soon_threadsafe(handle_peer_message, msg), loop.call_soon_threadsafe)
+
+    start_presence(lambda room_name, fn, *args: loop.call_soon_threadsafe(in_room, room_name, fn, *args))
+    restore_rooms(*worker_position())
+    start_rooms()
+    start_reaper()
+    start_sessions(lambda name, buffer: loop.call_soon_threadsafe(session_expired, name, buffer))
+    if stats_options["socket"]:
+        start_metrics(stats_options["socket"])
+
+    server = await loop.create_server(RelayProtocol, host, port, reuse_address=True, reuse_port=reuse_port)
+
+    print(f"[+] Relay server listening on {host}:{port} (async mode)")
+    print("[+] Waiting for clients to connect...")
+
+    async with server:
+        await server.serve_forever()
+
+
+# one process of a multi-process relay, every worker has its own clients and rooms
+def run_worker(worker_id, workers, socket_dir, host, port, mode):
+    global cluster
+    cluster = Cluster(worker_id, workers, socket_dir, directory)
+    directory.forward = cluster.publish
+
+    print(f"[+] Worker {worker_id} of {workers} starting")
+    try:
+        if mode == "async":
+            asyncio.run(serve_async(host, port, reuse_port=True))
+        else:
+            serve_threads(host, port, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_store()
+
+# SIGTERM / Ctrl-C: the snapshot store gets its last write before anything is torn down
+# (otherwise the connections closing on the way out would empty and delete every room), then the process unwinds
+# and a multi-process relay stops its workers too
+def exit_on_signal(signum, frame):
+    stop_store()
+    sys.exit(0)
+
+# writes the last changes to the snapshot journal
+def stop_store():
+    if store is not None:
+        store.stop()
+
+def serve_workers(host, port, mode, workers):
+    # the workers' Unix sockets, removed again on the way out
+    socket_dir = tempfile.mkdtemp(prefix="relay-")
+
+    # forked, so every worker starts with the settings parsed in main()
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=run_worker, args=(i, workers, socket_dir, host, port, mode), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        # if one worker dies its rooms and links are gone, stop everything
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    global limiter
+    parser = argparse.ArgumentParser(description="Chat relay server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    # thread = one OS thread per connection (original behaviour), async = single asyncio event loop
+    parser.add_argument("--mode", choices=("thread", "async"), default="thread")
+    # more than one = that many processes sharing the port, rooms are spread over them (see cluster.py)
+    parser.add_argument("--workers", type=int, default=1, help="relay processes (uses SO_REUSEPORT)")
+    # per-connection outbound queue, what to do with a client that reads slower than its room talks
+    parser.add_argument("--queue-limit", type=int, default=QUEUE_LIMIT, help="max frames queued per connection")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY)
+    parser.add_argument("--block-timeout", type=float, default=BLOCK_TIMEOUT, help="seconds the block policy waits before disconnecting")
+    # write coalescing, every flush is one sendmsg / writelines call carrying all the frames that are ready
+    parser.add_argument("--flush-frames", type=int, default=FLUSH_FRAMES, help="max frames per write call")
+    parser.add_argument("--flush-bytes", type=int, default=FLUSH_BYTES, help="max bytes per write call")
+    parser.add_argument("--flush-latency", type=float, default=FLUSH_LATENCY,
+                        help="seconds a writer may wait for more frames before flushing (0 = flush right away)")
+    # streaming compression for clients that ask for it, frames under the threshold are sent as they are
+    parser.add_argument("--no-compression", action="store_true", help="never compress, whatever the client asks for")
+    parser.add_argument("--compression-threshold", type=int, default=compression.THRESHOLD, help="smallest frame (bytes) worth compressing")
+    parser.add_argument("--compression-level", type=int, choices=range(1, 10), default=compression.LEVEL, metavar="1-9")
+    # room history: recent messages in memory, older ones in an on-disk log when a directory is given
+    parser.add_argument("--history-size", type=int, default=history.HISTORY_SIZE, help="messages kept in memory per room")
+    parser.add_argument("--scrollback", type=int, default=history.SCROLLBACK, help="messages sent to someone joining a room")
+    parser.add_argument("--history-dir", help="keep room history in memory-mapped log files under this directory")
+    parser.add_argument("--segment-size", type=int, default=history.SEGMENT_SIZE, help="bytes per history log segment")
+    parser.add_argument("--max-segments", type=int, default=history.MAX_SEGMENTS, help="log segments kept per room, older ones are deleted")
+    # room snapshots: rooms, admins, bans and passwords come back after a restart
+    parser.add_argument("--snapshot-dir", help="save rooms under this directory and restore them on start up")
+    parser.add_argument("--snapshot-interval", type=float, default=snapshot.SNAPSHOT_INTERVAL, help="seconds between snapshot journal writes")
+    parser.add_argument("--checkpoint-every", type=int, default=snapshot.CHECKPOINT_EVERY, help="journal records before a full checkpoint")
+    # metrics, off unless asked for (see metrics.py)
+    parser.add_argument("--stats-socket", help="collect metrics and serve them as JSON on this Unix socket (.<worker id> is added per worker)")
+    # keepalives: quiet connections get a PING, silent ones are dropped
+    parser.add_argument("--ping-interval", type=float, default=heartbeat.PING_INTERVAL, help="seconds of silence before a PING")
+    parser.add_argument("--idle-timeout", type=float, default=heartbeat.IDLE_TIMEOUT, help="seconds of silence before a connection is dropped (0 = never)")
+    parser.add_argument("--heartbeat-tick", type=float, default=heartbeat.TICK, help="resolution of the idle timers in seconds")
+    # room actors: a fixed pool of threads runs every room's jobs in order, one room on one thread at a time
+    parser.add_argument("--room-workers", type=int, default=actors.ROOM_WORKERS,
+                        help="threads running room actors (0 = rooms run on the thread that read the message)")
+    parser.add_argument("--room-batch", type=int, default=actors.BATCH, help="jobs a room runs before the next room gets its turn")
+    # rate limits (0 = none): messages and bytes per second per user, per room and per connection
+    parser.add_argument("--user-rate", type=float, default=0.0, help="chat messages per second per user")
+    parser.add_argument("--user-bytes", type=float, default=0.0, help="chat bytes per second per user")
+    parser.add_argument("--room-rate", type=float, default=0.0, help="chat messages per second per room")
+    parser.add_argument("--room-bytes", type=float, default=0.0, help="chat bytes per second per room")
+    parser.add_argument("--conn-rate", type=float, default=0.0, help="frames per second per connection")
+    parser.add_argument("--conn-bytes", type=float, default=0.0, help="chat bytes per second per connection")
+    parser.add_argument("--rate-burst", type=float, default=ratelimit.BURST, help="seconds worth of messages a sender can save up")
+    parser.add_argument("--over-limit", choices=ratelimit.ACTIONS, default=ratelimit.OVER_LIMIT,
+                        help="what happens to a message over a limit: delay it, drop it (the sender is told) or disconnect the sender")
+
+    parser.add_argument("--session-grace", type=float, default=sessions.GRACE,
+                        help="seconds a dropped client can come back and resume its session (0 = never)")
+    parser.add_argument("--session-buffer", type=int, default=sessions.BUFFER_LIMIT, help="frames kept for a dropped client to catch up on")
+
+    parser.add_argument("--presence-window", type=float, default=presence.PRESENCE_WINDOW,
+                        help="seconds join / leave notices are held to go out as one (0 = one notice per join / leave)")
+    parser.add_argument("--presence-cap", type=int, default=presence.PRESENCE_CAP, help="names listed in one join / leave notice")
+    args = parser.parse_args(argv)
+
+    history_options.update(
+        size=args.history_size, scrollback=args.scrollback, directory=args.history_dir,
+        segment_size=args.segment_size, max_segments=args.max_segments,
+    )
+
+    compression_options.update(
+        methods=() if args.no_compression else compression.METHODS,
+        threshold=args.compression_threshold, level=args.compression_level,
+    )
+
+    connection_options.update(
+        limit=args.queue_limit, policy=args.overflow, block_timeout=args.block_timeout,
+        flush_frames=args.flush_frames, flush_bytes=args.flush_bytes, flush_latency=args.flush_latency,
+    )
+
+    # (forked workers inherit the handlers)
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    signal.signal(signal.SIGINT, exit_on_signal)
+
+    stats_options.update(socket=args.stats_socket)
+    room_options.update(workers=args.room_workers, batch=args.room_batch)
+    ratelimit_options.update(
+        user=ratelimit.Limit(args.user_rate, args.user_bytes, args.rate_burst),
+        room=ratelimit.Limit(args.room_rate, args.room_bytes, args.rate_burst),
+        connection=ratelimit.Limit(args.conn_rate, args.conn_bytes, args.rate_burst),
+        action=args.over_limit,
+    )
+    if any(ratelimit_options[scope] for scope in ("user", "room", "connection")):
+        limiter = ratelimit.RateLimiter(**ratelimit_options)
+    session_options.update(grace=args.session_grace, limit=args.session_buffer)
+    presence_options.update(window=args.presence_window, cap=args.presence_cap)
+    heartbeat_options.update(ping_interval=args.ping_interval, idle_timeout=args.idle_timeout, tick=args.heartbeat_tick)
+    snapshot_options.update(directory=args.snapshot_dir, interval=args.snapshot_interval, checkpoint_every=args.checkpoint_every)
+    if args.snapshot_dir:
+        # every store of the last run, rewritten as one checkpoint per worker of this run
+        with snapshot.bulk_load():
+            restored.update(snapshot.load(args.snapshot_dir))
+        snapshot.reshard(args.snapshot_dir, restored, args.workers)
+
+    if args.workers > 1:
+        serve_workers(args.host, args.port, args.mode, args.workers)
+        return
+
+    try:
+        if args.mode == "async":
+            asyncio.run(serve_async(args.host, args.port))
+        else:
+            serve_threads(args.host, args.port)
+    finally:
+        stop_store()
+
+
 if __name__ == "__main__":
     main()
-
-    
\ No newline at end of file
@@ -0,0 +1,143 @@
+# Session resumption (relay_server.py --session-grace).
+# Every client gets a session token in its WELCOME. When its connection drops the relay doesn't tear the user down: the
+# user stays in its room (admin rights and all) and a SessionBuffer takes the connection's place, keeping what the room
+# sends it. A client that reconnects within the grace period sends its token in NAME and carries on where it was:
+# the buffered frames are replayed to the new connection first, then everything goes to it directly.
+# Only when the grace period runs out is the user cleaned up like a disconnect used to be (leaves the room, name freed).
+#
+# A reconnect storm after a network blip costs one WELCOME and the replay per client, no listing, no joins, no rosters.
+# Expiry uses the same timer wheel as the idle reaper (heartbeat.py), a single thread however many sessions are detached.
+
+import collections
+import hmac
+import secrets
+import threading
+import time
+
+from heartbeat import TimerWheel, TICK
+
+GRACE = 30.0          # seconds a dropped client's session is kept (0 = no sessions, a disconnect ends everything)
+BUFFER_LIMIT = 1024   # frames kept for a detached session, the oldest are dropped past that
+
+
+# stands in for the connection of a detached session, fan-out writes into it like into any connection
+class SessionBuffer:
+
+    def __init__(self, codec, limit=BUFFER_LIMIT):
+        self.codec = codec  # frames are encoded for the connection that dropped, a resume has to speak the same
+        self.limit = limit
+        self.frames = collections.deque()
+        self.missed = 0     # frames dropped because the buffer was full
+        self.target = None  # the connection that resumed the session
+        self.lock = threading.Lock()
+
+    def send_parts(self, parts):
+        with self.lock:
+            if self.target is not None:
+                self.target.send_parts(parts)
+                return
+            self.frames.append(parts)
+            if len(self.frames) > self.limit:
+                self.frames.popleft()
+                self.missed += 1
+
+    # frames the dropped connection never got to write, they go before anything sent since
+    def prepend(self, frames):
+        with self.lock:
+            self.frames.extendleft(reversed(frames))
+            while len(self.frames) > self.limit:
+                self.frames.popleft()
+                self.missed += 1
+
+    # file chunks aren't kept, a transfer doesn't wait for someone who isn't there (see attachments.py)
+    def send_bulk(self, parts, done=None):
+        if done is not None:
+            done()
+
+    # replays what was kept to conn, then passes on whatever is still sent through here (deliveries that picked up the
+    # buffer before it was swapped out). Returns the number of frames that couldn't be replayed
+    def attach(self, conn):
+        with self.lock:
+            if conn.codec == self.codec:
+                for parts in self.frames:
+                    conn.send_parts(parts)
+            else:
+                self.missed += len(self.frames)
+            self.frames.clear()
+            self.target = conn
+            return self.missed
+
+
+class Session:
+    __slots__ = ("name", "token", "buffer")
+
+    def __init__(self, name, token):
+        self.name = name
+        self.token = token
+        self.buffer = None  # SessionBuffer while the client is away
+
+
+class SessionStore:
+
+    def __init__(self, grace=GRACE, limit=BUFFER_LIMIT, tick=TICK):
+        self.grace = grace
+        self.limit = limit
+        self.sessions = {}  # user name -> Session
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+
+    # a new session for a client that just registered, returns its token
+    # (token is given for a session another worker handed over, see cluster.py)
+    def issue(self, name, token=None):
+        token = token or secrets.token_urlsafe(16)
+        with self.lock:
+            self.sessions[name] = Session(name, token)
+        return token
+
+    # name's connection dropped, returns the SessionBuffer that takes its place (None if it has no session)
+    def detach(self, name, codec):
+        with self.lock:
+            session = self.sessions.get(name)
+            if session is None:
+                return None
+            session.buffer = SessionBuffer(codec, self.limit)
+            self.wheel.schedule(name, time.monotonic() + self.grace)
+            return session.buffer
+
+    # token is the one name's session was issued
+    def valid(self, name, token):
+        with self.lock:
+            session = self.sessions.get(name)
+        return session is not None and isinstance(token, str) and hmac.compare_digest(session.token.encode(), token.encode())
+
+    # the client is back: returns the SessionBuffer that stood in for it, None if the session expired in the meantime
+    def resume(self, name):
+        with self.lock:
+            session = self.sessions.get(name)
+            if session is None or session.buffer is None:
+                return None
+            self.wheel.cancel(name)
+            buffer, session.buffer = session.buffer, None
+            return buffer
+
+    # the client logged out (or is gone for good), nothing to resume
+    def forget(self, name):
+        with self.lock:
+            self.sessions.pop(name, None)
+            self.wheel.cancel(name)
+
+    # expired(name, buffer) is called (on this store's thread) for every session whose grace period ran out
+    def start(self, expired):
+        threading.Thread(target=self.run, args=(expired,), daemon=True).start()
+
+    def run(self, expired):
+        while True:
+            time.sleep(self.wheel.tick)
+            with self.lock:
+                gone = []
+                for name in self.wheel.advance(time.monotonic()):
+                    session = self.sessions.pop(name, None)
+                    if session is not None and session.buffer is not None:
+                        gone.append((name, session.buffer))
+            for name, buffer in gone:
+                expired(name, buffer)
@@ -0,0 +1,210 @@
+# Room snapshots, so a restarted relay comes back with its rooms (relay_server.py --snapshot-dir).
+# What survives a restart is the state people set up: room names, admins, ban lists and password hashes.
+# Members don't, they are connections and have to join again.
+#
+# chat_room reports every change of that state (created, admins / bans changed, deleted) to the SnapshotStore,
+# which only remembers the room's new record. A background thread writes whatever changed since its last run to an
+# append-only journal every --snapshot-interval seconds, and once the journal holds --checkpoint-every records it
+# writes the full state as a new checkpoint and starts an empty journal. The relay never waits on the disk.
+#
+# on boot the relay reads every checkpoint and replays the journals before it starts listening.
+# Each process of a multi-process relay has its own store (worker<id>.ckpt / worker<id>.journal), and the stores are
+# rewritten for the current worker count first, so --workers can change between restarts.
+#
+# records are plain tuples: (room name, admins, banned users, password salt, password hash)
+
+import contextlib
+import gc
+import os
+import pickle
+import struct
+import threading
+
+from cluster import shard_of
+
+SNAPSHOT_INTERVAL = 1.0    # seconds between journal writes
+CHECKPOINT_EVERY = 10000   # journal records before the next checkpoint
+
+RECORD = struct.Struct("!I")  # length of one pickled journal entry
+
+
+def room_record(room):
+    if room.has_password:
+        return (room.room_name, tuple(room.admins), tuple(room.ban_list), room.password_salt, room.password_hash)
+    return (room.room_name, tuple(room.admins), tuple(room.ban_list), None, None)
+
+
+# loading and rebuilding lots of rooms makes millions of objects that all stay around, the garbage collector would
+# walk them over and over while they are being made, so it is paused and they are moved out of its way afterwards
+@contextlib.contextmanager
+def bulk_load():
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.freeze()
+        gc.enable()
+
+
+def store_name(worker_id):
+    return f"worker{worker_id}"
+
+
+def write_file(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# room name -> record from a checkpoint and the journal written after it
+# a journal entry is (room name, record), record None means the room was deleted
+def read_store(directory, name):
+    rooms = {}
+    checkpoint = os.path.join(directory, name + ".ckpt")
+    if os.path.exists(checkpoint):
+        with open(checkpoint, "rb") as f:
+            rooms = {record[0]: record for record in pickle.load(f)}
+
+    journal = os.path.join(directory, name + ".journal")
+    if os.path.exists(journal):
+        with open(journal, "rb") as f:
+            data = f.read()
+        pos = 0
+        # a cut off entry at the end (the relay died mid write) is ignored
+        while pos + RECORD.size <= len(data):
+            (length,) = RECORD.unpack_from(data, pos)
+            end = pos + RECORD.size + length
+            if end > len(data):
+                break
+            room_name, record = pickle.loads(data[pos + RECORD.size:end])
+            if record is None:
+                rooms.pop(room_name, None)
+            else:
+                rooms[room_name] = record
+            pos = end
+
+    return rooms
+
+
+def store_names(directory):
+    names = set()
+    for file_name in os.listdir(directory):
+        stem, ext = os.path.splitext(file_name)
+        if ext in (".ckpt", ".journal"):
+            names.add(stem)
+    return sorted(names)
+
+
+# every room in every store of the directory
+def load(directory):
+    os.makedirs(directory, exist_ok=True)
+    rooms = {}
+    for name in store_names(directory):
+        rooms.update(read_store(directory, name))
+    return rooms
+
+
+# writes a fresh checkpoint per worker with the rooms it owns, then removes the journals and any other stores
+# (new files first, so a crash halfway leaves duplicates behind rather than losing rooms)
+def reshard(directory, rooms, workers):
+    shards = [[] for _ in range(workers)]
+    for room_name, record in rooms.items():
+        shards[shard_of(room_name, workers) if workers > 1 else 0].append(record)
+
+    current = set()
+    for worker_id, records in enumerate(shards):
+        name = store_name(worker_id)
+        write_file(os.path.join(directory, name + ".ckpt"), pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL))
+        current.add(name + ".ckpt")
+
+    for file_name in os.listdir(directory):
+        if file_name.endswith((".ckpt", ".journal", ".tmp")) and file_name not in current:
+            os.remove(os.path.join(directory, file_name))
+
+
+class SnapshotStore:
+
+    # rooms is what the store's checkpoint holds right now (what reshard() wrote for this worker)
+    def __init__(self, directory, name, interval=SNAPSHOT_INTERVAL, checkpoint_every=CHECKPOINT_EVERY, rooms=None):
+        self.checkpoint_path = os.path.join(directory, name + ".ckpt")
+        self.journal_path = os.path.join(directory, name + ".journal")
+        self.interval = interval
+        self.checkpoint_every = checkpoint_every
+
+        # changes since the last write, room name -> record (None = deleted), only the newest one per room matters
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # what is on disk, only touched by the writer thread
+        self.rooms = dict(rooms or {})
+        self.journal = open(self.journal_path, "ab")
+        self.journal_records = 0
+
+        self.stopped = threading.Event()
+        self.writer = None
+
+    # called by chat_room, cheap enough for the message path
+    def changed(self, room):
+        record = room_record(room)
+        with self.lock:
+            self.pending[room.room_name] = record
+
+    def removed(self, room_name):
+        with self.lock:
+            self.pending[room_name] = None
+
+    def start(self):
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def writer_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[-] Snapshot failed: {e}")
+
+    # appends what changed to the journal, checkpoints when the journal has grown enough
+    def flush(self):
+        with self.lock:
+            changes, self.pending = self.pending, {}
+        if not changes:
+            return
+
+        out = bytearray()
+        for room_name, record in changes.items():
+            data = pickle.dumps((room_name, record), protocol=pickle.HIGHEST_PROTOCOL)
+            out += RECORD.pack(len(data))
+            out += data
+            if record is None:
+                self.rooms.pop(room_name, None)
+            else:
+                self.rooms[room_name] = record
+
+        self.journal.write(out)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_records += len(changes)
+
+        if self.journal_records >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        write_file(self.checkpoint_path, pickle.dumps(list(self.rooms.values()), protocol=pickle.HIGHEST_PROTOCOL))
+        # everything in the journal is in the checkpoint now
+        self.journal.close()
+        self.journal = open(self.journal_path, "wb")
+        self.journal_records = 0
+
+    # last write on the way out, changes after that are not saved
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.flush()
+        self.journal.close()
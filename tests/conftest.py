@@ -0,0 +1,83 @@
+import os
+import sys
+import types
+
+import pytest
+
+# the relay's modules sit at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+from directory import RoomDirectory
+from protocol import decode_payload
+
+
+# stands in for a Connection: what is sent to it is decoded back into messages (sent), file chunks wait in bulk
+# until drain() plays the writer taking them
+class FakeConnection:
+
+    def __init__(self, codec=codec.VERSION, last_seen=0.0):
+        self.codec = codec
+        self.sent = []
+        self.bulk = []  # (message, done)
+        self.queue = types.SimpleNamespace(closed=False)
+        self.last_seen = last_seen
+        self.rate_limits = None
+        self.slow_consumer = False
+        self.aborted = False
+
+    def send_parts(self, parts):
+        self.sent.append(decode_payload(parts[1]))
+
+    def send_bulk(self, parts, done=None):
+        self.bulk.append((decode_payload(parts[1]), done))
+
+    def drain(self):
+        taken, self.bulk = self.bulk, []
+        for _, done in taken:
+            if done is not None:
+                done()
+        return [msg for msg, _ in taken]
+
+    def types(self):
+        return [msg["TYPE"] for msg in self.sent]
+
+    def close(self):
+        self.queue.closed = True
+
+    def abort(self):
+        self.aborted = True
+        self.queue.closed = True
+
+
+# room jobs handed to the relay's actor pool, run() plays the actors
+class FakeRooms:
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, room_name, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run(self):
+        while self.jobs:
+            fn, args = self.jobs.pop(0)
+            fn(*args)
+
+
+@pytest.fixture
+def connection():
+    return FakeConnection
+
+
+# relay_server with its state emptied out, and room jobs held in a FakeRooms until the test runs them
+@pytest.fixture
+def relay(monkeypatch):
+    import relay_server
+
+    monkeypatch.setattr(relay_server, "clients", {})
+    monkeypatch.setattr(relay_server, "chat_rooms", {})
+    monkeypatch.setattr(relay_server, "user_rooms", {})
+    monkeypatch.setattr(relay_server, "directory", RoomDirectory())
+    monkeypatch.setattr(relay_server, "rooms", FakeRooms())
+    return relay_server
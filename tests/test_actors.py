@@ -0,0 +1,86 @@
+import threading
+import time
+
+from actors import ActorPool
+
+
+def wait_idle(pool, timeout=5):
+    deadline = time.monotonic() + timeout
+    while pool.backlog() != (0, 0) or pool.mailboxes:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_a_room_runs_its_jobs_in_order_one_at_a_time():
+    pool = ActorPool(workers=4, batch=3)
+    pool.start()
+    ran = []
+    running = set()
+    overlaps = []
+
+    def job(room, n):
+        if room in running:
+            overlaps.append(room)
+        running.add(room)
+        time.sleep(0.0001)
+        ran.append((room, n))
+        running.discard(room)
+
+    for n in range(100):
+        for room in ("a", "b", "c"):
+            pool.submit(room, job, room, n)
+    wait_idle(pool)
+
+    assert overlaps == []
+    for room in ("a", "b", "c"):
+        assert [n for r, n in ran if r == room] == list(range(100))
+
+
+def test_rooms_run_on_different_workers_at_once():
+    pool = ActorPool(workers=2)
+    pool.start()
+    both = threading.Barrier(2, timeout=5)
+    passed = []
+
+    # each job only gets past the barrier if the other room's job is running at the same time
+    for room in ("a", "b"):
+        pool.submit(room, lambda: passed.append(both.wait() is not None))
+    wait_idle(pool)
+    assert passed == [True, True]
+
+
+def test_a_busy_room_gives_up_its_worker_after_a_batch():
+    pool = ActorPool(workers=1, batch=2)
+    ran = []
+    for n in range(5):
+        pool.submit("a", ran.append, "a")
+        pool.submit("b", ran.append, "b")
+    pool.start()
+    wait_idle(pool)
+    assert ran == ["a", "a", "b", "b", "a", "a", "b", "b", "a", "b"]
+
+
+def test_a_failing_job_does_not_stop_the_room(capsys):
+    pool = ActorPool(workers=1)
+    ran = []
+    pool.submit("a", lambda: 1 / 0)
+    pool.submit("a", ran.append, "after")
+    pool.start()
+    wait_idle(pool)
+    assert ran == ["after"]
+    assert "division by zero" in capsys.readouterr().out
+
+
+def test_without_room_workers_jobs_run_inline_under_the_lock(relay, monkeypatch):
+    monkeypatch.setattr(relay, "rooms", None)
+    held = []
+
+    # another thread can't take the relay lock while the job runs
+    def job(value):
+        taker = threading.Thread(target=lambda: held.append(not relay.lock.acquire(blocking=False)))
+        taker.start()
+        taker.join()
+        held.append(value)
+
+    relay.in_room("r", job, "ran")
+    assert held == [True, "ran"]
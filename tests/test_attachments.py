@@ -0,0 +1,151 @@
+import pytest
+
+import attachments
+from attachments import WINDOW, MAX_CHUNK, Upload
+from chat_room import chat_room
+from client_info import Client
+
+
+def acks(conn):
+    return [msg for msg in conn.sent if msg["TYPE"] == "ATTACH_ACK"]
+
+
+@pytest.fixture
+def room():
+    return chat_room("r", "alice")
+
+
+@pytest.fixture
+def clients(room, connection):
+    clients = {"alice": Client(connection(), "alice", "r")}
+    for name in ("bob", "carol"):
+        clients[name] = Client(connection(), name, "r")
+        room.add_user(name)
+    return clients
+
+
+def conn(clients, user):
+    return clients[user].get_socket()
+
+
+def start(room, clients, size, transfer="t1"):
+    attachments.start(room, clients, "alice", conn(clients, "alice"),
+                      {"TYPE": "ATTACH_START", "TRANSFER": transfer, "FILE_NAME": "f.bin", "SIZE": size})
+
+
+def chunk(room, clients, offset, data, transfer="t1"):
+    attachments.chunk(room, clients, "alice", conn(clients, "alice"),
+                      {"TYPE": "ATTACH_CHUNK", "TRANSFER": transfer, "OFFSET": offset, "DATA": data})
+
+
+def test_start_opens_the_window(room, clients):
+    start(room, clients, 100)
+    assert acks(conn(clients, "alice")) == [{"TYPE": "ATTACH_ACK", "TRANSFER": "t1", "OFFSET": 0, "WINDOW": WINDOW, "RESUME": 0}]
+    assert [msg["TYPE"] for msg in conn(clients, "bob").sent] == ["ATTACH_START"]
+    assert conn(clients, "bob").sent[0]["FROM"] == "alice"
+
+
+def test_a_chunk_is_acked_once_every_member_took_it(room, clients):
+    start(room, clients, 100)
+    chunk(room, clients, 0, b"x" * 60)
+    assert len(acks(conn(clients, "alice"))) == 1
+
+    assert conn(clients, "bob").drain()[0]["DATA"] == b"x" * 60
+    assert len(acks(conn(clients, "alice"))) == 1
+    conn(clients, "carol").drain()
+    assert acks(conn(clients, "alice"))[-1]["OFFSET"] == 60
+
+
+def test_acks_follow_the_slowest_member(room, clients):
+    start(room, clients, 3 * 10)
+    for n in range(3):
+        chunk(room, clients, n * 10, b"x" * 10)
+    conn(clients, "bob").drain()
+    assert [ack["OFFSET"] for ack in acks(conn(clients, "alice"))] == [0]
+
+    # carol takes the first two, then the last
+    carol = conn(clients, "carol")
+    for _, done in carol.bulk[:2]:
+        done()
+    carol.bulk = carol.bulk[2:]
+    assert [ack["OFFSET"] for ack in acks(conn(clients, "alice"))] == [0, 10, 20]
+    carol.drain()
+    assert [ack["OFFSET"] for ack in acks(conn(clients, "alice"))] == [0, 10, 20, 30]
+
+
+def test_going_past_the_window_cancels_the_transfer(room, clients):
+    start(room, clients, 2 * WINDOW)
+    for offset in range(0, WINDOW, MAX_CHUNK):
+        chunk(room, clients, offset, b"x" * MAX_CHUNK)
+    assert ("alice", "t1") in room.transfers
+
+    # nothing acked yet, one more byte is over
+    chunk(room, clients, WINDOW, b"x")
+    assert ("alice", "t1") not in room.transfers
+    assert conn(clients, "alice").sent[-1]["TYPE"] == "ATTACH_END"
+    assert conn(clients, "alice").sent[-1]["CANCELLED"] is True
+    assert conn(clients, "bob").bulk[-1][0]["TYPE"] == "ATTACH_END"
+
+
+def test_out_of_order_chunk_cancels_the_transfer(room, clients):
+    start(room, clients, 100)
+    chunk(room, clients, 10, b"x")
+    assert not room.transfers
+    assert conn(clients, "alice").sent[-1]["MESSAGE"] == "The file was sent out of order."
+
+
+def test_resume_carries_on_from_what_was_forwarded(room, clients, connection):
+    start(room, clients, 100)
+    chunk(room, clients, 0, b"x" * 40)
+    conn(clients, "bob").drain()
+    conn(clients, "carol").drain()
+
+    # the sender comes back on a new connection
+    clients["alice"].change_socket(connection())
+    start(room, clients, 100)
+    assert acks(conn(clients, "alice")) == [{"TYPE": "ATTACH_ACK", "TRANSFER": "t1", "OFFSET": 40, "WINDOW": WINDOW, "RESUME": 40}]
+    # the members aren't told about it a second time
+    assert [msg["TYPE"] for msg in conn(clients, "bob").sent] == ["ATTACH_START"]
+
+
+def test_a_transfer_without_members_is_acked_right_away(room, clients):
+    room.remove_user("bob")
+    room.remove_user("carol")
+    start(room, clients, 10)
+    chunk(room, clients, 0, b"x" * 10)
+    assert acks(conn(clients, "alice"))[-1]["OFFSET"] == 10
+
+
+def test_upload_sends_what_the_window_has_room_for(tmp_path, monkeypatch):
+    monkeypatch.setattr(attachments, "CHUNK_SIZE", 4)
+    path = tmp_path / "f.bin"
+    path.write_bytes(bytes(range(20)))
+    upload = Upload("t1", "r", str(path))
+    try:
+        chunks = upload.acknowledged({"TYPE": "ATTACH_ACK", "OFFSET": 0, "WINDOW": 10, "RESUME": 0})
+        assert [(c["OFFSET"], len(c["DATA"])) for c in chunks] == [(0, 4), (4, 4), (8, 2)]
+
+        # nothing new acked, nothing more to send
+        assert upload.acknowledged({"TYPE": "ATTACH_ACK", "OFFSET": 0, "WINDOW": 10}) == []
+
+        chunks = upload.acknowledged({"TYPE": "ATTACH_ACK", "OFFSET": 8, "WINDOW": 10})
+        assert [(c["OFFSET"], len(c["DATA"])) for c in chunks] == [(10, 4), (14, 4)]
+        assert chunks[0]["DATA"] == bytes(range(10, 14))
+        assert not upload.done()
+
+        upload.acknowledged({"TYPE": "ATTACH_ACK", "OFFSET": 18, "WINDOW": 10})
+        upload.acknowledged({"TYPE": "ATTACH_ACK", "OFFSET": 20, "WINDOW": 10})
+        assert upload.done()
+    finally:
+        upload.close()
+
+
+def test_upload_resumes_where_the_members_are(tmp_path):
+    path = tmp_path / "f.bin"
+    path.write_bytes(bytes(range(100)))
+    upload = Upload("t1", "r", str(path))
+    try:
+        chunks = upload.acknowledged({"TYPE": "ATTACH_ACK", "OFFSET": 60, "WINDOW": WINDOW, "RESUME": 60})
+        assert [(c["OFFSET"], c["DATA"]) for c in chunks] == [(60, bytes(range(60, 100)))]
+    finally:
+        upload.close()
@@ -0,0 +1,150 @@
+from chat_room import chat_room, Members
+from client_info import Client
+from directory import RoomDirectory
+
+
+def test_members_keep_join_order():
+    members = Members(["alice"])
+    for name in ("bob", "carol", "dave"):
+        members.add(name)
+    # adding someone already there keeps their place
+    members.add("alice")
+    assert list(members) == ["alice", "bob", "carol", "dave"]
+    assert members.first() == "alice"
+
+    members.remove("alice")
+    members.discard("nobody")
+    assert members.first() == "bob"
+    assert "alice" not in members and "carol" in members
+    assert len(members) == 3
+
+    members.add("alice")
+    assert list(members) == ["bob", "carol", "dave", "alice"]
+
+
+def test_empty_members_have_no_first():
+    assert Members().first() is None
+
+
+def test_longest_standing_member_takes_over_from_the_last_admin():
+    room = chat_room("r", "alice")
+    for name in ("bob", "carol"):
+        room.add_user(name)
+    room.admins.add("carol")
+
+    # an admin leaving while another is left changes nothing
+    room.remove_user("carol")
+    assert list(room.admins) == ["alice"]
+
+    room.add_user("dave")
+    room.remove_user("alice")
+    assert list(room.admins) == ["bob"]
+    assert room.get_owner() == "bob"
+
+    room.remove_user("bob")
+    assert list(room.admins) == ["dave"]
+
+
+def test_a_member_leaving_keeps_the_admins():
+    room = chat_room("r", "alice")
+    room.add_user("bob")
+    room.remove_user("bob")
+    assert list(room.admins) == ["alice"]
+
+
+def test_reverse_index_and_directory_follow_the_members():
+    user_rooms = {}
+    directory = RoomDirectory()
+    room = chat_room("r", "alice", directory=directory, user_rooms=user_rooms)
+    room.add_user("bob")
+    assert user_rooms == {"alice": "r", "bob": "r"}
+    assert directory.rooms["r"].members == 2
+
+    room.remove_user("alice")
+    assert user_rooms == {"bob": "r"}
+    assert directory.rooms["r"].members == 1
+    assert directory.rooms["r"].owner == "bob"
+
+    # the last one out deletes the room's listing
+    room.remove_user("bob")
+    assert user_rooms == {}
+    assert "r" not in directory.rooms
+
+
+def test_a_user_is_in_one_room_at_a_time(relay, connection):
+    conns = {name: connection() for name in ("alice", "bob")}
+    for name, conn in conns.items():
+        relay.clients[name] = Client(conn, name, None)
+
+    assert relay.assign_room(conns["alice"], "alice", {"TYPE": "CREATE_ROOM", "ROOM_NAME": "one"}) == "one"
+    assert relay.assign_room(conns["bob"], "bob", {"TYPE": "CREATE_ROOM", "ROOM_NAME": "two"}) == "two"
+
+    # joining or creating another room while still in one is refused, nothing changes in either room
+    assert relay.assign_room(conns["alice"], "alice", {"TYPE": "JOIN_ROOM", "ROOM_NAME": "two"}) == "one"
+    assert relay.assign_room(conns["alice"], "alice", {"TYPE": "CREATE_ROOM", "ROOM_NAME": "three"}) == "one"
+    assert relay.assign_room(conns["alice"], "alice", {"TYPE": "JOIN_ROOM", "ROOM_NAME": "one"}) == "one"
+    assert list(relay.chat_rooms["two"].users) == ["bob"]
+    assert "three" not in relay.chat_rooms
+    assert relay.user_rooms == {"alice": "one", "bob": "two"}
+
+    # a join that fails gives its claim back
+    relay.chat_rooms["two"].ban_list.add("carol")
+    relay.clients["carol"] = Client(connection(), "carol", None)
+    assert relay.assign_room(relay.clients["carol"].get_socket(), "carol", {"TYPE": "JOIN_ROOM", "ROOM_NAME": "two"}) is None
+    assert "carol" not in relay.user_rooms
+
+
+def test_recipients_are_reused_until_the_members_change(connection):
+    clients = {name: Client(connection(), name, "r") for name in ("alice", "bob", "carol")}
+    room = chat_room("r", "alice")
+    room.add_user("bob")
+
+    first = room.recipients(clients)
+    assert first == (("alice", clients["alice"].get_socket()), ("bob", clients["bob"].get_socket()))
+    assert room.recipients(clients) is first
+
+    room.add_user("carol")
+    second = room.recipients(clients)
+    assert second is not first
+    assert [user for user, _ in second] == ["alice", "bob", "carol"]
+
+    room.remove_user("alice")
+    assert [user for user, _ in room.recipients(clients)] == ["bob", "carol"]
+    # a tuple handed out earlier is never changed under whoever holds it
+    assert [user for user, _ in second] == ["alice", "bob", "carol"]
+
+
+def test_swapped_connection_rebuilds_the_recipients(connection):
+    clients = {"alice": Client(connection(), "alice", "r")}
+    room = chat_room("r", "alice")
+    before = room.recipients(clients)
+
+    replacement = connection()
+    clients["alice"].change_socket(replacement)
+    assert room.recipients(clients) is before
+    room.connection_changed()
+    assert room.recipients(clients) == (("alice", replacement),)
+
+
+def test_members_without_a_client_are_left_out(connection):
+    clients = {"alice": Client(connection(), "alice", "r")}
+    room = chat_room("r", "alice")
+    room.add_user("ghost")
+    assert [user for user, _ in room.recipients(clients)] == ["alice"]
+
+
+def test_members_that_just_disconnected_are_skipped(connection):
+    clients = {name: Client(connection(), name, "r") for name in ("alice", "bob")}
+    room = chat_room("r", "alice")
+    room.add_user("bob")
+    room.add_user("carol")  # disconnected, their leave job hasn't run yet
+
+    room.send_roster(clients)
+    assert clients["bob"].get_socket().sent[-1]["MEMBERS"] == [["alice", None], ["bob", None], ["carol", None]]
+
+    room.send_sender_keys(clients, "alice", {"TYPE": "SENDER_KEY", "KEY_ID": 1, "KEYS": [["carol", b"k"], ["bob", b"k"], [["x"], b"k"]]})
+    assert clients["bob"].get_socket().types() == ["ROSTER", "SENDER_KEY"]
+
+    room.send_history(clients, "carol", {"TYPE": "GET_HISTORY"})
+    room.send_message("RECEIVE", "hi", clients, from_user="alice")
+    assert clients["bob"].get_socket().types() == ["ROSTER", "SENDER_KEY", "RECEIVE"]
@@ -0,0 +1,145 @@
+import pytest
+
+import cluster
+from cluster import Cluster
+
+
+class FakeLink:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+def name_on(worker_id, workers=2):
+    return next(f"user{i}" for i in range(100) if cluster.shard_of(f"user{i}", workers) == worker_id)
+
+
+@pytest.fixture
+def worker():
+    worker = Cluster(0, 2, "/nonexistent", None)
+    worker.links = {1: FakeLink()}
+    calls = []
+    # stands in for the event loop: answers are only handled when the test runs them
+    worker.call = lambda fn, *args: calls.append((fn, args))
+    worker.calls = calls
+    return worker
+
+
+# done(reserved, resumed) for reserve(), answers get reserved or "resumed"
+def answering(answers):
+    return lambda reserved, resumed: answers.append("resumed" if resumed else reserved)
+
+
+def run_calls(worker):
+    calls, worker.calls[:] = list(worker.calls), []
+    for fn, args in calls:
+        fn(*args)
+
+
+def test_names_held_here_are_settled_right_away(worker):
+    name = name_on(0)
+    answers = []
+    worker.reserve(name, answering(answers))
+    worker.reserve(name, answering(answers))
+    assert answers == [True, False]
+    assert worker.links[1].sent == []
+
+
+def test_reserve_does_not_wait_for_the_registry(worker):
+    name = name_on(1)
+    answers = []
+    worker.reserve(name, answering(answers))
+    request = worker.links[1].sent[-1]
+    assert request["TYPE"] == "RESERVE" and request["NAME"] == name
+    assert answers == []
+
+    # the answer comes in on a link thread and is handed to call()
+    worker.handle({"TYPE": "RESERVED", "ID": request["ID"], "NAME": name, "SESSION": 7})
+    assert answers == []
+    run_calls(worker)
+    assert answers == [True]
+    assert worker.sessions[name] == 7
+    assert worker.requests == {}
+
+
+def test_a_taken_name_is_refused(worker):
+    name = name_on(1)
+    answers = []
+    worker.reserve(name, answering(answers))
+    worker.handle({"TYPE": "RESERVED", "ID": worker.links[1].sent[-1]["ID"], "NAME": name, "SESSION": None})
+    run_calls(worker)
+    assert answers == [False]
+    assert name not in worker.sessions
+
+
+def test_a_late_answer_gives_the_name_back(worker, monkeypatch):
+    monkeypatch.setattr(cluster, "RESERVE_TIMEOUT", 0.01)
+    name = name_on(1)
+    answers = []
+    worker.reserve(name, answering(answers))
+    request_id = worker.links[1].sent[-1]["ID"]
+
+    timer = worker.requests[request_id][2]
+    timer.join()
+    run_calls(worker)
+    assert answers == [False]
+
+    worker.handle({"TYPE": "RESERVED", "ID": request_id, "NAME": name, "SESSION": 7})
+    run_calls(worker)
+    assert answers == [False]
+    assert worker.links[1].sent[-1] == {"TYPE": "RELEASE", "NAME": name, "SESSION": 7}
+
+
+def test_the_registry_answers_reserve_requests(worker):
+    name = name_on(0)
+    worker.handle({"TYPE": "RESERVE", "NAME": name, "ID": 3, "WORKER": 1})
+    worker.handle({"TYPE": "RESERVE", "NAME": name, "ID": 4, "WORKER": 1})
+    first, second = worker.links[1].sent
+    assert first["ID"] == 3 and first["SESSION"] is not None
+    assert second["ID"] == 4 and second["SESSION"] is None
+
+    # released with the wrong session nothing happens, with the right one the name is free again
+    worker.handle({"TYPE": "RELEASE", "NAME": name, "SESSION": -1})
+    assert name in worker.names
+    worker.handle({"TYPE": "RELEASE", "NAME": name, "SESSION": first["SESSION"]})
+    assert name not in worker.names
+
+
+def test_a_session_token_for_a_taken_name_goes_to_the_worker_holding_it(worker):
+    name = name_on(0)
+    worker.handle({"TYPE": "RESERVE", "NAME": name, "ID": 3, "WORKER": 1})
+    session = worker.links[1].sent[-1]["SESSION"]
+
+    # the client is back on worker 0 with its token
+    answers = []
+    worker.reserve(name, answering(answers), "token", 8)
+    handoff = worker.links[1].sent[-1]
+    assert handoff["TYPE"] == "HANDOFF" and handoff["WORKER"] == 0 and handoff["TOKEN"] == "token"
+
+    worker.handle({"TYPE": "RESERVED", "ID": handoff["ID"], "NAME": name, "SESSION": session, "TOUCHED": [1]})
+    worker.handle({"TYPE": "HELD", "NAME": name, "SESSION": session, "WORKER": 0})
+    run_calls(worker)
+    assert answers == ["resumed"]
+    assert worker.sessions[name] == session and worker.touched[name] == {1}
+    assert worker.holders[name] == 0
+
+    # without a token it's just taken
+    worker.reserve(name, answering(answers))
+    assert answers == ["resumed", False]
+
+
+def test_the_holder_hands_the_session_over():
+    worker = Cluster(0, 3, "/nonexistent", None)
+    worker.links = {1: FakeLink(), 2: FakeLink()}
+    name = name_on(0, 3)
+    worker.sessions[name] = 5
+    worker.touched[name] = {1, 2}
+
+    remote = worker.hand_off({"TYPE": "HANDOFF", "NAME": name, "ID": 9, "WORKER": 2, "TOKEN": "token", "CODEC": 8})
+    assert worker.links[1].sent == [{"TYPE": "MOVED", "NAME": name, "SESSION": 5, "WORKER": 2, "CODEC": 8}]
+    assert worker.links[2].sent == [{"TYPE": "RESERVED", "ID": 9, "NAME": name, "SESSION": 5, "TOUCHED": [0, 1]}]
+    assert remote.link is worker.links[2] and remote.session == 5 and remote.codec == 8
+    assert name not in worker.sessions and name not in worker.touched
@@ -0,0 +1,137 @@
+import pickle
+
+import pytest
+
+import codec
+from protocol import decode_payload
+
+
+def roundtrip(msg):
+    return codec.decode(codec.encode(msg))
+
+
+@pytest.mark.parametrize("msg", [
+    {"TYPE": "NAME", "NAME": "alice", "CODECS": [8], "PUBLIC_KEY": b"\x00" * 32, "SESSION": "tok"},
+    {"TYPE": "SEND", "ROOM_NAME": "lobby", "MESSAGE": "héllo ✓"},
+    {"TYPE": "RECEIVE", "FROM": "bob", "MESSAGE": "hi", "SEQ": 2 ** 40},
+    {"TYPE": "ROOM_LIST", "VERSION": 3, "PAGE": 0, "PAGES": 1, "ROOMS": [["lobby", "alice", 2, False]]},
+    {"TYPE": "SEALED", "ROOM_NAME": "r", "FROM": "bob", "KEY_ID": 1, "CIPHERTEXT": bytes(range(256)), "SEQ": 7},
+    {"TYPE": "COMMAND", "ROOM_NAME": "r", "COMMAND": "ban", "ARGS": ["carol"]},
+    {"TYPE": "ATTACH_ACK", "TRANSFER": "t1", "OFFSET": 65536, "WINDOW": 262144, "RESUME": None},
+    {"TYPE": "PING"},
+    {"TYPE": "LOGOUT"},
+])
+def test_roundtrip(msg):
+    assert roundtrip(msg) == msg
+
+
+def test_every_message_type_roundtrips_with_its_fields_absent():
+    for msg_type in codec.SCHEMA:
+        assert roundtrip({"TYPE": msg_type}) == {"TYPE": msg_type}
+
+
+def test_none_and_absent_are_kept_apart():
+    assert roundtrip({"TYPE": "WELCOME", "MESSAGE": None}) == {"TYPE": "WELCOME", "MESSAGE": None}
+    assert "MESSAGE" not in roundtrip({"TYPE": "WELCOME"})
+
+
+def test_keys_outside_the_schema_are_kept():
+    msg = {"TYPE": "WELCOME", "CODEC": 8, "COMPRESSION": "zlib", "EXTRA": [1, -5, b"x", True, None, ["a"]]}
+    assert roundtrip(msg) == msg
+
+
+def test_values_it_cant_encode():
+    with pytest.raises(codec.CodecError):
+        codec.encode({"TYPE": "SEND", "MESSAGE": 1.5})
+    with pytest.raises(codec.CodecError):
+        codec.encode({"TYPE": "NOT_A_TYPE"})
+
+
+def test_truncated_and_unknown_payloads():
+    data = codec.encode({"TYPE": "SEND", "ROOM_NAME": "lobby", "MESSAGE": "hello"})
+    for end in range(2, len(data)):
+        with pytest.raises(codec.CodecError):
+            codec.decode(data[:end])
+    with pytest.raises(codec.CodecError):
+        codec.decode(bytes([codec.VERSION, 250]))
+    with pytest.raises(codec.CodecError):
+        codec.decode(bytes([codec.VERSION - 1]) + data[1:])
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    bytes([codec.VERSION]),
+    # a huge extras count made of zero length keys, used to spin forever without moving
+    bytes([codec.VERSION, 19]) + b"\xff" * 9 + b"\x7f" + b"\x01\x00",
+    bytes([codec.VERSION, 19, 1, 1, 0]),
+    # a varint that never ends
+    bytes([codec.VERSION, 4, 0, codec.INT]) + b"\xff" * 20 + b"\x01",
+    # lengths past the end of the payload
+    bytes([codec.VERSION, 3, 0x7F, 0x61]),
+    bytes([codec.VERSION, 3, 0x80, 0x01, 0x61]),
+    bytes([codec.VERSION, 3, 0, codec.BYTES, 100, 1, 2]),
+    bytes([codec.VERSION, 3, 0, codec.LIST, 100, codec.NONE, 0]),
+    bytes([codec.VERSION, 3, 0, codec.TEXT, 1, 0]),
+    bytes([codec.VERSION, 3, 0, codec.TEXT, 4, 0xFF, 0xFE, 0]),
+    # lists nested deeper than the interpreter can recurse
+    bytes([codec.VERSION, 3, 0]) + bytes([codec.LIST, 1]) * 5000 + bytes([codec.NONE, 0]),
+])
+def test_malformed_payloads(data):
+    with pytest.raises(codec.CodecError):
+        codec.decode(data)
+
+
+def test_random_payloads_only_ever_raise_codec_errors():
+    import random
+
+    rng = random.Random(1234)
+    samples = [codec.encode(msg) for msg in (
+        {"TYPE": "NAME", "NAME": "alice", "CODECS": [8], "PUBLIC_KEY": b"\x00" * 32},
+        {"TYPE": "ROOM_LIST", "VERSION": 3, "PAGE": 0, "PAGES": 1, "ROOMS": [["lobby", "alice", 2, False]]},
+        {"TYPE": "WELCOME", "CODEC": 8, "EXTRA": [1, -5, b"x", ["a"]]},
+    )]
+    for _ in range(5000):
+        data = bytearray(rng.choice(samples))
+        for _ in range(rng.randint(1, 4)):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        data = data[:rng.randint(0, len(data))]
+        try:
+            codec.decode(bytes(data))
+        except codec.CodecError:
+            pass
+
+
+def test_negotiate_picks_the_highest_common_version():
+    assert codec.negotiate([1, 2, codec.VERSION]) == codec.VERSION
+    assert codec.negotiate(list(codec.SUPPORTED_VERSIONS)) == max(codec.SUPPORTED_VERSIONS)
+    assert codec.negotiate([1, 2]) is None
+    assert codec.negotiate([]) is None
+    assert codec.negotiate(None) is None
+    assert codec.negotiate(str(codec.VERSION)) is None
+
+
+# a pickle payload is never unpickled, whatever it would do
+class Boom:
+    def __reduce__(self):
+        return (pytest.fail, ("payload was unpickled",))
+
+
+def test_pickle_payloads_are_rejected():
+    with pytest.raises(codec.CodecError):
+        decode_payload(pickle.dumps(Boom()))
+    with pytest.raises(codec.CodecError):
+        decode_payload(pickle.dumps({"TYPE": "SEND", "ROOM_NAME": "r", "MESSAGE": "hi"}))
+
+
+def test_registration_negotiates_the_codec(relay, connection):
+    conn, registered = connection(), []
+    relay.register_name(conn, {"TYPE": "NAME", "NAME": "alice", "CODECS": [1, codec.VERSION]}, registered.append)
+    assert registered == ["alice"]
+    assert conn.sent[0]["TYPE"] == "WELCOME" and conn.sent[0]["CODEC"] == codec.VERSION
+
+    # an old client that doesn't list any codec version is turned away
+    conn, registered = connection(), []
+    relay.register_name(conn, {"TYPE": "NAME", "NAME": "bob"}, registered.append)
+    assert registered == [None]
+    assert conn.sent == [{"TYPE": "ERROR", "MESSAGE": "Unsupported client version"}]
+    assert "bob" not in relay.clients
@@ -0,0 +1,102 @@
+import pytest
+
+import commands
+from chat_room import chat_room
+from client_info import Client
+
+
+@pytest.fixture
+def room():
+    room = chat_room("r", "alice")
+    room.add_user("bob")
+    room.add_user("carol")
+    return room
+
+
+@pytest.fixture
+def clients(connection):
+    return {name: Client(connection(), name, "r") for name in ("alice", "bob", "carol", "dave")}
+
+
+def run(room, clients, from_user, name, *args):
+    commands.run(room, clients, from_user, {"TYPE": "COMMAND", "ROOM_NAME": "r", "COMMAND": name, "ARGS": list(args)})
+
+
+def messages(clients, user):
+    return [msg.get("MESSAGE") for msg in clients[user].get_socket().sent]
+
+
+def test_admin_commands_are_refused_to_members(room, clients):
+    for name in ("remove", "ban", "makeadmin"):
+        run(room, clients, "bob", name, "carol")
+        assert messages(clients, "bob")[-1] == f"Only admins can use !{name}."
+    run(room, clients, "bob", "listusers")
+    assert messages(clients, "bob")[-1] == "Only admins can use !listusers."
+
+    assert list(room.users) == ["alice", "bob", "carol"]
+    assert list(room.admins) == ["alice"]
+    assert not room.ban_list
+    assert messages(clients, "carol") == []
+
+
+@pytest.mark.parametrize("args, error", [
+    ((), "Invalid command format."),
+    (("bob", "carol"), "Invalid command format."),
+    (("alice",), "You cannot perform this action on yourself."),
+    (("dave",), "dave is not in the room."),
+])
+def test_target_is_checked_before_the_handler_runs(room, clients, args, error):
+    run(room, clients, "alice", "ban", *args)
+    assert messages(clients, "alice") == [error]
+    assert list(room.users) == ["alice", "bob", "carol"]
+    assert not room.ban_list
+
+
+def test_commands_without_a_target_take_no_arguments(room, clients):
+    run(room, clients, "bob", "role", "extra")
+    assert messages(clients, "bob") == ["Invalid command format."]
+
+
+def test_malformed_and_unknown_commands(room, clients):
+    commands.run(room, clients, "bob", {"TYPE": "COMMAND", "COMMAND": "role", "ARGS": [1]})
+    commands.run(room, clients, "bob", {"TYPE": "COMMAND", "COMMAND": None})
+    run(room, clients, "bob", "nope")
+    assert messages(clients, "bob") == ["Invalid command format.", "Invalid command format.",
+                                        "Unknown command !nope, !help lists the commands."]
+
+
+def test_commands_from_outside_the_room_are_ignored(room, clients):
+    run(room, clients, "dave", "role")
+    run(room, clients, "dave", "ban", "bob")
+    assert messages(clients, "dave") == []
+    assert "bob" in room.users
+
+
+def test_admin_ban_removes_and_tells_the_room(room, clients):
+    run(room, clients, "alice", "ban", "bob")
+    assert list(room.users) == ["alice", "carol"]
+    assert room.ban_list == {"bob"}
+
+    sent = clients["bob"].get_socket().sent
+    assert sent[-1]["TYPE"] == "REJOIN"
+    assert [msg["TYPE"] for msg in clients["carol"].get_socket().sent] == ["BROADCAST", "ROSTER"]
+    assert clients["carol"].get_socket().sent[-1]["MEMBERS"] == [["alice", None], ["carol", None]]
+
+
+def test_makeadmin_lets_the_new_admin_run_admin_commands(room, clients):
+    run(room, clients, "alice", "makeadmin", "bob")
+    assert "bob" in room.admins
+    run(room, clients, "bob", "remove", "carol")
+    assert list(room.users) == ["alice", "bob"]
+
+
+def test_help_only_lists_admin_commands_for_admins(room, clients):
+    run(room, clients, "alice", "help")
+    run(room, clients, "bob", "help")
+    admin_help, member_help = messages(clients, "alice")[0], messages(clients, "bob")[0]
+
+    for cmd in commands.COMMANDS.values():
+        assert cmd.usage() in admin_help
+        assert (cmd.usage() in member_help) != cmd.admin
+    for name, _ in commands.CLIENT_COMMANDS:
+        assert f"!{name}" in member_help
@@ -0,0 +1,81 @@
+import zlib
+
+import pytest
+
+import codec
+import compression
+from compression import Deflater, Inflater, negotiate, COMPRESSED, ZLIB, ZLIB_DICT
+from protocol import encode_frame, HEADER
+
+
+def test_the_first_method_the_relay_allows_is_picked():
+    assert negotiate([ZLIB, ZLIB_DICT]) == ZLIB_DICT
+    assert negotiate([ZLIB]) == ZLIB
+    assert negotiate([ZLIB_DICT], allowed=(ZLIB,)) is None
+    assert negotiate(["brotli"]) is None
+    assert negotiate(None) is None and negotiate("zlib") is None
+
+
+def test_unknown_method_is_refused():
+    with pytest.raises(ValueError):
+        Deflater("brotli")
+
+
+def test_small_frames_go_out_as_they_are():
+    deflater = Deflater(threshold=64)
+    parts = encode_frame({"TYPE": "PING"})
+    assert deflater.compress(parts) is parts
+    assert deflater.stats()["RAW_BYTES"] == deflater.stats()["WIRE_BYTES"] == len(parts[1])
+
+
+@pytest.mark.parametrize("method", [ZLIB, ZLIB_DICT])
+def test_one_stream_carries_every_frame(method):
+    deflater = Deflater(method, threshold=0)
+    inflater = Inflater()
+    msgs = [{"TYPE": "RECEIVE", "FROM": "alice", "ROOM_NAME": "lobby", "MESSAGE": f"line {i} of the same chat"} for i in range(5)]
+
+    sizes = []
+    for msg in msgs:
+        header, data = deflater.compress(encode_frame(msg))
+        (length,) = HEADER.unpack(header)
+        assert length & COMPRESSED and length & ~COMPRESSED == len(data)
+        # every frame can be read as soon as it arrives
+        assert codec.decode(inflater.decompress(data)) == msg
+        sizes.append(len(data))
+
+    # later frames are mostly back references to the earlier ones
+    assert sizes[-1] < sizes[0]
+    stats = deflater.stats()
+    assert stats["COMPRESSION"] == method and stats["WIRE_BYTES"] == sum(sizes)
+
+
+def test_broken_or_oversized_frames_are_refused():
+    with pytest.raises(ValueError):
+        Inflater().decompress(b"not zlib at all")
+
+    data = zlib.compress(b"x" * 10000)
+    with pytest.raises(ValueError):
+        Inflater().decompress(data, max_length=100)
+
+
+def test_the_welcome_turns_compression_on(relay, connection):
+    conn = connection()
+    names = []
+    relay.register_name(conn, {"TYPE": "NAME", "NAME": "alice", "CODECS": [codec.VERSION], "COMPRESSION": [ZLIB]}, names.append)
+    assert names == ["alice"]
+    welcome = conn.sent[0]
+    assert welcome["TYPE"] == "WELCOME" and welcome["COMPRESSION"] == ZLIB
+    assert conn.deflater.method == ZLIB
+
+    # a client that doesn't offer compression gets none
+    other = connection()
+    relay.register_name(other, {"TYPE": "NAME", "NAME": "bob", "CODECS": [codec.VERSION]}, names.append)
+    assert other.sent[0]["COMPRESSION"] is None
+    assert not hasattr(other, "deflater")
+
+
+def test_the_relay_can_turn_methods_off(relay, connection, monkeypatch):
+    monkeypatch.setitem(relay.compression_options, "methods", (compression.ZLIB,))
+    conn = connection()
+    relay.register_name(conn, {"TYPE": "NAME", "NAME": "alice", "CODECS": [codec.VERSION], "COMPRESSION": [ZLIB_DICT]}, lambda name: None)
+    assert conn.sent[0]["COMPRESSION"] is None
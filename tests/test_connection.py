@@ -0,0 +1,131 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from connection import OutboundQueue, Connection, DROP_OLDEST, DISCONNECT, BLOCK
+from protocol import encode_frame, FrameReader
+
+
+def frame(n):
+    return (b"h", b"%d" % n)
+
+
+def queued(queue):
+    return [int(parts[1]) for parts in queue.frames]
+
+
+def test_unknown_policy_is_refused():
+    with pytest.raises(ValueError):
+        OutboundQueue(policy="wait_forever")
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    queue = OutboundQueue(limit=3, policy=DROP_OLDEST)
+    for n in range(5):
+        assert queue.put(frame(n))
+    assert queued(queue) == [2, 3, 4]
+    assert queue.bytes == 6
+    assert queue.stats()["DROPPED"] == 2 and queue.stats()["MAX_DEPTH"] == 3
+
+
+def test_disconnect_refuses_past_the_limit():
+    queue = OutboundQueue(limit=2, policy=DISCONNECT)
+    assert queue.put(frame(0)) and queue.put(frame(1))
+    assert not queue.put(frame(2))
+    assert queued(queue) == [0, 1]
+    assert queue.stats()["DROPPED"] == 0
+
+
+def test_block_gives_up_after_the_timeout():
+    queue = OutboundQueue(limit=1, policy=BLOCK, block_timeout=0.05)
+    assert queue.put(frame(0))
+    started = time.monotonic()
+    assert not queue.put(frame(1))
+    assert time.monotonic() - started >= 0.05
+    assert queued(queue) == [0]
+
+
+def test_block_waits_for_the_writer_to_make_room():
+    queue = OutboundQueue(limit=1, policy=BLOCK, block_timeout=5.0)
+    queue.put(frame(0))
+    threading.Timer(0.05, queue.pop_batch).start()
+    assert queue.put(frame(1))
+    assert queued(queue) == [1]
+
+
+def test_block_on_the_event_loop_runs_over_for_the_timeout():
+    queue = OutboundQueue(limit=1, policy=BLOCK, block_timeout=0.05)
+    queue.put(frame(0))
+    # the event loop can't wait: the queue goes over its limit until the timeout, then the consumer is dropped
+    assert queue.put(frame(1), can_block=False)
+    assert queue.put(frame(2), can_block=False)
+    time.sleep(0.06)
+    assert not queue.put(frame(3), can_block=False)
+    assert queued(queue) == [0, 1, 2]
+
+    # the writer caught up, the clock starts over
+    queue.pop_batch()
+    assert queue.full_since is None
+    assert queue.put(frame(4), can_block=False)
+
+
+def test_a_closed_queue_takes_frames_without_keeping_them():
+    queue = OutboundQueue(limit=1, policy=DISCONNECT)
+    queue.put(frame(0))
+    assert queue.close(discard=True) == [frame(0)]
+    assert queue.put(frame(1))
+    assert len(queue) == 0
+
+
+def test_batches_keep_to_the_budget_and_take_one_bulk_frame():
+    queue = OutboundQueue()
+    for n in range(5):
+        queue.put(frame(n))
+    taken = []
+    queue.put_bulk((b"h", b"chunk1"), lambda: taken.append(1))
+    queue.put_bulk((b"h", b"chunk2"), lambda: taken.append(2))
+
+    assert queue.pop_batch(max_frames=3) == [frame(0), frame(1), frame(2)]
+    assert queue.pop_batch(max_frames=3) == [frame(3), frame(4), (b"h", b"chunk1")]
+    assert taken == [1]
+    # a batch over max_bytes still takes its first frame
+    assert queue.pop_batch(max_bytes=1) == [(b"h", b"chunk2")]
+    assert taken == [1, 2]
+    assert queue.pop_batch() is None
+
+
+def test_a_slow_consumer_is_disconnected():
+    near, far = socket.socketpair()
+    near.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    conn = Connection(near, limit=4, policy=DISCONNECT)
+    try:
+        # far never reads: the writer stalls on a full socket buffer and the queue fills up behind it
+        payload = encode_frame({"TYPE": "RECEIVE", "MESSAGE": "x" * 4096})
+        deadline = time.monotonic() + 5
+        while not conn.slow_consumer and time.monotonic() < deadline:
+            conn.send_parts(payload)
+        assert conn.slow_consumer
+        assert conn.queue.closed
+    finally:
+        far.close()
+
+
+def test_the_writer_sends_queued_frames_in_order():
+    near, far = socket.socketpair()
+    conn = Connection(near)
+    try:
+        for n in range(10):
+            conn.send_parts(encode_frame({"TYPE": "RECEIVE", "MESSAGE": str(n)}))
+        conn.close()
+        reader = FrameReader(far)
+        got = []
+        while len(got) < 10:
+            msg = reader.recv_message()
+            if msg is None:
+                break
+            got.append(msg["MESSAGE"])
+        assert got == [str(n) for n in range(10)]
+    finally:
+        far.close()
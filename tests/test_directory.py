@@ -0,0 +1,83 @@
+from directory import RoomDirectory, DirectoryView, RoomSummary, ADD, UPDATE, REMOVE
+
+
+def summary(name, owner="alice", members=1, has_password=False):
+    return RoomSummary(name, owner, members, has_password)
+
+
+def filled(count, page_size=2, history=1024):
+    directory = RoomDirectory(page_size=page_size, history=history)
+    for i in range(count):
+        directory.apply(UPDATE, summary(f"r{i}"))
+    return directory
+
+
+def test_changes_are_numbered_and_no_op_updates_are_skipped():
+    directory = RoomDirectory()
+    assert directory.apply(UPDATE, summary("r")) == (1, ADD, summary("r"))
+    assert directory.apply(UPDATE, summary("r")) is None
+    assert directory.apply(UPDATE, summary("r", members=2)) == (2, UPDATE, summary("r", members=2))
+    assert directory.apply(REMOVE, summary("r")) == (3, REMOVE, summary("r", members=2))
+    assert directory.apply(REMOVE, summary("r")) is None
+    assert directory.version == 3
+
+
+def test_pages_are_encoded_once_per_version():
+    directory = filled(5)
+    first = directory.page(0)
+    assert first.obj["PAGES"] == 3 and [room[0] for room in first.obj["ROOMS"]] == ["r0", "r1"]
+    assert directory.page(0) is first
+    # past the end gives the last page
+    assert [room[0] for room in directory.page(9).obj["ROOMS"]] == ["r4"]
+
+    directory.apply(UPDATE, summary("r0", members=3))
+    assert directory.page(0) is not first
+
+
+def test_deltas_carry_the_last_change_per_room():
+    directory = filled(2)
+    since = directory.version
+    directory.apply(UPDATE, summary("r0", members=2))
+    directory.apply(UPDATE, summary("r0", members=3))
+    directory.apply(REMOVE, summary("r1"))
+    directory.apply(UPDATE, summary("new"))
+
+    delta = directory.listing(since=since)
+    assert delta.obj["TYPE"] == "ROOM_DELTA"
+    assert delta.obj["CHANGES"] == [[UPDATE, "r0", "alice", 3, False], [REMOVE, "r1", "alice", 1, False], [ADD, "new", "alice", 1, False]]
+    assert directory.listing(since=since) is delta
+    # nothing new
+    assert directory.delta(directory.version).obj["CHANGES"] == []
+
+
+def test_listings_older_than_the_log_get_a_page():
+    directory = filled(5, history=2)
+    assert directory.delta(1) is None
+    assert directory.listing(since=1).obj["TYPE"] == "ROOM_LIST"
+    assert directory.listing(since=99).obj["TYPE"] == "ROOM_LIST"
+    assert directory.listing(since=3).obj["TYPE"] == "ROOM_DELTA"
+
+
+def test_replayed_changes_keep_the_version_they_were_given():
+    directory = RoomDirectory()
+    directory.replay(7, ADD, summary("r"))
+    assert directory.version == 7 and directory.rooms == {"r": summary("r")}
+    directory.replay(8, REMOVE, summary("r"))
+    assert directory.version == 8 and directory.rooms == {}
+
+
+def test_the_client_view_follows_pages_and_deltas():
+    directory = filled(3)
+    view = DirectoryView()
+    view.apply(directory.page(0).obj)
+    assert view.has_more()
+    view.apply(directory.page(1).obj)
+    assert not view.has_more()
+    assert list(view.rooms) == ["r0", "r1", "r2"]
+
+    since = directory.version
+    directory.apply(REMOVE, summary("r1"))
+    directory.apply(UPDATE, summary("r2", members=4))
+    view.apply(directory.listing(since=since).obj)
+    assert view.rooms == {"r0": summary("r0"), "r2": summary("r2", members=4)}
+    assert view.version == directory.version
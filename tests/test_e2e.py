@@ -0,0 +1,186 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import e2e
+from client import ServerConnection
+from protocol import encode_frame, send_buffers, FrameReader
+
+pytestmark = pytest.mark.skipif(not e2e.AVAILABLE, reason="needs the cryptography package")
+
+
+def roster(room_name, *sessions, plain=()):
+    members = [[session.name, session.public_key] for session in sessions] + [[name, None] for name in plain]
+    return {"TYPE": "ROSTER", "ROOM_NAME": room_name, "MEMBERS": members}
+
+
+def deliver(sender_key, sender):
+    return dict(sender_key, FROM=sender.name)
+
+
+def test_members_read_each_others_messages():
+    sessions = [e2e.E2ESession(name) for name in ("alice", "bob", "carol")]
+    keys = [session.handle_roster(roster("r", *sessions)) for session in sessions]
+    for session in sessions:
+        for sender, key in zip(sessions, keys):
+            if sender is not session:
+                assert session.handle_sender_key(deliver(key, sender)) == []
+    alice, bob, carol = sessions
+    assert all(session.encrypted("r") for session in sessions)
+
+    sealed = dict(alice.seal("r", "hello"), FROM="alice")
+    assert bob.open(sealed) == "hello"
+    assert carol.open(sealed) == "hello"
+
+    # the relay can't pass it off as someone else's
+    with pytest.raises(e2e.E2EError):
+        bob.open(dict(sealed, FROM="carol"))
+
+
+def test_messages_held_until_their_key_arrives():
+    alice, bob = e2e.E2ESession("alice"), e2e.E2ESession("bob")
+    alice_key = alice.handle_roster(roster("r", alice, bob))
+    bob.handle_roster(roster("r", alice, bob))
+
+    sealed = dict(alice.seal("r", "early"), FROM="alice")
+    assert bob.open(sealed) is None
+    assert bob.handle_sender_key(deliver(alice_key, alice)) == [("alice", "early")]
+
+
+def test_someone_leaving_rotates_the_keys():
+    alice, bob, carol = e2e.E2ESession("alice"), e2e.E2ESession("bob"), e2e.E2ESession("carol")
+    alice.handle_roster(roster("r", alice, bob, carol))
+    key_id = alice.rooms["r"].key_id
+
+    # a newcomer only gets the current key
+    dave = e2e.E2ESession("dave")
+    msg = alice.handle_roster(roster("r", alice, bob, carol, dave))
+    assert alice.rooms["r"].key_id == key_id
+    assert [to for to, _ in msg["KEYS"]] == ["dave"]
+
+    msg = alice.handle_roster(roster("r", alice, bob, dave))
+    assert alice.rooms["r"].key_id == key_id + 1
+    assert [to for to, _ in msg["KEYS"]] == ["bob", "dave"]
+
+
+def test_a_member_without_a_key_is_reported_once():
+    alice, bob = e2e.E2ESession("alice"), e2e.E2ESession("bob")
+    alice.handle_roster(roster("r", alice, bob, plain=["old"]))
+    assert not alice.encrypted("r")
+    assert alice.newly_unencrypted("r") == ["old"]
+    assert alice.newly_unencrypted("r") == []
+
+    # once everyone can encrypt again the next one is reported again
+    alice.handle_roster(roster("r", alice, bob))
+    assert alice.newly_unencrypted("r") == []
+    assert alice.encrypted("r")
+    alice.handle_roster(roster("r", alice, bob, plain=["old2"]))
+    assert alice.newly_unencrypted("r") == ["old2"]
+
+
+def test_own_messages_read_back_from_history(pair):
+    near, _ = pair
+    alice, bob, carol = e2e.E2ESession("alice"), e2e.E2ESession("bob"), e2e.E2ESession("carol")
+    server = ServerConnection(near, alice)
+
+    alice.handle_roster(roster("r", alice, bob, carol))
+    first = alice.seal("r", "before carol left")
+    # carol leaves, alice seals with a new key from here on
+    alice.handle_roster(roster("r", alice, bob))
+    second = alice.seal("r", "after")
+    assert second["KEY_ID"] == first["KEY_ID"] + 1
+
+    history = {"TYPE": "HISTORY", "ROOM_NAME": "r", "FIRST": 1, "MESSAGES": [
+        [1, "SEALED", "alice", first["CIPHERTEXT"], first["KEY_ID"]],
+        [2, "SEALED", "alice", second["CIPHERTEXT"], second["KEY_ID"]],
+        [3, "SEALED", "bob", b"\x00" * 40, 1],
+    ]}
+    server.open_history(history)
+    assert [entry[3] for entry in history["MESSAGES"]] == ["before carol left", "after", "[encrypted message]"]
+
+
+def test_a_sender_key_claiming_to_be_ours_is_ignored():
+    alice, bob = e2e.E2ESession("alice"), e2e.E2ESession("bob")
+    alice.handle_roster(roster("r", alice, bob))
+    key = alice.rooms["r"].sender_keys[("alice", 1)]
+    forged = bob.handle_roster(roster("r", alice, bob))
+    alice.handle_sender_key(dict(forged, FROM="alice", KEY_ID=1))
+    assert alice.rooms["r"].sender_keys[("alice", 1)] is key
+
+
+@pytest.fixture
+def pair():
+    near, far = socket.socketpair()
+    yield near, far
+    near.close()
+    far.close()
+
+
+def relay_sends(sock, *msgs):
+    send_buffers(sock, [part for msg in msgs for part in encode_frame(msg)])
+
+
+def received(sock):
+    sock.setblocking(False)
+    reader = FrameReader(sock)
+    try:
+        reader.fill()
+    except BlockingIOError:
+        return []
+    return [reader.decode(payload)["TYPE"] for payload in reader.buffer.payloads()]
+
+
+def test_client_refuses_plaintext_until_the_user_agrees(pair):
+    near, far = pair
+    session, bob = e2e.E2ESession("alice"), e2e.E2ESession("bob")
+    server = ServerConnection(near, session)
+    server.name = "alice"
+    server.room = "r"
+
+    # no keys yet
+    assert server.say("hi")[0]["MESSAGE"].startswith("Not sent: the keys")
+
+    relay_sends(far, roster("r", session, bob, plain=["old"]))
+    notices = [msg for msg in server.read() if msg["TYPE"] == "BROADCAST"]
+    assert len(notices) == 1 and "old" in notices[0]["MESSAGE"]
+    # the next ROSTER with the same member doesn't tell the user again
+    relay_sends(far, roster("r", session, bob, plain=["old"]))
+    assert [msg for msg in server.read() if msg["TYPE"] == "BROADCAST"] == []
+    received(far)
+
+    assert server.say("hi")[0]["MESSAGE"].startswith("Not sent: someone")
+    assert received(far) == []
+
+    server.say("!plaintext")
+    assert server.say("hi") == []
+    assert received(far) == ["SEND"]
+
+
+def test_a_rejoin_waits_for_the_line_being_sealed(pair):
+    near, far = pair
+    alice, bob = e2e.E2ESession("alice"), e2e.E2ESession("bob")
+    server = ServerConnection(near, alice)
+    server.name = "alice"
+    server.room = "r"
+    alice.handle_roster(roster("r", alice, bob))
+
+    # the GUI's writer thread is between encrypted() and seal() when the network thread reads a REJOIN
+    checked = threading.Event()
+    encrypted = alice.encrypted
+
+    def slow_encrypted(room_name):
+        checked.set()
+        time.sleep(0.2)
+        return encrypted(room_name)
+
+    alice.encrypted = slow_encrypted
+    relay_sends(far, {"TYPE": "REJOIN", "MESSAGE": "kicked"})
+    reader = threading.Thread(target=lambda: checked.wait() and server.read())
+    reader.start()
+    assert server.say("hi") == []
+    reader.join()
+
+    assert server.room is None and "r" not in alice.rooms
+    assert received(far) == ["SEALED"]
@@ -0,0 +1,100 @@
+from heartbeat import TimerWheel, Reaper, SLOTS
+
+
+# deadline in ticks -> key, spread over every level of the wheel
+DEADLINES = [1, 2, SLOTS - 1, SLOTS, SLOTS + 1, 100, SLOTS ** 2 - 1, SLOTS ** 2, SLOTS ** 2 + 7, 5000, SLOTS ** 3 + 3]
+
+
+def test_every_timer_fires_on_its_own_tick():
+    wheel = TimerWheel(tick=1.0, start=0)
+    for deadline in DEADLINES:
+        wheel.schedule(deadline, deadline)
+    assert len(wheel) == len(DEADLINES)
+
+    fired = {}
+    for now in range(1, max(DEADLINES) + 1):
+        for key in wheel.advance(now):
+            fired[key] = now
+    assert fired == {deadline: deadline for deadline in DEADLINES}
+    assert len(wheel) == 0
+
+
+def test_cascading_timers_fire_after_a_jump():
+    wheel = TimerWheel(tick=1.0, start=0)
+    for deadline in DEADLINES:
+        wheel.schedule(deadline, deadline)
+
+    # one advance() over many ticks still goes through every cascade on the way
+    assert sorted(wheel.advance(SLOTS ** 2)) == [d for d in DEADLINES if d <= SLOTS ** 2]
+    assert wheel.advance(SLOTS ** 2 + 6) == []
+    assert sorted(wheel.advance(SLOTS ** 3 + 3)) == [d for d in DEADLINES if d > SLOTS ** 2]
+
+
+def test_timers_set_partway_through_cascade_on_time():
+    wheel = TimerWheel(tick=1.0, start=0)
+    wheel.advance(SLOTS - 3)
+    wheel.schedule("a", SLOTS - 3 + 200)
+    wheel.schedule("b", SLOTS - 3 + SLOTS ** 2 + 1)
+    assert wheel.advance(SLOTS - 3 + 199) == []
+    assert wheel.advance(SLOTS - 3 + 200) == ["a"]
+    assert wheel.advance(SLOTS - 3 + SLOTS ** 2) == []
+    assert wheel.advance(SLOTS - 3 + SLOTS ** 2 + 1) == ["b"]
+
+
+def test_deadlines_round_up_to_the_next_tick():
+    wheel = TimerWheel(tick=0.5, start=0)
+    wheel.schedule("a", 1.2)  # tick 3
+    wheel.schedule("b", -5)   # already due: the next tick
+    assert wheel.advance(0.5) == ["b"]
+    assert wheel.advance(1.0) == []
+    assert wheel.advance(1.5) == ["a"]
+
+
+def test_cancel_and_reschedule():
+    wheel = TimerWheel(tick=1.0, start=0)
+    wheel.schedule("a", 10)
+    wheel.schedule("b", 500)
+    wheel.cancel("b")
+    wheel.cancel("nobody")
+    assert len(wheel) == 1
+
+    # scheduling again moves the timer, it only fires once
+    wheel.schedule("a", 300)
+    assert wheel.advance(299) == []
+    assert wheel.advance(300) == ["a"]
+    assert wheel.advance(1000) == []
+    assert len(wheel) == 0
+
+
+def test_reaper_pings_then_drops_a_silent_connection(connection):
+    reaper = Reaper(ping_interval=10, idle_timeout=30, tick=1.0)
+    reaper.wheel = TimerWheel(tick=1.0, start=0)
+    conn = connection(last_seen=0)
+    reaper.watch(conn)
+
+    reaper.check(9)
+    assert conn.sent == []
+    reaper.check(10)
+    assert conn.types() == ["PING"] and not conn.aborted
+
+    reaper.check(29)
+    assert not conn.aborted
+    reaper.check(30)
+    assert conn.aborted and reaper.reaped == 1
+    assert len(reaper.wheel) == 0
+
+
+def test_reaper_leaves_a_busy_connection_alone(connection):
+    reaper = Reaper(ping_interval=10, idle_timeout=30, tick=1.0)
+    reaper.wheel = TimerWheel(tick=1.0, start=0)
+    conn = connection(last_seen=0)
+    reaper.watch(conn)
+
+    for now in range(1, 100):
+        conn.last_seen = now - 1
+        reaper.check(now)
+    assert conn.sent == [] and not conn.aborted
+    assert len(reaper.wheel) == 1
+
+    reaper.forget(conn)
+    assert len(reaper.wheel) == 0
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from history import RoomHistory, SegmentLog
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+needs_proc = pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="counts file descriptors through /proc")
+
+
+def fill(history, n):
+    for i in range(n):
+        history.append("RECEIVE", "alice", f"message {i}" + "x" * 100)
+
+
+def test_paging_back_through_full_segments(tmp_path):
+    history = RoomHistory(size=10, log=SegmentLog(str(tmp_path), segment_size=1024, max_segments=100))
+    fill(history, 200)
+    assert len(history.log.segments) > 5
+
+    page = history.before(50, 30)
+    assert [entry[0] for entry in page] == list(range(20, 50))
+    assert page[0][3].startswith("message 19")
+    # across the ring and the log
+    assert [entry[0] for entry in history.before(None, 15)] == list(range(186, 201))
+    assert history.log.get(1)[3].startswith("message 0")
+
+
+def test_only_the_segment_being_written_is_mapped(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=1024, max_segments=100)
+    history = RoomHistory(size=10, log=log)
+    fill(history, 200)
+    assert [segment.map is not None for segment in log.segments] == [False] * (len(log.segments) - 1) + [True]
+
+    # and after opening the log again
+    log.close()
+    log = SegmentLog(str(tmp_path), segment_size=1024, max_segments=100)
+    assert [segment.map is not None for segment in log.segments] == [False] * (len(log.segments) - 1) + [True]
+    log.close()
+
+
+@needs_proc
+def test_file_descriptors_per_room(tmp_path):
+    before = open_fds()
+    histories = []
+    for room in range(20):
+        history = RoomHistory(size=10, log=SegmentLog(str(tmp_path / str(room)), segment_size=1024, max_segments=8))
+        fill(history, 100)
+        histories.append(history)
+    assert open_fds() - before == 20
+    for history in histories:
+        history.close()
+    assert open_fds() == before
+
+
+@needs_proc
+def test_logs_open_on_first_use(tmp_path):
+    path = str(tmp_path / "room")
+    history = RoomHistory(size=10, log=SegmentLog(path, segment_size=1024))
+    fill(history, 30)
+    history.close()
+
+    before = open_fds()
+    opened = []
+
+    def open_log():
+        opened.append(True)
+        return SegmentLog(path, segment_size=1024)
+
+    restored = [RoomHistory(size=10, open_log=open_log) for _ in range(50)]
+    assert opened == [] and open_fds() == before
+
+    # the first use picks up where the log left off
+    again = restored[0]
+    assert again.last_seq() == 30
+    assert opened == [True]
+    assert [entry[0] for entry in again.before(None, 5)] == [26, 27, 28, 29, 30]
+    assert again.append("RECEIVE", "bob", "hi") == 31
+    again.close()
+
+
+def test_a_restored_room_that_is_deleted_takes_its_log_along(tmp_path):
+    path = str(tmp_path / "room")
+    history = RoomHistory(log=SegmentLog(path, segment_size=1024))
+    fill(history, 5)
+    history.close()
+
+    RoomHistory(open_log=lambda: SegmentLog(path, segment_size=1024)).delete()
+    assert not os.path.exists(path)
+
+
+def test_old_segments_are_evicted(tmp_path):
+    history = RoomHistory(size=5, log=SegmentLog(str(tmp_path), segment_size=1024, max_segments=3))
+    fill(history, 200)
+    assert len(history.log.segments) == 3
+    assert len(os.listdir(tmp_path)) == 3
+    first = history.first_seq()
+    assert first > 1
+    assert history.before(first + 3, 100)[0][0] == first
+    history.close()
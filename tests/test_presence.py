@@ -0,0 +1,108 @@
+import pytest
+
+from chat_room import chat_room
+from client_info import Client
+from presence import PresenceBatcher, notice, JOINED, LEFT, BANNED
+
+
+@pytest.fixture
+def batcher():
+    # room jobs run right here and the thread is never started, due() flushes whatever was scheduled
+    return PresenceBatcher(lambda room_name, fn, *args: fn(*args), window=0, cap=3)
+
+
+@pytest.fixture
+def clients(connection):
+    return {"owner": Client(connection(), "owner", "r")}
+
+
+# name joins room the way enter_room does it
+@pytest.fixture
+def join(connection):
+    def join(room, clients, name):
+        clients[name] = Client(connection(), name, room.room_name)
+        room.add_user(name)
+        room.announce(clients, JOINED, name)
+        room.send_join_roster(clients)
+    return join
+
+
+def due(batcher):
+    while batcher.due:
+        _, room, clients = batcher.due.popleft()
+        batcher.flush(room, clients)
+
+
+def types(clients, user):
+    return clients[user].get_socket().types()
+
+
+def test_notice_lists_up_to_the_cap():
+    assert notice(JOINED, ["alice"]) == "Welcome to the chat room alice!"
+    assert notice(LEFT, ["alice", "bob"]) == "2 users left: alice, bob"
+    assert notice(BANNED, ["a", "b", "c", "d", "e"], cap=3) == \
+        "5 users were banned from the room by an admin: a, b, c and 2 more"
+
+
+def test_a_window_of_joins_is_one_notice_and_one_roster(batcher, clients, join):
+    room = chat_room("r", "owner", presence=batcher)
+    for i in range(5):
+        join(room, clients, f"user{i}")
+
+    # nothing goes out before the window ends, and the room is only scheduled once
+    assert types(clients, "owner") == []
+    assert len(batcher.due) == 1
+
+    due(batcher)
+    assert types(clients, "owner") == ["BROADCAST", "ROSTER"]
+    sent = clients["owner"].get_socket().sent
+    assert sent[0]["MESSAGE"] == "5 users joined: user0, user1, user2 and 2 more"
+    assert [member for member, _ in sent[1]["MEMBERS"]] == ["owner"] + [f"user{i}" for i in range(5)]
+    assert types(clients, "user4") == ["BROADCAST", "ROSTER"]
+    assert not room.roster_pending and not room.presence_scheduled
+
+
+def test_joining_and_leaving_in_one_window_cancels_out(batcher, clients, join):
+    room = chat_room("r", "owner", presence=batcher)
+    join(room, clients, "alice")
+    join(room, clients, "bob")
+    room.remove_user("alice")
+    room.announce(clients, LEFT, "alice")
+
+    due(batcher)
+    assert [msg["MESSAGE"] for msg in clients["owner"].get_socket().sent if msg["TYPE"] == "BROADCAST"] == \
+        ["Welcome to the chat room bob!"]
+
+
+def test_a_departure_roster_takes_the_pending_one(batcher, clients, join):
+    room = chat_room("r", "owner", presence=batcher)
+    join(room, clients, "alice")
+    join(room, clients, "bob")
+
+    # someone leaving sends the ROSTER right away, it already has the newcomers
+    room.remove_user("bob")
+    room.announce(clients, LEFT, "bob")
+    room.send_roster(clients)
+    assert types(clients, "owner") == ["ROSTER"]
+
+    due(batcher)
+    # no second ROSTER, and bob came and went within the window so only alice is announced
+    assert types(clients, "owner") == ["ROSTER", "BROADCAST"]
+    assert clients["owner"].get_socket().sent[-1]["MESSAGE"] == "Welcome to the chat room alice!"
+
+
+def test_a_new_window_starts_after_a_flush(batcher, clients, join):
+    room = chat_room("r", "owner", presence=batcher)
+    join(room, clients, "alice")
+    due(batcher)
+    join(room, clients, "bob")
+    assert len(batcher.due) == 1
+    due(batcher)
+    assert types(clients, "owner") == ["BROADCAST", "ROSTER", "BROADCAST", "ROSTER"]
+
+
+def test_without_a_batcher_everything_goes_out_right_away(clients, join):
+    room = chat_room("r", "owner")
+    join(room, clients, "alice")
+    join(room, clients, "bob")
+    assert types(clients, "owner") == ["BROADCAST", "ROSTER", "BROADCAST", "ROSTER"]
@@ -0,0 +1,107 @@
+import pytest
+
+import compression
+from protocol import FrameBuffer, FrameReader, MAX_LEN, HEADER, encode_frame, decode_payload
+
+
+def frame_bytes(msg):
+    return b"".join(encode_frame(msg))
+
+
+# recv_into that hands out at most chunk bytes per call, like a slow network
+class TrickleSocket:
+
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.chunk = chunk
+
+    def recv_into(self, view):
+        n = min(self.chunk, len(view), len(self.data))
+        view[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+
+def feed(buffer, data):
+    view = buffer.writable()
+    view[:len(data)] = data
+    buffer.filled(len(data))
+
+
+def messages(buffer):
+    return [decode_payload(payload) for payload in buffer.payloads()]
+
+
+def test_frame_split_byte_by_byte():
+    buffer = FrameBuffer(16)
+    msg = {"TYPE": "SEND", "ROOM_NAME": "lobby", "MESSAGE": "hello there"}
+    data = frame_bytes(msg)
+
+    for i in range(len(data) - 1):
+        feed(buffer, data[i:i + 1])
+        assert buffer.next_payload() is None
+    feed(buffer, data[-1:])
+    assert messages(buffer) == [msg]
+
+
+def test_several_frames_in_one_read():
+    buffer = FrameBuffer()
+    msgs = [{"TYPE": "SEND", "ROOM_NAME": "r", "MESSAGE": str(i)} for i in range(5)]
+    data = b"".join(frame_bytes(msg) for msg in msgs)
+
+    # all of them plus the start of the next one
+    feed(buffer, data + data[:3])
+    assert messages(buffer) == msgs
+    feed(buffer, data[3:len(frame_bytes(msgs[0]))])
+    assert messages(buffer) == msgs[:1]
+
+
+def test_buffer_grows_for_a_big_frame_and_shrinks_back():
+    buffer = FrameBuffer(64)
+    big = {"TYPE": "SEND", "ROOM_NAME": "r", "MESSAGE": "x" * 1000}
+    data = frame_bytes(big)
+
+    sock = TrickleSocket(data, 100)
+    while buffer.next_payload() is None:
+        n = sock.recv_into(buffer.writable())
+        buffer.filled(n)
+        # the whole pending frame fits once its header is in
+        assert len(buffer.buf) in (64, len(data))
+    assert len(buffer.buf) == len(data)
+
+    buffer.writable()
+    assert len(buffer.buf) == 64
+
+
+def test_oversized_frame_is_rejected():
+    buffer = FrameBuffer()
+    feed(buffer, HEADER.pack(MAX_LEN + 1))
+    with pytest.raises(ValueError):
+        buffer.next_payload()
+
+
+def test_compressed_frames_are_inflated():
+    deflater = compression.Deflater(compression.ZLIB_DICT, threshold=0)
+    msgs = [{"TYPE": "BROADCAST", "FROM": "", "MESSAGE": f"Welcome to the chat room user{i}!"} for i in range(3)]
+    data = b"".join(b"".join(deflater.compress(encode_frame(msg))) for msg in msgs)
+
+    buffer = FrameBuffer()
+    for i in range(0, len(data), 7):
+        feed(buffer, data[i:i + 7])
+    assert messages(buffer) == msgs
+
+
+def test_reader_returns_whole_messages_from_partial_reads():
+    msgs = [{"TYPE": "SEND", "ROOM_NAME": "r", "MESSAGE": "m" * n} for n in (0, 1, 300, 5000)]
+    reader = FrameReader(TrickleSocket(b"".join(frame_bytes(msg) for msg in msgs), 13), size=32)
+
+    assert [reader.recv_message() for _ in msgs] == msgs
+    assert reader.recv_message() is None
+
+
+def test_reader_hands_back_everything_already_buffered():
+    msgs = [{"TYPE": "PING"}, {"TYPE": "PONG"}, {"TYPE": "LOGOUT"}]
+    reader = FrameReader(TrickleSocket(b"".join(frame_bytes(msg) for msg in msgs), 1 << 16))
+
+    assert reader.recv_messages() == msgs
+    assert reader.recv_messages() is None
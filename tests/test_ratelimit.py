@@ -0,0 +1,118 @@
+import pytest
+
+import ratelimit
+from ratelimit import TokenBucket, Limit, RateLimiter
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+class FakeRoom:
+    rate_limits = None
+
+
+def send(text):
+    return {"TYPE": "SEND", "ROOM_NAME": "r", "MESSAGE": text}
+
+
+def test_bucket_starts_full_and_refills_at_its_rate():
+    bucket = TokenBucket(rate=2.0, burst=4.0, now=0.0)
+    for _ in range(4):
+        assert bucket.wait(1, 0.0) == 0.0
+        bucket.take(1)
+    assert bucket.wait(1, 0.0) == pytest.approx(0.5)
+
+    # refilled, but never past the burst
+    assert bucket.wait(1, 0.5) == 0.0
+    assert bucket.wait(4, 100.0) == 0.0
+    assert bucket.tokens == 4.0
+
+
+def test_bucket_wait_takes_nothing():
+    bucket = TokenBucket(rate=1.0, burst=2.0, now=0.0)
+    for _ in range(5):
+        assert bucket.wait(1, 0.0) == 0.0
+    assert bucket.tokens == 2.0
+
+
+def test_anything_bigger_than_the_bucket_passes_once_it_is_full():
+    bucket = TokenBucket(rate=10.0, burst=20.0, now=0.0)
+    assert bucket.wait(1000, 0.0) == 0.0
+    bucket.take(1000)
+    assert bucket.tokens == 0.0
+    assert bucket.wait(1000, 0.0) == pytest.approx(2.0)
+
+
+def test_user_limit_counts_messages_and_bytes(clock, connection):
+    limiter = RateLimiter(user=Limit(messages=1.0, bytes=10.0, burst=2.0))
+    conn = connection()
+    assert limiter.check(conn, "alice", send("x" * 20)) == 0.0
+    # the messages bucket still has one, the bytes one is empty
+    assert limiter.check(conn, "alice", send("x")) == pytest.approx(0.1)
+
+    # other users and anything that isn't a chat line aren't limited by it
+    assert limiter.check(conn, "bob", send("x")) == 0.0
+    assert limiter.check(conn, "alice", {"TYPE": "LIST_ROOMS"}) == 0.0
+
+
+def test_a_message_dropped_by_one_limit_costs_nothing_in_the_others(clock, connection):
+    limiter = RateLimiter(room=Limit(messages=1.0, burst=1.0), connection=Limit(messages=1.0, burst=2.0))
+    conn, room = connection(), FakeRoom()
+
+    assert limiter.check(conn, "alice", send("hi"), room) == 0.0
+    # the room is out of tokens, the connection keeps the one it has left
+    assert limiter.check(conn, "alice", send("hi"), room) == pytest.approx(1.0)
+    assert limiter.check(conn, "alice", send("hi"), room) == pytest.approx(1.0)
+    assert conn.rate_limits.messages.tokens == pytest.approx(1.0)
+    assert limiter.check(conn, "alice", {"TYPE": "LIST_ROOMS"}) == 0.0
+
+
+def test_reserve_takes_the_tokens_anyway(clock, connection):
+    limiter = RateLimiter(connection=Limit(messages=1.0, burst=1.0))
+    conn = connection()
+    assert limiter.check(conn, "alice", send("hi")) == 0.0
+    assert limiter.check(conn, "alice", send("hi"), reserve=True) == pytest.approx(1.0)
+    # in debt: the next one waits for both
+    assert limiter.check(conn, "alice", send("hi"), reserve=True) == pytest.approx(2.0)
+
+    clock.now += 2.0
+    assert limiter.check(conn, "alice", send("hi")) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert limiter.check(conn, "alice", send("hi")) == 0.0
+
+
+def test_forwarded_messages_only_hit_the_room(clock):
+    limiter = RateLimiter(user=Limit(messages=1.0, burst=1.0), room=Limit(messages=1.0, burst=1.0),
+                          connection=Limit(messages=1.0, burst=1.0))
+    room = FakeRoom()
+    assert limiter.check(None, "alice", send("hi"), room) == 0.0
+    assert limiter.users == {}
+    assert limiter.check(None, "alice", send("hi"), room) == pytest.approx(1.0)
+
+
+def test_forget_drops_the_users_buckets(clock, connection):
+    limiter = RateLimiter(user=Limit(messages=1.0, burst=1.0))
+    conn = connection()
+    limiter.check(conn, "alice", send("hi"))
+    assert limiter.check(conn, "alice", send("hi")) > 0
+    limiter.forget("alice")
+    limiter.forget("nobody")
+    assert limiter.check(conn, "alice", send("hi")) == 0.0
+
+
+def test_unknown_action_is_refused():
+    with pytest.raises(ValueError):
+        RateLimiter(action="explode")
@@ -0,0 +1,63 @@
+import pytest
+
+from client_info import Client
+
+
+@pytest.fixture
+def room(relay, connection):
+    for name in ("alice", "bob", "carol"):
+        relay.clients[name] = Client(connection(), name, None)
+    relay.handle_message(conn(relay, "alice"), "alice", {"TYPE": "CREATE_ROOM", "ROOM_NAME": "r"})
+    for name in ("bob", "carol"):
+        relay.handle_message(conn(relay, name), name, {"TYPE": "JOIN_ROOM", "ROOM_NAME": "r"})
+    relay.rooms.run()
+    for name in ("alice", "bob", "carol"):
+        conn(relay, name).sent.clear()
+    return relay.chat_rooms["r"]
+
+
+def conn(relay, name):
+    return relay.clients[name].get_socket()
+
+
+def remove(relay, target):
+    relay.handle_message(conn(relay, "alice"), "alice", {"TYPE": "COMMAND", "ROOM_NAME": "r", "COMMAND": "remove", "ARGS": [target]})
+
+
+def test_remove_queued_before_a_disconnect(relay, room):
+    bob, carol = conn(relay, "bob"), conn(relay, "carol")
+    # the !remove was read first, bob's connection drops before the room's actor gets to it
+    remove(relay, "bob")
+    relay.client_disconnected(bob, "bob")
+    relay.rooms.run()
+
+    assert list(room.users) == ["alice", "carol"]
+    assert "bob" not in relay.clients and "bob" not in relay.user_rooms
+    # the others are told and get the ROSTER they rotate their sender keys from
+    assert carol.types() == ["BROADCAST", "ROSTER"]
+    assert "removed" in carol.sent[0]["MESSAGE"]
+    assert [member for member, _ in carol.sent[1]["MEMBERS"]] == ["alice", "carol"]
+
+
+def test_remove_queued_after_a_disconnect(relay, room):
+    alice, bob, carol = conn(relay, "alice"), conn(relay, "bob"), conn(relay, "carol")
+    relay.client_disconnected(bob, "bob")
+    remove(relay, "bob")
+    relay.rooms.run()
+
+    assert list(room.users) == ["alice", "carol"]
+    assert "bob" not in relay.clients
+    assert carol.types() == ["BROADCAST", "ROSTER"]
+    assert carol.sent[0]["MESSAGE"] == "bob has left the room."
+    assert alice.sent[-1]["MESSAGE"] == "bob is not in the room."
+
+
+def test_a_new_login_keeps_its_client(relay, room, connection):
+    bob = conn(relay, "bob")
+    relay.client_disconnected(bob, "bob")
+    # the name is taken again before the leave job ran
+    relay.clients["bob"] = Client(connection(), "bob", None)
+    relay.rooms.run()
+
+    assert "bob" not in room.users
+    assert relay.clients["bob"].get_socket() is not bob
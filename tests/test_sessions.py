@@ -0,0 +1,104 @@
+import time
+
+from protocol import encode_frame
+from sessions import SessionBuffer, SessionStore
+
+
+def frame(n):
+    return encode_frame({"TYPE": "RECEIVE", "FROM": "bob", "MESSAGE": f"frame {n}"})
+
+
+def messages(conn):
+    return [msg["MESSAGE"] for msg in conn.sent]
+
+
+def test_buffer_keeps_the_newest_frames():
+    buffer = SessionBuffer(8, limit=3)
+    for n in range(5):
+        buffer.send_parts(frame(n))
+    assert list(buffer.frames) == [frame(2), frame(3), frame(4)]
+    assert buffer.missed == 2
+
+
+def test_unwritten_frames_go_before_the_buffered_ones():
+    buffer = SessionBuffer(8, limit=4)
+    buffer.send_parts(frame(3))
+    buffer.send_parts(frame(4))
+    buffer.prepend([frame(0), frame(1), frame(2)])
+    # past the limit it's still the oldest that go
+    assert list(buffer.frames) == [frame(1), frame(2), frame(3), frame(4)]
+    assert buffer.missed == 1
+
+
+def test_attach_replays_in_order_then_passes_frames_on(connection):
+    buffer = SessionBuffer(8)
+    for n in range(3):
+        buffer.send_parts(frame(n))
+    conn = connection()
+    assert buffer.attach(conn) == 0
+    buffer.send_parts(frame(3))
+    assert messages(conn) == ["frame 0", "frame 1", "frame 2", "frame 3"]
+    assert not buffer.frames
+
+
+def test_attach_with_another_codec_replays_nothing(connection):
+    buffer = SessionBuffer(8)
+    buffer.send_parts(frame(0))
+    buffer.send_parts(frame(1))
+    conn = connection(codec=9)
+    assert buffer.attach(conn) == 2
+    assert conn.sent == []
+
+
+def test_bulk_frames_are_not_kept():
+    buffer = SessionBuffer(8)
+    done = []
+    buffer.send_bulk(frame(0), lambda: done.append(True))
+    buffer.send_bulk(frame(1))
+    assert done == [True]
+    assert not buffer.frames
+
+
+def test_tokens_are_checked_per_name():
+    store = SessionStore(grace=30)
+    token = store.issue("alice")
+    other = store.issue("bob")
+    assert store.valid("alice", token)
+    assert not store.valid("alice", other)
+    assert not store.valid("alice", None)
+    assert not store.valid("carol", token)
+
+    # a new login gets a new token, the old one stops working
+    assert store.issue("alice") != token
+    assert not store.valid("alice", token)
+
+
+def test_detach_and_resume():
+    store = SessionStore(grace=30)
+    assert store.detach("alice", 8) is None
+    assert store.resume("alice") is None
+
+    store.issue("alice")
+    # connected: nothing to resume
+    assert store.resume("alice") is None
+
+    buffer = store.detach("alice", 8)
+    assert buffer.codec == 8 and len(store.wheel) == 1
+    assert store.resume("alice") is buffer
+    assert len(store.wheel) == 0
+    assert store.resume("alice") is None
+
+
+def test_the_grace_period_is_on_the_wheel():
+    store = SessionStore(grace=30, tick=1.0)
+    store.issue("alice")
+    store.issue("bob")
+    store.detach("alice", 8)
+    store.detach("bob", 8)
+    store.forget("bob")
+    assert len(store.wheel) == 1
+
+    now = time.monotonic()
+    assert store.wheel.advance(now + 28) == []
+    assert store.wheel.advance(now + 32) == ["alice"]
+    assert "bob" not in store.sessions
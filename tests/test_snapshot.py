@@ -0,0 +1,90 @@
+import os
+
+from chat_room import chat_room, restore_room
+from cluster import shard_of
+from snapshot import SnapshotStore, read_store, load, reshard, room_record, store_name
+
+
+def record(name, admins=("alice",), bans=()):
+    return (name, tuple(admins), tuple(bans), None, None)
+
+
+def test_changes_reach_the_journal_and_read_back(tmp_path):
+    store = SnapshotStore(str(tmp_path), "worker0")
+    room = chat_room("r", "alice", store=store)
+    room.ban_list.add("mallory")
+    room.save()
+    store.removed("gone")
+    # only the newest record per room is written
+    assert store.pending == {"r": room_record(room), "gone": None}
+
+    store.flush()
+    assert store.pending == {} and store.journal_records == 2
+    assert read_store(str(tmp_path), "worker0") == {"r": ("r", ("alice",), ("mallory",), None, None)}
+
+    store.removed("r")
+    store.stop()
+    assert read_store(str(tmp_path), "worker0") == {}
+
+
+def test_the_last_member_leaving_deletes_the_record(tmp_path):
+    store = SnapshotStore(str(tmp_path), "worker0")
+    room = chat_room("r", "alice", store=store)
+    room.remove_user("alice")
+    assert store.pending == {"r": None}
+    store.stop()
+
+
+def test_a_checkpoint_empties_the_journal(tmp_path):
+    store = SnapshotStore(str(tmp_path), "worker0", checkpoint_every=3)
+    for i in range(3):
+        store.pending[f"r{i}"] = record(f"r{i}")
+    store.flush()
+    assert store.journal_records == 0
+    assert os.path.getsize(tmp_path / "worker0.journal") == 0
+
+    store.pending["r3"] = record("r3")
+    store.stop()
+    assert sorted(read_store(str(tmp_path), "worker0")) == ["r0", "r1", "r2", "r3"]
+
+
+def test_an_entry_cut_off_mid_write_is_ignored(tmp_path):
+    store = SnapshotStore(str(tmp_path), "worker0")
+    store.pending["r"] = record("r")
+    store.flush()
+    store.pending["s"] = record("s")
+    store.stop()
+
+    path = tmp_path / "worker0.journal"
+    path.write_bytes(path.read_bytes()[:-3])
+    assert read_store(str(tmp_path), "worker0") == {"r": record("r")}
+
+
+def test_reshard_spreads_the_rooms_over_a_new_worker_count(tmp_path):
+    rooms = {f"r{i}": record(f"r{i}") for i in range(20)}
+    store = SnapshotStore(str(tmp_path), "worker0")
+    store.pending.update(rooms)
+    store.stop()
+    (tmp_path / "worker5.journal").write_bytes(b"")
+
+    reshard(str(tmp_path), load(str(tmp_path)), 3)
+    assert sorted(os.listdir(tmp_path)) == ["worker0.ckpt", "worker1.ckpt", "worker2.ckpt"]
+    for worker_id in range(3):
+        own = read_store(str(tmp_path), store_name(worker_id))
+        assert all(shard_of(name, 3) == worker_id for name in own)
+    assert load(str(tmp_path)) == rooms
+
+
+def test_a_restored_room_keeps_admins_bans_and_password(tmp_path, monkeypatch):
+    monkeypatch.setattr("chat_room.SCRYPT_PARAMS", {"n": 2, "r": 1, "p": 1})
+    room = chat_room("r", "alice", password="secret")
+    room.add_user("bob", password="secret")
+    room.admins.add("bob")
+    room.ban_list.add("mallory")
+
+    restored = restore_room(room_record(room))
+    assert list(restored.users) == []
+    assert list(restored.admins) == ["alice", "bob"]
+    assert restored.ban_list == {"mallory"}
+    assert restored.has_password and restored.check_password("secret") and not restored.check_password("wrong")
+    assert room_record(restored) == room_record(room)